@@ -0,0 +1,149 @@
+# admission.py
+
+"""
+Admission control for speech requests.
+
+Each backend gets a fixed number of concurrent synthesis slots and a bounded
+FIFO wait queue. A request that cannot get a slot within its maximum wait, or
+that arrives while the queue is full, is rejected straight away with an
+estimate of when to retry, so a burst sheds load instead of slowing every
+request down together.
+"""
+
+import math
+import threading
+import time
+from collections import deque
+
+import metrics
+
+class Overloaded(Exception):
+    """Raised when a request is not admitted. retry_after is in whole seconds."""
+
+    def __init__(self, backend, reason, retry_after):
+        super().__init__(f"{backend} backend is overloaded ({reason})")
+        self.backend = backend
+        self.reason = reason
+        self.retry_after = retry_after
+
+class BackendLimiter:
+    """Concurrency slots plus a bounded FIFO wait queue for one backend.
+
+    max_concurrency <= 0 disables the limit for the backend.
+    """
+
+    def __init__(self, backend, max_concurrency, max_queue, max_wait):
+        self.backend = backend
+        self.max_concurrency = max_concurrency
+        self.max_queue = max_queue
+        self.max_wait = max_wait
+        self._active = 0
+        self._waiters = deque()
+        self._lock = threading.Lock()
+        # Smoothed slot hold time, used to estimate Retry-After
+        self._avg_hold = 1.0
+
+    @property
+    def enabled(self):
+        return self.max_concurrency > 0
+
+    def acquire(self, max_wait=None):
+        """Takes a slot, waiting in line for at most max_wait seconds (never longer than configured). Raises Overloaded."""
+        if not self.enabled:
+            return
+        max_wait = self.max_wait if max_wait is None else min(max_wait, self.max_wait)
+        with self._lock:
+            if self._active < self.max_concurrency and not self._waiters:
+                self._active += 1
+                return
+            if len(self._waiters) >= self.max_queue or max_wait <= 0:
+                raise self._reject('queue_full')
+            waiter = threading.Event()
+            self._waiters.append(waiter)
+            metrics.ADMISSION_QUEUE_DEPTH.set(len(self._waiters), backend=self.backend)
+
+        if waiter.wait(max_wait):
+            return
+        with self._lock:
+            # The slot may have been handed over just after the wait timed out
+            if waiter.is_set():
+                return
+            self._waiters.remove(waiter)
+            metrics.ADMISSION_QUEUE_DEPTH.set(len(self._waiters), backend=self.backend)
+            raise self._reject('wait_timeout')
+
+    def release(self, held_for=None):
+        """Returns a slot, handing it directly to the longest waiting request if there is one."""
+        if not self.enabled:
+            return
+        with self._lock:
+            if held_for is not None:
+                self._avg_hold = 0.8 * self._avg_hold + 0.2 * held_for
+            if self._waiters:
+                # The slot stays counted as active and passes to the waiter
+                self._waiters.popleft().set()
+                metrics.ADMISSION_QUEUE_DEPTH.set(len(self._waiters), backend=self.backend)
+            else:
+                self._active -= 1
+
+    def snapshot(self):
+        with self._lock:
+            return {"active": self._active, "queued": len(self._waiters), "limit": self.max_concurrency}
+
+    def _reject(self, reason):
+        # Called with the lock held: time for everyone ahead to drain through the slots
+        ahead = len(self._waiters) + 1
+        retry_after = max(1, math.ceil(ahead * self._avg_hold / self.max_concurrency))
+        metrics.ADMISSION_REJECTED.inc(backend=self.backend, reason=reason)
+        return Overloaded(self.backend, reason, retry_after)
+
+class AdmissionSlot:
+    """A held slot; release() is idempotent so streamed and buffered paths can share it."""
+
+    def __init__(self, limiter):
+        self._limiter = limiter
+        self._start = time.monotonic()
+        self._released = False
+        self._lock = threading.Lock()
+
+    def release(self):
+        with self._lock:
+            if self._released:
+                return
+            self._released = True
+        self._limiter.release(time.monotonic() - self._start)
+
+class AdmissionController:
+    def __init__(self, limits):
+        """limits maps backend name to (max_concurrency, max_queue, max_wait)."""
+        self._limiters = {
+            backend: BackendLimiter(backend, *limit) for backend, limit in limits.items()
+        }
+
+    def admit(self, backend, max_wait=None):
+        """Returns an AdmissionSlot for the backend or raises Overloaded."""
+        limiter = self._limiters.get(backend)
+        if limiter is None:
+            limiter = self._limiters[backend] = BackendLimiter(backend, 0, 0, 0)
+        limiter.acquire(max_wait)
+        return AdmissionSlot(limiter)
+
+    def snapshot(self):
+        return {backend: limiter.snapshot() for backend, limiter in self._limiters.items()}
+
+class ReleasingStream:
+    """Wraps a streamed response body so the admission slot is held until the stream ends."""
+
+    def __init__(self, iterable, slot):
+        self._iterable = iterable
+        self._slot = slot
+
+    def __iter__(self):
+        return iter(self._iterable)
+
+    def close(self):
+        try:
+            if hasattr(self._iterable, 'close'):
+                self._iterable.close()
+        finally:
+            self._slot.release()
@@ -0,0 +1,175 @@
+# audio_cache.py
+
+"""
+Synthesized audio cache.
+
+Speech output is deterministic for a given backend, voice, text, speed,
+pitch, format and cleaning options, so buffered responses are stored under
+a canonical key derived from those fields. The same key is the response's
+strong ETag, which lets repeat requests be answered with 304, and stored
+audio lets Range requests (seeking in an <audio> element) be served without
+synthesizing again.
+
+Keys are an HMAC of the canonical request under a server secret, so a key
+also works as an unguessable URL for the stored audio.
+
+An optional DiskCache behind the in-memory LRU shares stored audio between
+processes; disk hits are copied into memory.
+
+With an admission filter (popularity.PopularityTracker), audio that would
+push entries out of the in-memory or the disk tier is only stored in that
+tier if it is requested more often than each entry it would evict (TinyLFU).
+
+With a peer_cache.PeerCache, misses in both local tiers are looked up on the
+replica that owns the key, and audio stored here is also sent to its owner.
+"""
+
+import hashlib
+import hmac
+import json
+import threading
+from collections import OrderedDict
+
+import metrics
+
+def cache_key(secret, backend, voice, text, speed, pitch, response_format, cleaning_options):
+    """Canonical key for a speech request; hex, and safe to use directly as an ETag or URL segment."""
+    canonical = json.dumps({
+        "backend": backend,
+        "voice": voice,
+        "input": text,
+        "speed": float(speed),
+        "pitch": int(pitch),
+        "response_format": response_format,
+        "cleaning_options": cleaning_options or {},
+    }, sort_keys=True, ensure_ascii=False, separators=(',', ':'))
+    return hmac.new(secret.encode('utf-8'), canonical.encode('utf-8'), hashlib.sha256).hexdigest()[:40]
+
+class CachedAudio:
+    __slots__ = ('data', 'mimetype')
+
+    def __init__(self, data, mimetype):
+        self.data = data
+        self.mimetype = mimetype
+
+class AudioCache:
+    """
+    In-memory LRU bounded by total bytes, optionally backed by a shared DiskCache;
+    entries above max_entry_bytes are not stored. admission, if given, estimates how
+    often a key is requested (estimate(key)) and guards what either tier may evict. peers,
+    if given, is a third tier on other replicas.
+    """
+
+    def __init__(self, max_bytes, max_entry_bytes, disk=None, admission=None, peers=None):
+        self.max_bytes = max_bytes
+        self.max_entry_bytes = max_entry_bytes
+        # Disabling the cache (max_bytes=0) disables both tiers
+        self.disk = disk if max_bytes > 0 and disk is not None and disk.enabled else None
+        self.admission = admission
+        self.peers = peers if max_bytes > 0 else None
+        self._entries = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self):
+        return self.max_bytes > 0
+
+    def contains(self, key):
+        """Whether key is in the in-memory tier (without counting a lookup)."""
+        with self._lock:
+            return key in self._entries
+
+    def get(self, key, local=False):
+        """The stored audio for key, or None; local skips the peer tier (for lookups from a peer)."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+        if entry is not None:
+            metrics.AUDIO_CACHE_LOOKUPS.inc(result='hit')
+            return entry
+        stored = self.disk.get(key) if self.disk is not None else None
+        if stored is not None:
+            metrics.AUDIO_CACHE_LOOKUPS.inc(result='disk_hit')
+            self._remember(key, *stored)
+            return CachedAudio(*stored)
+        stored = self.peers.get(key) if self.peers is not None and not local else None
+        if stored is None:
+            metrics.AUDIO_CACHE_LOOKUPS.inc(result='miss')
+            return None
+        metrics.AUDIO_CACHE_LOOKUPS.inc(result='peer_hit')
+        self._remember(key, *stored)
+        if self.disk is not None:
+            self._store_on_disk(key, *stored)
+        return CachedAudio(*stored)
+
+    def put(self, key, data, mimetype, share=True):
+        """Stores audio in every local tier and, unless share is false, on the replica owning key."""
+        if not self.enabled or len(data) > self.max_entry_bytes:
+            return
+        self._remember(key, data, mimetype)
+        if self.disk is not None:
+            self._store_on_disk(key, data, mimetype)
+        if share and self.peers is not None:
+            self.peers.put(key, data, mimetype)
+
+    def _remember(self, key, data, mimetype):
+        """Stores an entry in the in-memory tier only."""
+        size = len(data)
+        if size > self.max_entry_bytes or size > self.max_bytes:
+            return
+        with self._lock:
+            previous = self._entries.pop(key, None)
+            if previous is not None:
+                self._size -= len(previous.data)
+            if not self._admit(key, size):
+                if previous is not None:
+                    self._entries[key] = previous
+                    self._size += len(previous.data)
+                metrics.AUDIO_CACHE_REJECTED.inc(tier='memory')
+                return
+            self._entries[key] = CachedAudio(data, mimetype)
+            self._size += size
+            while self._size > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self._size -= len(evicted.data)
+            metrics.AUDIO_CACHE_BYTES.set(self._size)
+
+    def _admit(self, key, size):
+        """Whether a new entry may evict what it needs to; call with self._lock held."""
+        needed = self._size + size - self.max_bytes
+        if self.admission is None or needed <= 0:
+            return True
+        frequency = self.admission.estimate(key)
+        for victim_key, victim in self._entries.items():  # least recently used first
+            if self.admission.estimate(victim_key) >= frequency:
+                return False
+            needed -= len(victim.data)
+            if needed <= 0:
+                return True
+        return True
+
+    def _store_on_disk(self, key, data, mimetype):
+        """Stores an entry in the disk tier, under the same admission rule as the in-memory one."""
+        if self.admission is None:
+            self.disk.put(key, data, mimetype)
+            return
+        frequency = self.admission.estimate(key)
+
+        def admit(victims):
+            if all(self.admission.estimate(victim) < frequency for victim in victims):
+                return True
+            metrics.AUDIO_CACHE_REJECTED.inc(tier='disk')
+            return False
+
+        self.disk.put(key, data, mimetype, admit=admit)
+
+    def stats(self):
+        with self._lock:
+            stats = {"entries": len(self._entries), "bytes": self._size, "max_bytes": self.max_bytes}
+        if self.disk is not None:
+            stats["disk"] = self.disk.stats()
+        if self.peers is not None:
+            stats["peers"] = self.peers.snapshot()
+        return stats
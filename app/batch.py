@@ -0,0 +1,143 @@
+# batch.py
+
+"""
+Batch synthesis helpers.
+
+run_batch() executes many speech items with bounded parallelism and yields
+each result as soon as it completes; ndjson_stream() and zip_stream() encode
+those results incrementally so the first audio reaches the client while the
+rest of the batch is still being synthesized.
+"""
+
+import base64
+import json
+import re
+import time
+import zipfile
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from utils import AUDIO_FORMAT_MIME_TYPES
+
+# Audio format by mimetype, to name what a backend actually produced (nano always makes mp3)
+FORMAT_EXTENSIONS = {mimetype: extension for extension, mimetype in AUDIO_FORMAT_MIME_TYPES.items()}
+
+class BatchResult:
+    def __init__(self, index, item, status_code, audio=None, mimetype=None, error=None, duration=0.0):
+        self.index = index
+        self.item = item
+        self.status_code = status_code
+        self.audio = audio
+        self.mimetype = mimetype
+        self.error = error
+        self.duration = duration
+
+    @property
+    def ok(self):
+        return self.error is None
+
+    @property
+    def audio_format(self):
+        """The format of the produced audio, from its mimetype; never taken from the item."""
+        return FORMAT_EXTENSIONS.get(self.mimetype, 'bin')
+
+    def describe(self):
+        """Result metadata without the audio, as reported in NDJSON lines and the zip manifest."""
+        entry = {
+            "index": self.index,
+            "status": "ok" if self.ok else "error",
+            "status_code": self.status_code,
+            "voice": self.item.get('voice') or self.item.get('model'),
+            "response_format": self.item.get('response_format', 'mp3'),
+            "duration_ms": round(self.duration * 1000.0, 1),
+        }
+        if 'id' in self.item:
+            entry["id"] = self.item['id']
+        if self.ok:
+            entry["response_format"] = self.audio_format
+            entry["bytes"] = len(self.audio)
+        else:
+            entry["error"] = self.error
+        return entry
+
+def run_batch(items, synthesize, max_parallel):
+    """Runs synthesize(index, item) -> BatchResult over items, yielding results in completion order.
+
+    Items not yet started are cancelled when the consumer stops early (e.g. the client disconnects).
+    """
+    executor = ThreadPoolExecutor(max_workers=max_parallel, thread_name_prefix='batch')
+    try:
+        futures = {executor.submit(_timed, synthesize, index, item): index for index, item in enumerate(items)}
+        for future in as_completed(futures):
+            yield future.result()
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
+
+def _timed(synthesize, index, item):
+    start = time.perf_counter()
+    try:
+        result = synthesize(index, item)
+    except Exception as e:
+        result = BatchResult(index, item, 500, error=str(e))
+    result.duration = time.perf_counter() - start
+    return result
+
+def ndjson_stream(results):
+    """One JSON line per completed item (audio base64-encoded), then a summary line."""
+    succeeded = failed = 0
+    for result in results:
+        entry = {"type": "item", **result.describe()}
+        if result.ok:
+            succeeded += 1
+            entry["audio"] = base64.b64encode(result.audio).decode('utf-8')
+        else:
+            failed += 1
+        yield json.dumps(entry, ensure_ascii=False) + '\n'
+    yield json.dumps({"type": "summary", "succeeded": succeeded, "failed": failed}) + '\n'
+
+class _ChunkSink:
+    """Write-only, unseekable file object: zipfile then streams entries with data descriptors."""
+
+    def __init__(self):
+        self._chunks = []
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        data = b''.join(self._chunks)
+        self._chunks = []
+        return data
+
+def _entry_name(result):
+    """Archive name for an item: its id when safe, otherwise its position in the batch."""
+    extension = result.audio_format
+    name = str(result.item.get('id', f"{result.index:04d}"))
+    name = re.sub(r'[^\w.-]', '_', name).strip('.') or f"{result.index:04d}"
+    return f"{name}.{extension}"
+
+def zip_stream(results):
+    """A zip archive written entry by entry as items complete, ending with manifest.json."""
+    sink = _ChunkSink()
+    manifest = []
+    used_names = set()
+    with zipfile.ZipFile(sink, 'w', compression=zipfile.ZIP_STORED) as archive:
+        for result in results:
+            entry = result.describe()
+            if result.ok:
+                name = _entry_name(result)
+                if name in used_names:
+                    name = f"{result.index:04d}-{name}"
+                used_names.add(name)
+                entry["file"] = name
+                archive.writestr(name, result.audio)
+            manifest.append(entry)
+            data = sink.drain()
+            if data:
+                yield data
+        manifest.sort(key=lambda entry: entry["index"])
+        archive.writestr('manifest.json', json.dumps(manifest, ensure_ascii=False, indent=2))
+    yield sink.drain()
@@ -0,0 +1,100 @@
+# breaker.py
+
+"""
+Circuit breakers for the upstream synthesis services.
+
+After FAILURE_THRESHOLD consecutive failed calls a breaker opens and requests
+skip that upstream for COOLDOWN seconds instead of waiting on it to fail
+again. After the cooldown one probe request is let through (half-open); its
+success closes the breaker, its failure opens it for another cooldown.
+"""
+
+import os
+import threading
+import time
+
+from config import DEFAULT_CONFIGS
+import metrics
+from logs import get_logger
+
+log = get_logger('breaker')
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+_STATE_VALUES = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}
+
+FAILURE_THRESHOLD = int(os.getenv('BREAKER_FAILURE_THRESHOLD', str(DEFAULT_CONFIGS["BREAKER_FAILURE_THRESHOLD"])))
+COOLDOWN = float(os.getenv('BREAKER_COOLDOWN', str(DEFAULT_CONFIGS["BREAKER_COOLDOWN"])))
+
+class CircuitBreaker:
+    def __init__(self, name, failure_threshold=FAILURE_THRESHOLD, cooldown=COOLDOWN):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self._state = CLOSED
+        self._failures = 0
+        self._opened_at = 0.0
+        self._probe_started = 0.0
+        self._lock = threading.Lock()
+        metrics.CIRCUIT_STATE.set(0, upstream=name)
+
+    def allow(self):
+        """Whether a call to the upstream should be attempted now."""
+        with self._lock:
+            now = time.monotonic()
+            if self._state == CLOSED:
+                return True
+            if self._state == OPEN:
+                if now - self._opened_at < self.cooldown:
+                    return False
+                self._set_state(HALF_OPEN)
+                self._probe_started = now
+                return True
+            # Half-open: one probe at a time; a probe that never reported back expires after a cooldown
+            if now - self._probe_started >= self.cooldown:
+                self._probe_started = now
+                return True
+            return False
+
+    def record_success(self):
+        with self._lock:
+            self._failures = 0
+            if self._state != CLOSED:
+                log.info("Circuit breaker for %s closed", self.name)
+                self._set_state(CLOSED)
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            if self._state == HALF_OPEN or (self._state == CLOSED and self._failures >= self.failure_threshold):
+                log.warning("Circuit breaker for %s opened after %d consecutive failures", self.name, self._failures)
+                self._opened_at = time.monotonic()
+                self._set_state(OPEN)
+
+    def retry_after(self):
+        """Seconds until the breaker lets a probe through (0 when closed)."""
+        with self._lock:
+            if self._state == CLOSED:
+                return 0
+            return max(1, int(self.cooldown - (time.monotonic() - self._opened_at)) + 1)
+
+    def snapshot(self):
+        with self._lock:
+            return {"state": self._state, "consecutive_failures": self._failures}
+
+    def _set_state(self, state):
+        self._state = state
+        metrics.CIRCUIT_STATE.set(_STATE_VALUES[state], upstream=self.name)
+
+BREAKERS = {
+    'nano': CircuitBreaker('nano'),
+    'edge': CircuitBreaker('edge'),
+}
+
+def get_breaker(upstream):
+    return BREAKERS[upstream]
+
+def snapshot():
+    return {name: breaker.snapshot() for name, breaker in BREAKERS.items()}
@@ -11,6 +11,106 @@ DEFAULT_CONFIGS = {
     "DEFAULT_SPEED": 1.0,
     "DEFAULT_LANGUAGE": 'en-US',
 
+    # Admission control (0 concurrency disables the limit for that backend)
+    "NANO_MAX_CONCURRENCY": 8,
+    "EDGE_MAX_CONCURRENCY": 16,
+    "ADMISSION_QUEUE_SIZE": 32,
+    "ADMISSION_MAX_WAIT": 10.0,
+
+    # Batch synthesis
+    "BATCH_MAX_ITEMS": 1000,
+    "BATCH_MAX_PARALLEL": 4,
+
+    # SSML documents (Azure endpoint): segments synthesized at once per request
+    "SSML_MAX_PARALLEL": 4,
+
+    # Asynchronous jobs
+    "JOBS_DIR": 'data/jobs',
+    "JOB_WORKERS": 2,
+    "JOB_MAX_ATTEMPTS": 3,
+
+    # Cold start budget for the startup timing report
+    "STARTUP_BUDGET_MS": 1500,
+
+    # Upstream circuit breakers: consecutive failures before opening, seconds before a probe
+    "BREAKER_FAILURE_THRESHOLD": 5,
+    "BREAKER_COOLDOWN": 30.0,
+
+    # Request deadlines (seconds) for buffered and streamed speech; clients may shorten them
+    "REQUEST_TIMEOUT": 60.0,
+    "STREAM_REQUEST_TIMEOUT": 300.0,
+    # Timeout cap (seconds) for a single upstream call
+    "UPSTREAM_TIMEOUT": 30,
+
+    # Sentence-level retries: attempts per sentence, backoff (seconds), retry time budget per request
+    "SENTENCE_MAX_ATTEMPTS": 3,
+    "SENTENCE_RETRY_BASE_DELAY": 0.2,
+    "SENTENCE_RETRY_MAX_DELAY": 2.0,
+    "REQUEST_RETRY_BUDGET": 10.0,
+    # Edge voice for sentences nano-tts cannot synthesize; per-voice overrides as "nano=edge,..."
+    "NANO_FALLBACK_VOICE": 'zh-CN-XiaoxiaoNeural',
+    "NANO_FALLBACK_VOICES": '',
+
+    # Upstream call scheduling: concurrent calls per upstream (0 disables scheduling), and the
+    # buffered text length from which a request is bulk work rather than interactive
+    "NANO_UPSTREAM_CONCURRENCY": 8,
+    "EDGE_UPSTREAM_CONCURRENCY": 16,
+    "SCHEDULER_BULK_CHARS": 2000,
+
+    # OpenAI voice aliases: "static" (first available voice) or "latency" (fastest backend), extra
+    # routes as "alias=voice|voice,...", seconds between background latency probes (0 disables them)
+    "VOICE_ROUTING": 'static',
+    "VOICE_ROUTES": '',
+    "ROUTING_PROBE_INTERVAL": 30.0,
+
+    # Pooled edge-tts websocket sessions (0 disables pooling): idle sessions kept, seconds idle/total before retiring
+    "EDGE_WS_POOL_SIZE": 4,
+    "EDGE_WS_MAX_IDLE": 60.0,
+    "EDGE_WS_MAX_AGE": 300.0,
+    "EDGE_WS_HEARTBEAT": 20.0,
+
+    # Synthesized audio cache (0 disables it)
+    "AUDIO_CACHE_MAX_BYTES": 64 * 1024 * 1024,
+    "AUDIO_CACHE_MAX_ENTRY_BYTES": 8 * 1024 * 1024,
+
+    # Request popularity (cache admission and pre-warming): saved hot set, hot phrases pre-synthesized
+    # per voice (0 disables pre-warming), seconds between pre-warming rounds
+    "POPULARITY_FILE": 'data/popularity.json',
+    "PREWARM_TOP_N": 20,
+    "PREWARM_INTERVAL": 300.0,
+
+    # Shared on-disk tier behind the audio cache, also holding the edge voice list (0 disables it)
+    "DISK_CACHE_DIR": 'data/cache',
+    "DISK_CACHE_MAX_BYTES": 256 * 1024 * 1024,
+    "VOICE_LIST_TTL": 2 * 60 * 60,
+
+    # Audio cache shared between replicas: comma-separated base URLs of every replica (empty disables it),
+    # this replica's own URL among them, per-request timeout, seconds a failed replica is skipped,
+    # hash ring points per replica
+    "PEER_URLS": '',
+    "PEER_SELF": '',
+    "PEER_TIMEOUT": 0.5,
+    "PEER_RETRY_AFTER": 30.0,
+    "PEER_VNODES": 64,
+
+    # Scratch directory for synthesized audio files: total size quota and age after which the janitor removes them
+    "SCRATCH_DIR": 'data/scratch',
+    "SCRATCH_MAX_BYTES": 1024 * 1024 * 1024,
+    "SCRATCH_MAX_AGE": 600.0,
+
+    # Pre-fork launcher (prefork.py): workers (0 = one per CPU) and worker recycling limits (0 disables each)
+    "PREFORK_WORKERS": 0,
+    "PREFORK_MAX_REQUESTS": 5000,
+    "PREFORK_MAX_RSS_MB": 512,
+    "PREFORK_GRACEFUL_TIMEOUT": 30.0,
+
+    # Logging: level (DEBUG adds per-sentence detail), "text" or "json" lines, fraction of requests whose
+    # INFO/DEBUG records are kept (warnings and errors always are), records buffered before dropping
+    "LOG_LEVEL": 'INFO',
+    "LOG_FORMAT": 'text',
+    "LOG_SAMPLE_RATE": 1.0,
+    "LOG_QUEUE_SIZE": 10000,
+
     # Feature flags
     "REQUIRE_API_KEY": True,
     "REMOVE_FILTER": False,
@@ -0,0 +1,93 @@
+# deadline.py
+
+"""
+Per-request deadlines.
+
+A request's deadline starts when it arrives, from the client's
+X-Request-Timeout header (seconds) or the route's server default, whichever
+is shorter. It is kept on flask.g and every upstream call takes the time
+remaining as its timeout, so a request whose client has given up stops
+synthesizing instead of running every remaining sentence.
+"""
+
+import math
+import os
+import time
+
+from flask import g, has_request_context, request
+
+from config import DEFAULT_CONFIGS
+
+REQUEST_TIMEOUT = float(os.getenv('REQUEST_TIMEOUT', str(DEFAULT_CONFIGS["REQUEST_TIMEOUT"])))
+STREAM_REQUEST_TIMEOUT = float(os.getenv('STREAM_REQUEST_TIMEOUT', str(DEFAULT_CONFIGS["STREAM_REQUEST_TIMEOUT"])))
+# Cap for any single upstream call, so one hung call cannot use a whole long deadline
+UPSTREAM_TIMEOUT = float(os.getenv('UPSTREAM_TIMEOUT', str(DEFAULT_CONFIGS["UPSTREAM_TIMEOUT"])))
+
+TIMEOUT_HEADER = 'X-Request-Timeout'
+
+# A timeout firing this close to the deadline is the deadline passing, not the upstream being slow
+SLACK = 0.05
+
+class DeadlineExceeded(Exception):
+    pass
+
+class Deadline:
+    """A point in time after which the request's work is abandoned; seconds=None never expires."""
+
+    def __init__(self, seconds=None):
+        self.seconds = seconds
+        self.expires_at = math.inf if seconds is None else time.monotonic() + seconds
+
+    def remaining(self):
+        return max(0.0, self.expires_at - time.monotonic())
+
+    def expired(self):
+        return time.monotonic() >= self.expires_at
+
+    def reached(self):
+        """Whether the deadline has passed or is within SLACK of passing."""
+        return self.remaining() <= SLACK
+
+    def exceeded(self):
+        return DeadlineExceeded(f"request deadline of {self.seconds:g}s exceeded")
+
+    def check(self):
+        if self.expired():
+            raise self.exceeded()
+
+    def timeout(self, cap=None):
+        """
+        Timeout for the next upstream call: the time remaining, at most cap (None when
+        there is neither a deadline nor a cap). Raises once the deadline has passed.
+        """
+        self.check()
+        if self.expires_at == math.inf:
+            return cap
+        remaining = self.remaining()
+        return remaining if cap is None else min(remaining, cap)
+
+def route_timeout(stream):
+    """Server default deadline for a speech route."""
+    return STREAM_REQUEST_TIMEOUT if stream else REQUEST_TIMEOUT
+
+def _requested_timeout(default):
+    value = request.headers.get(TIMEOUT_HEADER)
+    try:
+        seconds = float(value) if value else None
+    except ValueError:
+        seconds = None
+    if seconds is None or not seconds > 0:
+        return default
+    return min(seconds, default)
+
+def current_deadline(default=None):
+    """
+    The deadline of the current request, started on first use from the header and
+    default (REQUEST_TIMEOUT if not given). Outside a request there is no deadline.
+    """
+    if not has_request_context():
+        return Deadline()
+    deadline = g.get('deadline')
+    if deadline is None:
+        deadline = g.deadline = Deadline(_requested_timeout(REQUEST_TIMEOUT if default is None else default))
+    return deadline
@@ -0,0 +1,184 @@
+# disk_cache.py
+
+"""
+Shared on-disk cache.
+
+A second cache tier behind the in-memory audio cache, shared by every process
+using the same directory (the pre-fork workers, or successive restarts).
+Values are files written then renamed into place, so a reader never sees a
+partial file; the index (size, last access, expiry) is a SQLite database in
+WAL mode, which serializes writers across processes. Total size is bounded
+by evicting the least recently used entries; a put may be given an admission
+check that sees what it would evict and can decline.
+
+SQLite connections must not cross a fork, so each process opens its own on
+first use.
+"""
+
+import os
+import sqlite3
+import threading
+import time
+
+from config import DEFAULT_CONFIGS
+from logs import get_logger
+
+log = get_logger('disk.cache')
+
+DISK_CACHE_DIR = os.getenv('DISK_CACHE_DIR', DEFAULT_CONFIGS["DISK_CACHE_DIR"])
+DISK_CACHE_MAX_BYTES = int(os.getenv('DISK_CACHE_MAX_BYTES', str(DEFAULT_CONFIGS["DISK_CACHE_MAX_BYTES"])))
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS entries (
+    key TEXT PRIMARY KEY,
+    mimetype TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    accessed_at REAL NOT NULL,
+    expires_at REAL
+);
+CREATE INDEX IF NOT EXISTS entries_accessed ON entries (accessed_at);
+"""
+
+# How long a process waits on another process's write lock before giving up on the operation
+BUSY_TIMEOUT = 5.0
+
+class DiskCache:
+    """Bytes by key, bounded by total size; keys must be safe as file names."""
+
+    def __init__(self, directory, max_bytes, max_entry_bytes=None):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.max_entry_bytes = max_entry_bytes or max_bytes
+        self._conn = None
+        self._pid = None
+        self._lock = threading.Lock()
+        if self.enabled:
+            os.makedirs(directory, exist_ok=True)
+
+    @property
+    def enabled(self):
+        return self.max_bytes > 0
+
+    def _db(self):
+        """This process's connection to the index; call with self._lock held."""
+        if self._pid != os.getpid():
+            self._conn = sqlite3.connect(os.path.join(self.directory, 'index.db'),
+                                         timeout=BUSY_TIMEOUT, check_same_thread=False)
+            self._pid = os.getpid()
+            with self._conn:
+                self._conn.execute('PRAGMA journal_mode=WAL')
+                self._conn.executescript(SCHEMA)
+        return self._conn
+
+    def path(self, key):
+        return os.path.join(self.directory, key[:2], key)
+
+    def get(self, key):
+        """Returns (data, mimetype), or None if the key is missing, expired or unreadable."""
+        if not self.enabled:
+            return None
+        now = time.time()
+        try:
+            with self._lock:
+                db = self._db()
+                row = db.execute("SELECT mimetype, expires_at FROM entries WHERE key = ?", (key,)).fetchone()
+                if row is None:
+                    return None
+                mimetype, expires_at = row
+                if expires_at is not None and expires_at <= now:
+                    return None
+                with db:
+                    db.execute("UPDATE entries SET accessed_at = ? WHERE key = ?", (now, key))
+            with open(self.path(key), 'rb') as f:
+                return f.read(), mimetype
+        except (OSError, sqlite3.Error) as e:
+            # Evicted by another process between the lookup and the read, or the index is busy
+            log.warning("Disk cache read of %s failed: %s", key, e)
+            return None
+
+    def put(self, key, data, mimetype, ttl=None, admit=None):
+        """
+        Stores data under key. admit, if given, is called with the keys the entry would evict
+        (least recently used first) and declines the entry by returning false. Returns whether it was stored.
+        """
+        size = len(data)
+        if not self.enabled or size > self.max_entry_bytes:
+            return False
+        path = self.path(key)
+        # Unique per process and thread, so concurrent writers of one key do not share a temp file
+        part = f"{path}.{os.getpid()}.{threading.get_ident()}.part"
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(part, 'wb') as f:
+                f.write(data)
+            now = time.time()
+            with self._lock:
+                db = self._db()
+                with db:
+                    if admit is not None and not admit(self._victims(db, key, size)):
+                        os.unlink(part)
+                        return False
+                    os.replace(part, path)
+                    db.execute("INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?)",
+                               (key, mimetype, size, now, now + ttl if ttl else None))
+                    evicted = self._evict(db)
+            for old in evicted:
+                try:
+                    os.unlink(self.path(old))
+                except FileNotFoundError:
+                    pass
+            return True
+        except (OSError, sqlite3.Error) as e:
+            log.warning("Disk cache write of %s failed: %s", key, e)
+            try:
+                os.unlink(part)
+            except OSError:
+                pass
+            return False
+
+    def _victims(self, db, key, size):
+        """The keys storing size bytes under key would evict, least recently used first."""
+        total = db.execute("SELECT COALESCE(SUM(size), 0) FROM entries WHERE key != ?", (key,)).fetchone()[0]
+        needed = total + size - self.max_bytes
+        victims = []
+        if needed <= 0:
+            return victims
+        for victim, victim_size in db.execute(
+                "SELECT key, size FROM entries WHERE key != ? ORDER BY accessed_at", (key,)):
+            if needed <= 0:
+                break
+            victims.append(victim)
+            needed -= victim_size
+        return victims
+
+    def _evict(self, db):
+        """Drops least recently used entries until the cache fits; returns their keys."""
+        total = db.execute("SELECT COALESCE(SUM(size), 0) FROM entries").fetchone()[0]
+        evicted = []
+        if total <= self.max_bytes:
+            return evicted
+        for key, size in db.execute("SELECT key, size FROM entries ORDER BY accessed_at").fetchall():
+            if total <= self.max_bytes:
+                break
+            evicted.append(key)
+            total -= size
+        db.executemany("DELETE FROM entries WHERE key = ?", [(key,) for key in evicted])
+        return evicted
+
+    def stats(self):
+        if not self.enabled:
+            return {"entries": 0, "bytes": 0, "max_bytes": 0}
+        with self._lock:
+            entries, size = self._db().execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM entries").fetchone()
+        return {"entries": entries, "bytes": size, "max_bytes": self.max_bytes}
+
+_disk_cache = None
+_disk_cache_lock = threading.Lock()
+
+def get_disk_cache():
+    """The process-wide DiskCache configured by DISK_CACHE_DIR / DISK_CACHE_MAX_BYTES."""
+    global _disk_cache
+    with _disk_cache_lock:
+        if _disk_cache is None:
+            _disk_cache = DiskCache(DISK_CACHE_DIR, DISK_CACHE_MAX_BYTES)
+        return _disk_cache
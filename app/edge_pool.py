@@ -0,0 +1,307 @@
+# edge_pool.py
+
+"""
+Pooled websocket sessions for edge-tts.
+
+edge_tts.Communicate opens a new TLS websocket for every synthesis, sends
+speech.config, runs a single turn and closes the socket; for short utterances
+the connect and handshake take longer than the synthesis. The pool keeps warm
+sessions (connected, speech.config already sent) per output config and runs
+successive ssml turns over them, one turn per session at a time.
+
+Sessions idle for MAX_IDLE seconds are closed and every session is retired
+after MAX_AGE seconds. Websocket heartbeats catch sockets that died while
+idle. A turn that fails on a reused session before any audio arrived is run
+again on a fresh connection, so a socket the service dropped costs a
+reconnect rather than an error.
+
+All websocket I/O runs on one event loop in a daemon thread; request threads
+use the blocking stream() iterator or the submit() future.
+
+The pool speaks the edge-tts wire protocol through edge-tts internals (ssml
+framing, DRM tokens, its TLS context), which is why edge-tts is pinned to a
+minor version. The ones only used at connect time are resolved on import too,
+so an edge-tts without them fails here and tts_handler falls back to unpooled
+Communicate instead of failing the first synthesis.
+"""
+
+import asyncio
+import queue
+import threading
+import time
+from collections import deque
+from xml.sax.saxutils import escape
+
+import aiohttp
+from edge_tts import communicate
+from edge_tts.communicate import (
+    connect_id, date_to_string, get_headers_and_data, mkssml,
+    remove_incompatible_characters, split_text_by_byte_length, ssml_headers_plus_data,
+)
+from edge_tts.constants import SEC_MS_GEC_VERSION, WSS_HEADERS
+from edge_tts.data_classes import TTSConfig
+from edge_tts.drm import DRM
+from edge_tts.exceptions import NoAudioReceived, UnexpectedResponse, WebSocketError
+
+import metrics
+from logs import get_logger
+
+# Used at connect time; looked up now so a missing one fails the import
+_SSL_CTX = communicate._SSL_CTX
+generate_sec_ms_gec = DRM.generate_sec_ms_gec
+headers_with_muid = DRM.headers_with_muid
+handle_client_response_error = DRM.handle_client_response_error
+
+log = get_logger('edge.pool')
+
+OUTPUT_FORMAT = 'audio-24khz-48kbitrate-mono-mp3'
+
+# Reused sessions failing this many turns in a row (with no reused turn succeeding)
+# means the service is not keeping sockets open; pooling is then paused for MAX_AGE.
+REUSE_FAILURE_LIMIT = 3
+
+_RECONNECTABLE = (aiohttp.ClientError, WebSocketError, ConnectionError, asyncio.TimeoutError)
+
+_END = object()
+
+def _speech_config(output_format):
+    return (
+        f"X-Timestamp:{date_to_string()}\r\n"
+        "Content-Type:application/json; charset=utf-8\r\n"
+        "Path:speech.config\r\n\r\n"
+        '{"context":{"synthesis":{"audio":{"metadataoptions":{'
+        '"sentenceBoundaryEnabled":"true","wordBoundaryEnabled":"false"},'
+        f'"outputFormat":"{output_format}"'
+        "}}}}\r\n"
+    )
+
+class PooledSession:
+    """One websocket to the edge service; runs one ssml turn at a time."""
+
+    def __init__(self, websocket, output_format):
+        self.websocket = websocket
+        self.output_format = output_format
+        self.created = time.monotonic()
+        self.last_used = self.created
+        self.turns = 0
+
+    def usable(self, max_idle, max_age):
+        now = time.monotonic()
+        return (not self.websocket.closed
+                and self.websocket.exception() is None
+                and now - self.created < max_age
+                and now - self.last_used < max_idle)
+
+    async def run(self, ssml, on_chunk, receive_timeout):
+        """Sends one ssml turn and passes its audio to on_chunk. Returns the number of audio bytes."""
+        request_id = connect_id()
+        await self.websocket.send_str(ssml_headers_plus_data(request_id, date_to_string(), ssml))
+        expected_id = request_id.encode('utf-8')
+        received = 0
+        while True:
+            message = await self.websocket.receive(timeout=receive_timeout)
+            if message.type == aiohttp.WSMsgType.TEXT:
+                data = message.data.encode('utf-8')
+                headers, _ = get_headers_and_data(data, data.find(b"\r\n\r\n"))
+                if headers.get(b"X-RequestId", expected_id) != expected_id:
+                    continue  # left over from an earlier turn on this socket
+                if headers.get(b"Path") == b"turn.end":
+                    break
+            elif message.type == aiohttp.WSMsgType.BINARY:
+                if len(message.data) < 2:
+                    raise UnexpectedResponse("Binary message is missing the header length.")
+                headers, data = get_headers_and_data(message.data, int.from_bytes(message.data[:2], "big"))
+                if headers.get(b"X-RequestId", expected_id) != expected_id:
+                    continue
+                if headers.get(b"Path") != b"audio":
+                    raise UnexpectedResponse("Binary message is not audio.")
+                if data:
+                    received += len(data)
+                    on_chunk(data)
+            elif message.type in (aiohttp.WSMsgType.CLOSE, aiohttp.WSMsgType.CLOSING, aiohttp.WSMsgType.CLOSED):
+                raise WebSocketError(f"edge websocket closed mid-turn (code {self.websocket.close_code})")
+            elif message.type == aiohttp.WSMsgType.ERROR:
+                raise WebSocketError(message.data or "Unknown error")
+        self.turns += 1
+        self.last_used = time.monotonic()
+        return received
+
+    async def close(self):
+        try:
+            await self.websocket.close()
+        except Exception:
+            pass
+
+class EdgeSessionPool:
+    def __init__(self, size, max_idle=60.0, max_age=300.0, heartbeat=20.0,
+                 connect_timeout=10, receive_timeout=60):
+        self.size = size
+        self.max_idle = max_idle
+        self.max_age = max_age
+        self.heartbeat = heartbeat or None
+        self.connect_timeout = connect_timeout
+        self.receive_timeout = receive_timeout
+        self._idle = {}  # output format -> deque of PooledSession, most recently used last
+        self._client = None
+        self._reuse_failures = 0
+        self._reuse_paused_until = 0.0
+        self._loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self._run_loop, name='edge-ws-pool', daemon=True)
+        self._thread.start()
+
+    # --- Blocking API for request threads ---
+
+    def submit(self, text, voice, rate='+0%', pitch='+0Hz', volume='+0%'):
+        """Synthesizes text; returns a concurrent.futures.Future of the complete mp3 bytes."""
+        return asyncio.run_coroutine_threadsafe(self._collect(text, voice, rate, pitch, volume), self._loop)
+
+    def stream(self, text, voice, rate='+0%', pitch='+0Hz', volume='+0%', deadline=None):
+        """
+        Yields mp3 chunks as they arrive; closing the generator cancels the turn. With a
+        deadline, waiting for the next chunk past it raises DeadlineExceeded.
+        """
+        chunks = queue.Queue()
+        future = asyncio.run_coroutine_threadsafe(
+            self._synthesize(text, voice, rate, pitch, volume, chunks.put), self._loop)
+        future.add_done_callback(lambda _: chunks.put(_END))
+        try:
+            while True:
+                try:
+                    chunk = chunks.get(timeout=deadline.timeout() if deadline else None)
+                except queue.Empty:
+                    raise deadline.exceeded()
+                if chunk is _END:
+                    break
+                yield chunk
+            future.result()
+        finally:
+            future.cancel()
+
+    def stats(self):
+        return {
+            "idle_sessions": sum(len(sessions) for sessions in self._idle.values()),
+            "size": self.size,
+            "reuse_paused": time.monotonic() < self._reuse_paused_until,
+        }
+
+    # --- Event loop side ---
+
+    def _run_loop(self):
+        asyncio.set_event_loop(self._loop)
+        self._loop.create_task(self._reap())
+        self._loop.run_forever()
+
+    async def _collect(self, text, voice, rate, pitch, volume):
+        chunks = []
+        await self._synthesize(text, voice, rate, pitch, volume, chunks.append)
+        return b''.join(chunks)
+
+    async def _synthesize(self, text, voice, rate, pitch, volume, on_chunk):
+        config = TTSConfig(voice, rate, volume, pitch, "SentenceBoundary")
+        for part in split_text_by_byte_length(escape(remove_incompatible_characters(text)), 4096):
+            if not await self._turn(mkssml(config, part), on_chunk):
+                raise NoAudioReceived("No audio was received. Please verify that your parameters are correct.")
+
+    async def _turn(self, ssml, on_chunk):
+        session = await self._acquire(OUTPUT_FORMAT)
+        delivered = []
+        def forward(data):
+            delivered.append(len(data))
+            on_chunk(data)
+        while True:
+            reused = session.turns > 0
+            metrics.EDGE_WS_TURNS.inc(session='reused' if reused else 'new')
+            try:
+                received = await session.run(ssml, forward, self.receive_timeout)
+            except _RECONNECTABLE as e:
+                await session.close()
+                if not reused or delivered:
+                    raise
+                # The socket went stale while idle; nothing reached the caller yet, so start over
+                self._note_reuse(False)
+                log.warning("Pooled edge-tts session failed (%r); reconnecting", e)
+                session = await self._connect(OUTPUT_FORMAT, reason='reconnect')
+                continue
+            except BaseException:
+                # Cancelled or failed mid-turn: the socket may still carry this turn's audio
+                await session.close()
+                raise
+            if reused:
+                self._note_reuse(True)
+            self._release(session)
+            return received
+
+    async def _acquire(self, output_format):
+        sessions = self._idle.get(output_format)
+        while sessions:
+            session = sessions.pop()
+            if session.usable(self.max_idle, self.max_age):
+                self._update_idle_gauge()
+                return session
+            await session.close()
+        self._update_idle_gauge()
+        return await self._connect(output_format, reason='new')
+
+    def _release(self, session):
+        sessions = self._idle.setdefault(session.output_format, deque())
+        if (len(sessions) >= self.size or time.monotonic() < self._reuse_paused_until
+                or not session.usable(self.max_idle, self.max_age)):
+            self._loop.create_task(session.close())
+            return
+        sessions.append(session)
+        self._update_idle_gauge()
+
+    async def _connect(self, output_format, reason):
+        if self._client is None:
+            self._client = aiohttp.ClientSession(
+                trust_env=True,
+                timeout=aiohttp.ClientTimeout(total=None, sock_connect=self.connect_timeout))
+        for attempt in (1, 2):
+            try:
+                websocket = await self._client.ws_connect(
+                    # Read at connect time: tts_handler may point it at a local stand-in
+                    f"{communicate.WSS_URL}&ConnectionId={connect_id()}"
+                    f"&Sec-MS-GEC={generate_sec_ms_gec()}"
+                    f"&Sec-MS-GEC-Version={SEC_MS_GEC_VERSION}",
+                    compress=15,
+                    headers=headers_with_muid(WSS_HEADERS),
+                    ssl=_SSL_CTX,
+                    heartbeat=self.heartbeat,
+                )
+                break
+            except aiohttp.ClientResponseError as e:
+                # A 403 means the clock skew used for Sec-MS-GEC is off; edge-tts corrects it
+                if e.status != 403 or attempt == 2:
+                    raise
+                handle_client_response_error(e)
+        try:
+            await websocket.send_str(_speech_config(output_format))
+        except BaseException:
+            await websocket.close()
+            raise
+        metrics.EDGE_WS_CONNECTS.inc(reason=reason)
+        return PooledSession(websocket, output_format)
+
+    def _note_reuse(self, ok):
+        if ok:
+            self._reuse_failures = 0
+            return
+        self._reuse_failures += 1
+        if self._reuse_failures >= REUSE_FAILURE_LIMIT:
+            log.warning("Pooled edge-tts sessions failed %d reuses in a row; not keeping sessions for %.0fs",
+                        self._reuse_failures, self.max_age)
+            self._reuse_failures = 0
+            self._reuse_paused_until = time.monotonic() + self.max_age
+
+    async def _reap(self):
+        """Closes expired idle sessions so they do not hold sockets open."""
+        while True:
+            await asyncio.sleep(max(1.0, self.max_idle / 2))
+            for sessions in self._idle.values():
+                for session in [s for s in sessions if not s.usable(self.max_idle, self.max_age)]:
+                    sessions.remove(session)
+                    await session.close()
+            self._update_idle_gauge()
+
+    def _update_idle_gauge(self):
+        metrics.EDGE_WS_IDLE.set(sum(len(sessions) for sessions in self._idle.values()))
@@ -1,7 +1,12 @@
 # handle_text.py
 
 import re
-import emoji
+from functools import lru_cache
+
+def remove_emoji(text):
+    """Strips emoji; the emoji package is imported on first use to keep startup fast."""
+    import emoji
+    return emoji.replace_emoji(text, replace='')
 
 def prepare_tts_input_with_context(text: str) -> str:
     """
@@ -16,7 +21,7 @@ def prepare_tts_input_with_context(text: str) -> str:
     """
 
     # Remove emojis
-    text = emoji.replace_emoji(text, replace='')
+    text = remove_emoji(text)
 
     # Add context for headers
     def header_replacer(match):
@@ -63,6 +68,60 @@ def prepare_tts_input_with_context(text: str) -> str:
 
     return text
 
+@lru_cache(maxsize=256)
+def _compile_keywords(keywords):
+    """
+    Compiles a keyword tuple into a single alternation regex.
+
+    Returns (pattern, keywords) with empty keywords dropped. pattern is None
+    when the keywords can overlap each other (one contains another, or a
+    suffix of one is a prefix of another). In that case a single leftmost-match
+    pass could pick a different keyword than the sequential replace would, so
+    callers must fall back to replacing one keyword at a time.
+    """
+    keywords = tuple(k for k in keywords if k)
+    unique = tuple(dict.fromkeys(keywords))
+    if not unique:
+        return None, keywords
+
+    prefixes = {k[:i] for k in unique for i in range(1, len(k))}
+    for keyword in unique:
+        if any(keyword[i:] in prefixes for i in range(1, len(keyword))):
+            return None, keywords
+        if any(keyword != other and keyword in other for other in unique):
+            return None, keywords
+
+    ordered = sorted(unique, key=len, reverse=True)
+    return re.compile('|'.join(map(re.escape, ordered))), keywords
+
+@lru_cache(maxsize=256)
+def parse_keywords(keywords):
+    """Splits a comma-separated keyword string into a tuple of stripped, non-empty keywords."""
+    return tuple(k.strip() for k in keywords.split(',') if k.strip())
+
+def remove_keywords(text, keywords):
+    """
+    Removes every keyword from the text in one pass.
+
+    The result is identical to calling text.replace(keyword, '') for each
+    keyword in order. The compiled matcher is cached per distinct keyword
+    list. When removing a keyword joins its neighbours into a new match, the
+    sequential semantics differ from a single pass, so that (rare) case is
+    detected and handled by the sequential replace.
+    """
+    pattern, keywords = _compile_keywords(tuple(keywords))
+    if not keywords:
+        return text
+
+    if pattern is not None:
+        cleaned = pattern.sub('', text)
+        if pattern.search(cleaned) is None:
+            return cleaned
+
+    for keyword in keywords:
+        text = text.replace(keyword, '')
+    return text
+
 def clean_text(text, options):
     """
     Cleans the text based on the provided options.
@@ -95,12 +154,11 @@ def clean_text(text, options):
     # Stage 2: Custom content removal
     custom_keywords = options.get('custom_keywords', [])
     if custom_keywords:
-        for keyword in custom_keywords:
-            cleaned_text = cleaned_text.replace(keyword, '')
+        cleaned_text = remove_keywords(cleaned_text, custom_keywords)
 
     # Stage 3: Character removal
     if options.get('remove_emoji'):
-        cleaned_text = emoji.replace_emoji(cleaned_text, replace='')
+        cleaned_text = remove_emoji(cleaned_text)
 
     # Stage 4: Context-aware formatting cleaning
     if options.get('remove_citation_numbers'):
@@ -116,3 +174,31 @@ def clean_text(text, options):
 
     # Stage 6: Final cleanup
     return cleaned_text.strip()
+
+# Where a short first chunk may end, best first: the first sentence end, else the first clause
+# break, else the last space (for text without punctuation)
+_CHUNK_BREAKS = (
+    (re.compile(r'[。！？!?；;]|[.](?=\s)'), False),
+    (re.compile(r'[，,、：:]'), False),
+    (re.compile(r'\s'), True),
+)
+
+def split_first_chunk(text, max_chars, min_chars=4):
+    """
+    Splits off a short first chunk of at most max_chars characters, ending at a sentence or
+    clause break when there is one, so its audio can start before the rest is synthesized.
+    Returns (first, rest); rest is empty when the text is already short enough.
+    """
+    if len(text) <= max_chars:
+        return text, ''
+    head = text[:max_chars]
+    cut = max_chars
+    for pattern, take_last in _CHUNK_BREAKS:
+        ends = [match.end() for match in pattern.finditer(head) if match.end() >= min_chars]
+        if ends:
+            cut = ends[-1] if take_last else ends[0]
+            break
+    first, rest = text[:cut].strip(), text[cut:].strip()
+    if not first:
+        return text, ''
+    return first, rest
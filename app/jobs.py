@@ -0,0 +1,366 @@
+# jobs.py
+
+"""
+Asynchronous synthesis jobs for long documents.
+
+A job's text is split into chunks when it is submitted. Background workers
+synthesize the chunks in order, writing each chunk's audio to disk and
+marking it done in SQLite as soon as it finishes. A job interrupted by a
+crash or restart is picked up again on startup and continues from its first
+unfinished chunk; completed chunks are never synthesized twice. When every
+chunk is done the audio is concatenated (and converted if needed) into the
+job's result file.
+
+Several processes may share one store (the pre-fork workers): SQLite
+serializes their writes and a job is claimed by moving it from queued to
+running, so only one worker runs it. Each claim gets a fresh run ID, and a
+run stops as soon as the job's run ID is no longer its own: a job cancelled
+and quickly resumed is never run by its old and new workers at once, even if
+the old one is still inside a chunk when the new one starts.
+"""
+
+import os
+import queue
+import shutil
+import sqlite3
+import threading
+import time
+import uuid
+from logs import get_logger
+
+log = get_logger('jobs')
+
+# Job states
+QUEUED = 'queued'
+RUNNING = 'running'
+SUCCEEDED = 'succeeded'
+FAILED = 'failed'
+CANCELLED = 'cancelled'
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id TEXT PRIMARY KEY,
+    status TEXT NOT NULL,
+    voice TEXT NOT NULL,
+    backend TEXT NOT NULL,
+    response_format TEXT NOT NULL,
+    speed REAL NOT NULL,
+    pitch INTEGER NOT NULL,
+    total_chunks INTEGER NOT NULL,
+    completed_chunks INTEGER NOT NULL DEFAULT 0,
+    error TEXT,
+    result_path TEXT,
+    run_id TEXT,
+    created_at REAL NOT NULL,
+    updated_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS chunks (
+    job_id TEXT NOT NULL,
+    idx INTEGER NOT NULL,
+    text TEXT NOT NULL,
+    done INTEGER NOT NULL DEFAULT 0,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    error TEXT,
+    PRIMARY KEY (job_id, idx)
+);
+"""
+
+class JobCancelled(Exception):
+    pass
+
+class JobStore:
+    """SQLite-backed job and chunk state; chunk audio lives in one directory per job."""
+
+    def __init__(self, directory):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        self._connection = None
+        self._pid = None
+        self._lock = threading.Lock()
+        with self._lock, self._conn:
+            self._conn.execute('PRAGMA journal_mode=WAL')
+            self._conn.executescript(SCHEMA)
+            columns = {row['name'] for row in self._conn.execute("PRAGMA table_info(jobs)")}
+            if 'run_id' not in columns:  # stores created before run IDs
+                self._conn.execute("ALTER TABLE jobs ADD COLUMN run_id TEXT")
+
+    @property
+    def _conn(self):
+        """This process's connection; a SQLite connection must not be used across a fork."""
+        if self._pid != os.getpid():
+            self._connection = sqlite3.connect(os.path.join(self.directory, 'jobs.db'), check_same_thread=False)
+            self._connection.row_factory = sqlite3.Row
+            self._pid = os.getpid()
+        return self._connection
+
+    def job_dir(self, job_id):
+        return os.path.join(self.directory, job_id)
+
+    def chunk_path(self, job_id, index):
+        return os.path.join(self.job_dir(job_id), f"{index:05d}.mp3")
+
+    def create(self, voice, backend, response_format, speed, pitch, chunks):
+        job_id = uuid.uuid4().hex
+        now = time.time()
+        os.makedirs(self.job_dir(job_id), exist_ok=True)
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT INTO jobs (id, status, voice, backend, response_format, speed, pitch, total_chunks,"
+                " created_at, updated_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (job_id, QUEUED, voice, backend, response_format, speed, pitch, len(chunks), now, now))
+            self._conn.executemany(
+                "INSERT INTO chunks (job_id, idx, text) VALUES (?, ?, ?)",
+                [(job_id, index, text) for index, text in enumerate(chunks)])
+        return job_id
+
+    def get(self, job_id):
+        with self._lock:
+            row = self._conn.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return dict(row) if row else None
+
+    def pending_chunks(self, job_id):
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT idx, text, attempts FROM chunks WHERE job_id = ? AND done = 0 ORDER BY idx",
+                (job_id,)).fetchall()
+        return [dict(row) for row in rows]
+
+    def failed_chunk(self, job_id):
+        """The chunk whose error failed the job, if any."""
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT idx, attempts, error FROM chunks WHERE job_id = ? AND done = 0 AND error IS NOT NULL"
+                " ORDER BY idx LIMIT 1", (job_id,)).fetchone()
+        return dict(row) if row else None
+
+    def set_status(self, job_id, status, error=None, result_path=None, only_if=None, run_id=None):
+        """
+        Updates a job's status; with only_if, only when its current status is one of those,
+        and with run_id, only while that run owns it. Returns success.
+        """
+        query = "UPDATE jobs SET status = ?, error = ?, result_path = COALESCE(?, result_path), updated_at = ? WHERE id = ?"
+        params = [status, error, result_path, time.time(), job_id]
+        if only_if:
+            query += f" AND status IN ({', '.join('?' * len(only_if))})"
+            params.extend(only_if)
+        if run_id:
+            query += " AND run_id = ?"
+            params.append(run_id)
+        with self._lock, self._conn:
+            return self._conn.execute(query, params).rowcount > 0
+
+    def claim(self, job_id, run_id):
+        """Moves a queued job to running under run_id; False if it is not queued (claimed, cancelled or deleted)."""
+        with self._lock, self._conn:
+            return self._conn.execute(
+                "UPDATE jobs SET status = ?, run_id = ?, updated_at = ? WHERE id = ? AND status = ?",
+                (RUNNING, run_id, time.time(), job_id, QUEUED)).rowcount > 0
+
+    def chunk_done(self, job_id, index, run_id):
+        """Marks a chunk done if run_id still owns the job and it is not done yet; returns whether it did."""
+        with self._lock, self._conn:
+            updated = self._conn.execute(
+                "UPDATE chunks SET done = 1, error = NULL WHERE job_id = ? AND idx = ? AND done = 0"
+                " AND EXISTS (SELECT 1 FROM jobs WHERE id = ? AND run_id = ?)",
+                (job_id, index, job_id, run_id)).rowcount > 0
+            if updated:
+                self._conn.execute(
+                    "UPDATE jobs SET completed_chunks = completed_chunks + 1, updated_at = ? WHERE id = ?",
+                    (time.time(), job_id))
+        return updated
+
+    def chunk_failed(self, job_id, index, attempts, error, run_id):
+        with self._lock, self._conn:
+            self._conn.execute(
+                "UPDATE chunks SET attempts = ?, error = ? WHERE job_id = ? AND idx = ?"
+                " AND EXISTS (SELECT 1 FROM jobs WHERE id = ? AND run_id = ?)",
+                (attempts, error, job_id, index, job_id, run_id))
+
+    def resumable(self):
+        """Jobs to (re)start at startup: queued ones, and running ones whose worker died."""
+        with self._lock, self._conn:
+            self._conn.execute("UPDATE jobs SET status = ? WHERE status = ?", (QUEUED, RUNNING))
+        return self.queued()
+
+    def queued(self):
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT id FROM jobs WHERE status = ? ORDER BY created_at", (QUEUED,)).fetchall()
+        return [row['id'] for row in rows]
+
+    def delete(self, job_id):
+        with self._lock, self._conn:
+            self._conn.execute("DELETE FROM chunks WHERE job_id = ?", (job_id,))
+            self._conn.execute("DELETE FROM jobs WHERE id = ?", (job_id,))
+        shutil.rmtree(self.job_dir(job_id), ignore_errors=True)
+
+class JobManager:
+    """
+    Worker pool over a JobStore.
+
+    synthesize(job, text) returns mp3 bytes for one chunk and raises on failure;
+    finalize(mp3_path, response_format) converts the concatenated mp3 and
+    returns the path of the result file. With a poll_interval, idle workers
+    also pick up jobs that other processes submitted to the store.
+    """
+
+    def __init__(self, store, synthesize, finalize, workers=2, max_attempts=3, retry_delay=1.0,
+                 poll_interval=None):
+        self.store = store
+        self.synthesize = synthesize
+        self.finalize = finalize
+        self.workers = workers
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self.poll_interval = poll_interval
+        self._queue = queue.Queue()
+        self._threads = []
+
+    def start(self):
+        for job_id in self.store.resumable():
+            self._queue.put(job_id)
+        for index in range(self.workers):
+            thread = threading.Thread(target=self._work, name=f'job-worker-{index}', daemon=True)
+            thread.start()
+            self._threads.append(thread)
+        return self
+
+    def submit(self, voice, backend, response_format, speed, pitch, chunks):
+        job_id = self.store.create(voice, backend, response_format, speed, pitch, chunks)
+        self._queue.put(job_id)
+        return job_id
+
+    def resume(self, job_id):
+        """Requeues a failed or cancelled job; its completed chunks are kept."""
+        if not self.store.set_status(job_id, QUEUED, only_if=(FAILED, CANCELLED)):
+            return False
+        self._queue.put(job_id)
+        return True
+
+    def cancel(self, job_id):
+        """Stops a queued or running job; a running one discards the chunk it is synthesizing."""
+        return self.store.set_status(job_id, CANCELLED, only_if=(QUEUED, RUNNING))
+
+    def describe(self, job_id):
+        job = self.store.get(job_id)
+        if job is None:
+            return None
+        total = job['total_chunks']
+        description = {
+            "id": job['id'],
+            "object": "audio.job",
+            "status": job['status'],
+            "voice": job['voice'],
+            "backend": job['backend'],
+            "response_format": job['response_format'],
+            "progress": {
+                "completed_chunks": job['completed_chunks'],
+                "total_chunks": total,
+                "percent": round(100.0 * job['completed_chunks'] / total, 1) if total else 100.0,
+            },
+            "created_at": int(job['created_at']),
+            "updated_at": int(job['updated_at']),
+        }
+        if job['error']:
+            description["error"] = job['error']
+            failed = self.store.failed_chunk(job_id)
+            if failed:
+                description["failed_chunk"] = failed
+        return description
+
+    def _work(self):
+        while True:
+            try:
+                job_id = self._queue.get(timeout=self.poll_interval)
+            except queue.Empty:
+                # Already-claimed jobs are skipped by _run, so listing one twice is harmless
+                for job_id in self.store.queued():
+                    self._queue.put(job_id)
+                continue
+            run_id = uuid.uuid4().hex
+            try:
+                self._run(job_id, run_id)
+            except JobCancelled:
+                log.info("Job %s cancelled", job_id)
+            except Exception as e:
+                log.error("Job %s failed: %s", job_id, e)
+                self.store.set_status(job_id, FAILED, error=str(e), only_if=(RUNNING,), run_id=run_id)
+            finally:
+                self._queue.task_done()
+
+    def _run(self, job_id, run_id):
+        if not self.store.claim(job_id, run_id):
+            return  # claimed elsewhere, cancelled or deleted while queued
+        job = self.store.get(job_id)
+        pending = self.store.pending_chunks(job_id)
+        log.info("Job %s: %d of %d chunks to synthesize", job_id, len(pending), job['total_chunks'])
+
+        for chunk in pending:
+            self._check_cancelled(job_id, run_id)
+            audio = self._synthesize_chunk(job, chunk, run_id)
+            self._check_cancelled(job_id, run_id)
+            path = self.store.chunk_path(job_id, chunk['idx'])
+            # Write then rename, so a chunk marked done always has complete audio on disk;
+            # the temporary name is per run, so a superseded run cannot interleave its writes
+            part = f"{path}.{run_id}.part"
+            with open(part, 'wb') as f:
+                f.write(audio)
+            os.replace(part, path)
+            if not self.store.chunk_done(job_id, chunk['idx'], run_id):
+                self._check_cancelled(job_id, run_id)
+
+        self._check_cancelled(job_id, run_id)
+        result_path = self._assemble(job, run_id)
+        log.info("Job %s finished: %s", job_id, result_path)
+
+    def _synthesize_chunk(self, job, chunk, run_id):
+        attempts = chunk['attempts']
+        while True:
+            attempts += 1
+            try:
+                audio = self.synthesize(job, chunk['text'])
+                if not audio:
+                    raise RuntimeError("upstream returned no audio")
+                return audio
+            except Exception as e:
+                self.store.chunk_failed(job['id'], chunk['idx'], attempts, str(e), run_id)
+                if attempts - chunk['attempts'] >= self.max_attempts:
+                    raise RuntimeError(f"chunk {chunk['idx']} failed after {attempts} attempts: {e}")
+                log.warning("Job %s: chunk %d attempt %d failed: %s", job['id'], chunk['idx'], attempts, e)
+                time.sleep(self.retry_delay * attempts)
+                self._check_cancelled(job['id'], run_id)
+
+    def _check_cancelled(self, job_id, run_id):
+        """Raises JobCancelled unless the job is still running as run_id (not cancelled, deleted or resumed since)."""
+        job = self.store.get(job_id)
+        if job is None or job['status'] != RUNNING or job['run_id'] != run_id:
+            raise JobCancelled(job_id)
+
+    def _assemble(self, job, run_id):
+        """
+        Concatenates the chunk mp3s (frame streams join cleanly), converts to the requested
+        format and marks the job succeeded; the chunks are removed only once it is.
+        """
+        job_dir = self.store.job_dir(job['id'])
+        combined = os.path.join(job_dir, f'combined.{run_id}.mp3')
+        with open(combined, 'wb') as out:
+            for index in range(job['total_chunks']):
+                with open(self.store.chunk_path(job['id'], index), 'rb') as f:
+                    shutil.copyfileobj(f, out)
+        result = self.finalize(combined, job['response_format'])
+        final = os.path.join(job_dir, 'result' + os.path.splitext(result)[1])
+        self._check_cancelled(job['id'], run_id)
+        shutil.move(result, final)  # the converted file may be on another filesystem
+        if result != combined:
+            try:
+                os.unlink(combined)
+            except OSError:
+                pass
+        if not self.store.set_status(job['id'], SUCCEEDED, result_path=final, only_if=(RUNNING,), run_id=run_id):
+            raise JobCancelled(job['id'])
+        for index in range(job['total_chunks']):
+            try:
+                os.unlink(self.store.chunk_path(job['id'], index))
+            except OSError:
+                pass
+        return final
@@ -0,0 +1,160 @@
+# logs.py
+
+"""
+Leveled, non-blocking logging for the service.
+
+Everything logs through get_logger(name) ("tts.<name>" loggers). Records are
+put on a bounded queue by the thread that logs them and written to stdout by
+a listener thread, so a slow or blocked stdout pipe never holds up a request;
+when the queue is full, records are dropped and counted
+(tts_log_dropped_total) instead. Messages are formatted on the listener
+thread, not the caller's.
+
+Each record carries the request's ID: the client's X-Request-Id header when
+it sends a usable one, otherwise a generated one, echoed in the response's
+X-Request-Id header. Records logged outside a request show "-".
+
+- LOG_LEVEL: DEBUG adds per-sentence detail, which INFO (the default) leaves out
+- LOG_FORMAT: "text" (one readable line) or "json" (one object per line, with
+  any extra= fields as keys)
+- LOG_SAMPLE_RATE: fraction of requests whose DEBUG and INFO records are kept,
+  decided once per request so a sampled request's lines stay together;
+  warnings and errors are always kept
+
+Request text is not logged, only its length.
+"""
+
+import atexit
+import json
+import logging
+import os
+import queue
+import random
+import re
+import sys
+import uuid
+from logging.handlers import QueueHandler, QueueListener
+
+from flask import g, has_request_context, request
+
+import metrics
+from config import DEFAULT_CONFIGS
+
+LOG_LEVEL = os.getenv('LOG_LEVEL', DEFAULT_CONFIGS["LOG_LEVEL"]).upper()
+LOG_FORMAT = os.getenv('LOG_FORMAT', DEFAULT_CONFIGS["LOG_FORMAT"]).lower()
+LOG_SAMPLE_RATE = float(os.getenv('LOG_SAMPLE_RATE', str(DEFAULT_CONFIGS["LOG_SAMPLE_RATE"])))
+LOG_QUEUE_SIZE = int(os.getenv('LOG_QUEUE_SIZE', str(DEFAULT_CONFIGS["LOG_QUEUE_SIZE"])))
+
+REQUEST_ID_HEADER = 'X-Request-Id'
+# A client's request ID is used as-is only if it is short and plain
+CLIENT_REQUEST_ID = re.compile(r'[\w.:-]{1,64}')
+TEXT_FORMAT = '%(asctime)s %(levelname)s %(name)s [%(request_id)s] %(message)s'
+
+# Attributes every LogRecord has; anything else on a record came from extra=
+_STANDARD_ATTRS = set(vars(logging.LogRecord('', 0, '', 0, '', None, None))) | {'message', 'asctime', 'request_id'}
+
+def request_id():
+    """This request's ID (assigned on first use), or None outside a request."""
+    if not has_request_context():
+        return None
+    rid = g.get('request_id')
+    if rid is None:
+        incoming = request.headers.get(REQUEST_ID_HEADER, '')
+        rid = g.request_id = incoming if CLIENT_REQUEST_ID.fullmatch(incoming) else uuid.uuid4().hex[:16]
+    return rid
+
+def _sampled():
+    sampled = g.get('log_sampled')
+    if sampled is None:
+        sampled = g.log_sampled = LOG_SAMPLE_RATE >= 1 or random.random() < LOG_SAMPLE_RATE
+    return sampled
+
+def _extra(record):
+    return {key: value for key, value in vars(record).items() if key not in _STANDARD_ATTRS}
+
+class RequestContextFilter(logging.Filter):
+    """
+    Tags records with the request ID and applies request sampling. Handler filters run on the
+    thread that logs, before the record is queued, which is what gives them the request context.
+    """
+
+    def filter(self, record):
+        if has_request_context():
+            if record.levelno < logging.WARNING and not _sampled():
+                return False
+            record.request_id = request_id()
+        elif not getattr(record, 'request_id', None):
+            record.request_id = '-'
+        return True
+
+class NonBlockingQueueHandler(QueueHandler):
+    """A QueueHandler that drops records rather than wait when the queue is full, and leaves formatting to the listener."""
+
+    def prepare(self, record):
+        # Only what cannot cross threads is resolved here: the arguments and the traceback
+        record = logging.makeLogRecord(vars(record))
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            metrics.LOG_DROPPED.inc()
+
+class TextFormatter(logging.Formatter):
+    """TEXT_FORMAT followed by any extra= fields as key=value."""
+
+    def format(self, record):
+        line = super().format(record)
+        extra = _extra(record)
+        if extra:
+            line += ' ' + ' '.join(f'{key}={value}' for key, value in extra.items())
+        return line
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            "time": self.formatTime(record),
+            "level": record.levelname,
+            "logger": record.name,
+            "request_id": record.request_id,
+            "message": record.getMessage(),
+            **_extra(record),
+        }
+        if record.exc_text:
+            entry["exc"] = record.exc_text
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+_handler = NonBlockingQueueHandler(queue.Queue(LOG_QUEUE_SIZE))
+_handler.addFilter(RequestContextFilter())
+_listener = None
+
+def _start_listener():
+    """Starts writing queued records; threads do not survive a fork, so each process starts its own."""
+    global _listener
+    _handler.queue = queue.Queue(LOG_QUEUE_SIZE)
+    output = logging.StreamHandler(sys.stdout)
+    output.setFormatter(JsonFormatter() if LOG_FORMAT == 'json' else TextFormatter(TEXT_FORMAT))
+    _listener = QueueListener(_handler.queue, output)
+    _listener.start()
+
+def flush():
+    """Writes out every queued record and stops the listener; at exit, and before os._exit (which skips atexit)."""
+    if _listener is not None:
+        _listener.stop()  # writes what is still queued
+
+_root = logging.getLogger('tts')
+_root.setLevel(LOG_LEVEL)
+_root.addHandler(_handler)
+_root.propagate = False
+_start_listener()
+os.register_at_fork(after_in_child=_start_listener)
+atexit.register(flush)
+
+def get_logger(name):
+    return logging.getLogger(f'tts.{name}')
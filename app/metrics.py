@@ -0,0 +1,230 @@
+# metrics.py
+
+"""
+Minimal Prometheus-style metrics registry.
+
+Counters, gauges and histograms are kept in process memory and rendered in the
+Prometheus text exposition format by render(). Only the standard library is
+used so the service does not pick up a new dependency.
+"""
+
+import bisect
+import threading
+import time
+from contextlib import contextmanager
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+_registry = []
+_registry_lock = threading.Lock()
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+def _format_labels(labelnames, labelvalues, extra=()):
+    pairs = list(zip(labelnames, labelvalues)) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in pairs) + '}'
+
+class _Metric:
+    kind = 'untyped'
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+        with _registry_lock:
+            _registry.append(self)
+
+    def _key(self, labels):
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f"{self.name} expects labels {self.labelnames}, got {tuple(labels)}")
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def _samples(self):
+        raise NotImplementedError
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        lines.extend(self._samples())
+        return '\n'.join(lines)
+
+class Counter(_Metric):
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def _samples(self):
+        with self._lock:
+            items = list(self._values.items())
+        return [f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}" for key, value in items]
+
+class Gauge(_Metric):
+    kind = 'gauge'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def _samples(self):
+        with self._lock:
+            items = list(self._values.items())
+        return [f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}" for key, value in items]
+
+class Histogram(_Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                state = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            state[0][index] += 1
+            state[1] += value
+            state[2] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        """Observes the duration of the with-block, including when it raises."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def _samples(self):
+        with self._lock:
+            items = [(key, (list(state[0]), state[1], state[2])) for key, state in self._values.items()]
+        lines = []
+        for key, (counts, total, count) in items:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += bucket_count
+                labels = _format_labels(self.labelnames, key, [('le', _format_value(bound))])
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            labels = _format_labels(self.labelnames, key)
+            lines.append(f"{self.name}_sum{labels} {_format_value(total)}")
+            lines.append(f"{self.name}_count{labels} {count}")
+        return lines
+
+def render():
+    """Renders every registered metric in the Prometheus text format."""
+    with _registry_lock:
+        metrics = list(_registry)
+    return '\n'.join(metric.render() for metric in metrics) + '\n'
+
+# --- Service metrics ---
+
+REQUESTS = Counter(
+    'tts_requests_total', 'Speech requests handled, by backend, voice, stream mode and HTTP status.',
+    ('backend', 'voice', 'stream', 'status'))
+REQUEST_LATENCY = Histogram(
+    'tts_request_duration_seconds', 'Time from request start until the last response byte.',
+    ('backend', 'voice', 'stream'))
+TIME_TO_FIRST_BYTE = Histogram(
+    'tts_time_to_first_byte_seconds', 'Time from request start until the first response byte.',
+    ('backend', 'voice', 'stream'))
+UPSTREAM_LATENCY = Histogram(
+    'tts_upstream_request_duration_seconds', 'Latency of calls to the upstream synthesis services.',
+    ('upstream',))
+UPSTREAM_ERRORS = Counter(
+    'tts_upstream_errors_total', 'Failed calls to the upstream synthesis services.',
+    ('upstream',))
+RETRIES = Counter(
+    'tts_retries_total', 'Retried synthesis attempts.',
+    ('backend',))
+FALLBACKS = Counter(
+    'tts_fallbacks_total', 'Requests that fell back to another backend.',
+    ('from_backend', 'to_backend'))
+FFMPEG_DURATION = Histogram(
+    'tts_ffmpeg_transcode_seconds', 'Time spent transcoding audio with ffmpeg.',
+    ('format',))
+INFLIGHT_STREAMS = Gauge(
+    'tts_inflight_streams', 'Streaming responses currently being sent.',
+    ('backend',))
+MODEL_CACHE_REFRESHES = Counter(
+    'tts_model_cache_refresh_total', 'Model list refreshes, by outcome.',
+    ('outcome',))
+CIRCUIT_STATE = Gauge(
+    'tts_circuit_breaker_state', 'Upstream circuit breaker state (0 closed, 1 half-open, 2 open).',
+    ('upstream',))
+ADMISSION_REJECTED = Counter(
+    'tts_admission_rejected_total', 'Speech requests shed with 429 by admission control, by reason.',
+    ('backend', 'reason'))
+ADMISSION_QUEUE_DEPTH = Gauge(
+    'tts_admission_queue_depth', 'Speech requests waiting for a synthesis slot.',
+    ('backend',))
+AUDIO_CACHE_LOOKUPS = Counter(
+    'tts_audio_cache_lookups_total', 'Audio cache lookups, by result.',
+    ('result',))
+AUDIO_CACHE_BYTES = Gauge(
+    'tts_audio_cache_bytes', 'Bytes of audio held in the cache.')
+DEADLINES_EXCEEDED = Counter(
+    'tts_deadline_exceeded_total', 'Speech requests abandoned because their deadline passed.',
+    ('backend',))
+EDGE_WS_CONNECTS = Counter(
+    'tts_edge_ws_connects_total', 'Websocket connections opened to the edge service, by reason.',
+    ('reason',))
+EDGE_WS_TURNS = Counter(
+    'tts_edge_ws_turns_total', 'Synthesis turns run over pooled edge websockets, on new or reused sessions.',
+    ('session',))
+EDGE_WS_IDLE = Gauge(
+    'tts_edge_ws_idle_sessions', 'Warm edge websocket sessions waiting in the pool.')
+CLIENT_DISCONNECTS = Counter(
+    'tts_client_disconnects_total', 'Streamed responses abandoned because the client disconnected.',
+    ('backend',))
+SCRATCH_BYTES = Gauge(
+    'tts_scratch_bytes', 'Bytes of audio files held in the scratch directory.')
+SCRATCH_SWEPT = Counter(
+    'tts_scratch_swept_total', 'Stale scratch files removed by the janitor.')
+ROUTE_CHOICES = Counter(
+    'tts_route_choices_total', 'OpenAI voice alias requests, by the backend the routing policy picked.',
+    ('alias', 'backend'))
+ROUTE_SCORE = Gauge(
+    'tts_route_score_seconds', 'Routing score per backend: moving average time to first byte, penalized for failures.',
+    ('backend',))
+SCHEDULER_QUEUE_DEPTH = Gauge(
+    'tts_scheduler_queue_depth', 'Upstream calls waiting for a slot, by priority class.',
+    ('backend', 'priority'))
+SCHEDULER_WAIT = Histogram(
+    'tts_scheduler_wait_seconds', 'Time upstream calls waited for a slot, by priority class.',
+    ('backend', 'priority'))
+AUDIO_CACHE_REJECTED = Counter(
+    'tts_audio_cache_rejected_total', 'Audio not cached because it is requested less often than what it would evict, by tier.',
+    ('tier',))
+PREWARMED = Counter(
+    'tts_prewarmed_total', 'Popular phrases synthesized ahead of requests by the pre-warmer.',
+    ('backend',))
+PEER_CACHE_REQUESTS = Counter(
+    'tts_peer_cache_requests_total', 'Requests to the replica owning a cache key, by operation and result.',
+    ('op', 'result'))
+LOG_DROPPED = Counter(
+    'tts_log_dropped_total', 'Log records dropped because the log queue was full.')
@@ -0,0 +1,202 @@
+# peer_cache.py
+
+"""
+Audio cache shared between replicas.
+
+With PEER_URLS listing every replica (base URLs, this one included as
+PEER_SELF), cache keys are sharded over the replicas by consistent hashing:
+each replica owns the keys that fall on its arcs of a hash ring of
+PEER_VNODES virtual nodes per replica, so adding or removing a replica only
+moves about 1/N of the keys.
+
+On a local miss the owning replica is asked for the audio
+(GET /v1/audio/speech/<key>) before synthesizing; audio synthesized for a
+key owned elsewhere is pushed to its owner in the background
+(PUT /v1/audio/speech/<key>), so the next replica to miss finds it there.
+Peer requests carry PEER_HEADER and are answered from the owner's own cache
+only, so they never cascade. Pushes are signed with the cache-key secret,
+which all replicas must share anyway for their keys to agree.
+
+A replica that fails or times out is skipped for PEER_RETRY_AFTER seconds;
+its keys fall to the next replica on the ring (or are handled locally), and
+it rejoins on its own once it answers again. A replica started later than
+its peers joins the same way.
+"""
+
+import bisect
+import hashlib
+import hmac
+import os
+import threading
+import time
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+import metrics
+from config import DEFAULT_CONFIGS
+from logs import get_logger
+
+log = get_logger('peer.cache')
+
+PEER_URLS = os.getenv('PEER_URLS', DEFAULT_CONFIGS["PEER_URLS"])
+PEER_SELF = os.getenv('PEER_SELF', DEFAULT_CONFIGS["PEER_SELF"])
+PEER_TIMEOUT = float(os.getenv('PEER_TIMEOUT', str(DEFAULT_CONFIGS["PEER_TIMEOUT"])))
+PEER_RETRY_AFTER = float(os.getenv('PEER_RETRY_AFTER', str(DEFAULT_CONFIGS["PEER_RETRY_AFTER"])))
+PEER_VNODES = int(os.getenv('PEER_VNODES', str(DEFAULT_CONFIGS["PEER_VNODES"])))
+
+# Marks a request from another replica: answer from the local cache only
+PEER_HEADER = 'X-Peer-Cache'
+SIGNATURE_HEADER = 'X-Peer-Signature'
+# Pushes waiting for a sender; beyond this they are dropped (the owner will synthesize on its own miss)
+MAX_PENDING_PUSHES = 64
+
+def _point(value):
+    return int.from_bytes(hashlib.blake2b(value.encode('utf-8'), digest_size=8).digest(), 'big')
+
+def parse_peers(value):
+    """Base URLs from a comma-separated list, without trailing slashes or duplicates."""
+    peers = []
+    for url in value.split(','):
+        url = url.strip().rstrip('/')
+        if url and url not in peers:
+            peers.append(url)
+    return peers
+
+class HashRing:
+    """Consistent hashing of keys onto nodes, with vnodes points per node."""
+
+    def __init__(self, nodes, vnodes=PEER_VNODES):
+        self.nodes = list(nodes)
+        points = sorted((_point(f"{node}#{index}"), node) for node in self.nodes for index in range(vnodes))
+        self._hashes = [point for point, _ in points]
+        self._owners = [node for _, node in points]
+
+    def owners(self, key):
+        """Every node in the order they own key: the owner first, then its successors on the ring."""
+        if not self._owners:
+            return []
+        start = bisect.bisect(self._hashes, _point(key))
+        seen = []
+        for offset in range(len(self._owners)):
+            node = self._owners[(start + offset) % len(self._owners)]
+            if node not in seen:
+                seen.append(node)
+                if len(seen) == len(self.nodes):
+                    break
+        return seen
+
+class PeerCache:
+    """Looks up and stores audio on the replica that owns a key."""
+
+    def __init__(self, self_url, peers, secret, timeout=PEER_TIMEOUT, retry_after=PEER_RETRY_AFTER):
+        self.self_url = self_url.rstrip('/')
+        self.secret = secret.encode('utf-8')
+        self.timeout = timeout
+        self.retry_after = retry_after
+        self.ring = HashRing(set(peers) | {self.self_url})
+        self._down_until = {}
+        self._pending = 0
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix='peer-push')
+
+    def owner(self, key):
+        """The live replica that owns key, or None if it is this one."""
+        now = time.monotonic()
+        with self._lock:
+            for node in self.ring.owners(key):
+                if node == self.self_url:
+                    return None
+                if self._down_until.get(node, 0) <= now:
+                    return node
+        return None
+
+    def _failed(self, peer, error):
+        with self._lock:
+            was_up = self._down_until.get(peer, 0) <= time.monotonic()
+            self._down_until[peer] = time.monotonic() + self.retry_after
+        if was_up:
+            log.warning("Peer cache %s unavailable, skipping it for %.0fs: %s", peer, self.retry_after, error)
+
+    def _recovered(self, peer):
+        with self._lock:
+            self._down_until.pop(peer, None)
+
+    def signature(self, key, data):
+        return hmac.new(self.secret, key.encode('utf-8') + data, hashlib.sha256).hexdigest()
+
+    def verify(self, key, data, signature):
+        return hmac.compare_digest(self.signature(key, data), signature or '')
+
+    def get(self, key):
+        """(data, mimetype) from the owning replica, or None if it is local, missing there or unreachable."""
+        peer = self.owner(key)
+        if peer is None:
+            return None
+        req = urllib.request.Request(f"{peer}/v1/audio/speech/{key}", headers={PEER_HEADER: '1'})
+        try:
+            with urllib.request.urlopen(req, timeout=self.timeout) as response:
+                data = response.read()
+                mimetype = response.headers.get_content_type()
+        except urllib.error.HTTPError as e:
+            if e.code != 404:
+                self._failed(peer, e)
+                metrics.PEER_CACHE_REQUESTS.inc(op='get', result='error')
+                return None
+            self._recovered(peer)
+            metrics.PEER_CACHE_REQUESTS.inc(op='get', result='miss')
+            return None
+        except (OSError, ValueError) as e:
+            self._failed(peer, e)
+            metrics.PEER_CACHE_REQUESTS.inc(op='get', result='error')
+            return None
+        self._recovered(peer)
+        metrics.PEER_CACHE_REQUESTS.inc(op='get', result='hit')
+        return data, mimetype
+
+    def put(self, key, data, mimetype):
+        """Sends audio for a key owned by another replica to it, in the background."""
+        peer = self.owner(key)
+        if peer is None:
+            return
+        with self._lock:
+            if self._pending >= MAX_PENDING_PUSHES:
+                metrics.PEER_CACHE_REQUESTS.inc(op='put', result='dropped')
+                return
+            self._pending += 1
+        self._executor.submit(self._push, peer, key, data, mimetype)
+
+    def _push(self, peer, key, data, mimetype):
+        req = urllib.request.Request(f"{peer}/v1/audio/speech/{key}", data=data, method='PUT', headers={
+            'Content-Type': mimetype, PEER_HEADER: '1', SIGNATURE_HEADER: self.signature(key, data),
+        })
+        try:
+            with urllib.request.urlopen(req, timeout=self.timeout) as response:
+                response.read()
+            self._recovered(peer)
+            metrics.PEER_CACHE_REQUESTS.inc(op='put', result='stored')
+        except (OSError, ValueError) as e:
+            self._failed(peer, e)
+            metrics.PEER_CACHE_REQUESTS.inc(op='put', result='error')
+        finally:
+            with self._lock:
+                self._pending -= 1
+
+    def snapshot(self):
+        now = time.monotonic()
+        with self._lock:
+            return {
+                "self": self.self_url,
+                "peers": {node: ("down" if self._down_until.get(node, 0) > now else "up")
+                          for node in self.ring.nodes if node != self.self_url},
+            }
+
+def get_peer_cache(secret):
+    """The configured PeerCache, or None when PEER_URLS is not set."""
+    peers = parse_peers(PEER_URLS)
+    if not peers:
+        return None
+    if not PEER_SELF:
+        log.error("PEER_URLS is set without PEER_SELF; the peer cache is disabled")
+        return None
+    return PeerCache(PEER_SELF, peers, secret)
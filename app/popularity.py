@@ -0,0 +1,165 @@
+# popularity.py
+
+"""
+Request popularity for the audio cache.
+
+Every cacheable speech request is counted in a count-min sketch: a few rows
+of small counters indexed by hashes of the cache key, whose smallest counter
+over-estimates a key's count by little while using a fixed amount of memory
+however many distinct requests there are. Counters are halved every
+SKETCH_SAMPLE_SIZE additions, so popularity follows recent traffic.
+
+The audio cache uses the sketch as a TinyLFU admission filter: new audio
+only displaces entries that are requested less often than it is, so a stream
+of one-off long documents cannot flush phrases that are asked for all day.
+
+Next to the sketch the tracker keeps the most requested phrases of each voice
+(their request bodies). The pre-warmer in main.py synthesizes the top
+PREWARM_TOP_N of them that are not cached while the upstream has spare
+capacity, and the set is saved to POPULARITY_FILE so a restart starts warm.
+
+Counts are per process. Under the pre-fork server each worker counts only
+the requests it serves, and only worker 0 pre-warms and saves, so the hot
+set is drawn from about 1/N of the traffic (N workers): with the load spread
+evenly its top phrases are the same ones, but a phrase needs N times as many
+requests to stand out, and the other workers' counts are lost on restart.
+"""
+
+import hashlib
+import json
+import os
+import threading
+from array import array
+
+from config import DEFAULT_CONFIGS
+from logs import get_logger
+
+log = get_logger('popularity')
+
+POPULARITY_FILE = os.getenv('POPULARITY_FILE', DEFAULT_CONFIGS["POPULARITY_FILE"])
+PREWARM_TOP_N = int(os.getenv('PREWARM_TOP_N', str(DEFAULT_CONFIGS["PREWARM_TOP_N"])))
+PREWARM_INTERVAL = float(os.getenv('PREWARM_INTERVAL', str(DEFAULT_CONFIGS["PREWARM_INTERVAL"])))
+
+SKETCH_WIDTH = 1 << 14
+SKETCH_DEPTH = 4
+# Additions between halvings of every counter
+SKETCH_SAMPLE_SIZE = 10 * SKETCH_WIDTH
+MAX_COUNT = 0xFFFF
+# Candidates kept per voice for each hot phrase slot; the rest of the counting is the sketch's
+CANDIDATES_PER_SLOT = 4
+# A phrase asked for once is not worth synthesizing ahead of time
+MIN_PREWARM_COUNT = 2
+
+class CountMinSketch:
+    """Approximate counts of string keys in fixed memory; estimates are never below the true count."""
+
+    def __init__(self, width=SKETCH_WIDTH, depth=SKETCH_DEPTH, sample_size=SKETCH_SAMPLE_SIZE):
+        self.width = width
+        self.sample_size = sample_size
+        self._rows = [array('H', bytes(2 * width)) for _ in range(depth)]
+        self._additions = 0
+
+    def _indexes(self, key):
+        digest = hashlib.blake2b(key.encode('utf-8'), digest_size=16).digest()
+        first, second = int.from_bytes(digest[:8], 'little'), int.from_bytes(digest[8:], 'little') | 1
+        return [(first + row * second) % self.width for row in range(len(self._rows))]
+
+    def add(self, key, count=1):
+        """Counts key count more times; returns its new estimate."""
+        indexes = self._indexes(key)
+        # Conservative update: only the counters at the minimum are raised, which keeps
+        # collisions from inflating other keys' estimates as much
+        target = min(min(row[index] for row, index in zip(self._rows, indexes)) + count, MAX_COUNT)
+        for row, index in zip(self._rows, indexes):
+            if row[index] < target:
+                row[index] = target
+        self._additions += count
+        if self._additions >= self.sample_size:
+            self._age()
+        return target
+
+    def estimate(self, key):
+        return min(row[index] for row, index in zip(self._rows, self._indexes(key)))
+
+    def _age(self):
+        for row in self._rows:
+            for index in range(self.width):
+                row[index] >>= 1
+        self._additions //= 2
+
+class PopularityTracker:
+    """How often each cacheable request is made, plus the most requested phrases per voice."""
+
+    def __init__(self, top_n, path=None):
+        self.top_n = top_n
+        self.path = path
+        self._sketch = CountMinSketch()
+        self._candidates = {}  # voice -> {key: request body}
+        self._lock = threading.Lock()
+
+    def record(self, key):
+        """Counts one request for key; returns its estimated count."""
+        with self._lock:
+            return self._sketch.add(key)
+
+    def estimate(self, key):
+        with self._lock:
+            return self._sketch.estimate(key)
+
+    def remember(self, key, voice, request):
+        """Keeps a served request as a candidate hot phrase of its voice, if it is among the most requested."""
+        if self.top_n <= 0:
+            return
+        with self._lock:
+            candidates = self._candidates.setdefault(voice, {})
+            candidates[key] = request
+            if len(candidates) > self.top_n * CANDIDATES_PER_SLOT:
+                coldest = min(candidates, key=self._sketch.estimate)
+                del candidates[coldest]
+
+    def hot(self):
+        """The top_n most requested phrases of each voice, as (key, request body), most requested first."""
+        with self._lock:
+            hot = []
+            for candidates in self._candidates.values():
+                counted = sorted(((self._sketch.estimate(key), key) for key in candidates), reverse=True)
+                hot.extend((count, key, candidates[key]) for count, key in counted[:self.top_n]
+                           if count >= MIN_PREWARM_COUNT)
+        hot.sort(key=lambda entry: entry[0], reverse=True)
+        return [(key, request) for _, key, request in hot]
+
+    def save(self):
+        """Writes the hot phrases and their counts to path, replacing it atomically."""
+        if not self.path:
+            return
+        with self._lock:
+            entries = [
+                {"key": key, "voice": voice, "count": self._sketch.estimate(key), "request": request}
+                for voice, candidates in self._candidates.items() for key, request in candidates.items()
+            ]
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        part = f"{self.path}.{os.getpid()}.part"
+        with open(part, 'w', encoding='utf-8') as f:
+            json.dump(entries, f, ensure_ascii=False)
+        os.replace(part, self.path)
+
+    def load(self):
+        """Restores the phrases saved by save(), counts included; returns how many were loaded."""
+        if not self.path or not os.path.exists(self.path):
+            return 0
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                entries = json.load(f)
+            with self._lock:
+                for entry in entries:
+                    self._sketch.add(entry['key'], entry['count'])
+                    self._candidates.setdefault(entry['voice'], {})[entry['key']] = entry['request']
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            log.warning("Could not load popularity data from %s: %s", self.path, e)
+            return 0
+        return len(entries)
+
+    def stats(self):
+        with self._lock:
+            return {"voices": len(self._candidates),
+                    "candidates": sum(len(candidates) for candidates in self._candidates.values())}
@@ -0,0 +1,51 @@
+# retry.py
+
+"""
+Sentence-level retry policy.
+
+Long inputs are synthesized sentence by sentence, so a transient upstream
+error only needs that one sentence redone. Each sentence gets up to
+MAX_ATTEMPTS tries with exponential backoff and full jitter; all retries of a
+request share one time budget so a bad upstream cannot stretch a request
+indefinitely. When a sentence runs out of attempts or budget the caller falls
+back to another backend for that sentence only.
+"""
+
+import os
+import random
+import time
+
+from config import DEFAULT_CONFIGS
+
+MAX_ATTEMPTS = int(os.getenv('SENTENCE_MAX_ATTEMPTS', str(DEFAULT_CONFIGS["SENTENCE_MAX_ATTEMPTS"])))
+BASE_DELAY = float(os.getenv('SENTENCE_RETRY_BASE_DELAY', str(DEFAULT_CONFIGS["SENTENCE_RETRY_BASE_DELAY"])))
+MAX_DELAY = float(os.getenv('SENTENCE_RETRY_MAX_DELAY', str(DEFAULT_CONFIGS["SENTENCE_RETRY_MAX_DELAY"])))
+REQUEST_BUDGET = float(os.getenv('REQUEST_RETRY_BUDGET', str(DEFAULT_CONFIGS["REQUEST_RETRY_BUDGET"])))
+
+class RetryBudget:
+    """Retry allowance for one request; shared by all of its sentences."""
+
+    def __init__(self, budget=REQUEST_BUDGET, max_attempts=MAX_ATTEMPTS,
+                 base_delay=BASE_DELAY, max_delay=MAX_DELAY, rng=random):
+        self.deadline = time.monotonic() + budget
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.retries = 0
+        self._rng = rng
+
+    def remaining(self):
+        return max(0.0, self.deadline - time.monotonic())
+
+    def next_delay(self, attempt):
+        """
+        Seconds to wait before retrying after the given (1-based) failed attempt,
+        or None when the sentence should not be retried again.
+        """
+        if attempt >= self.max_attempts:
+            return None
+        delay = self._rng.uniform(0, min(self.max_delay, self.base_delay * 2 ** (attempt - 1)))
+        if delay >= self.remaining():
+            return None
+        self.retries += 1
+        return delay
@@ -0,0 +1,177 @@
+# routing.py
+
+"""
+Backend selection for the OpenAI voice aliases (alloy, nova, ...).
+
+Each alias maps to an ordered list of equivalent voices; nano voice names
+and edge voices (the ones with a '-') can be mixed, and the voice decides the
+backend as it does for any other request. By default an alias has only its
+tts_handler.voice_mapping edge voice; VOICE_ROUTES adds or replaces lists:
+
+    VOICE_ROUTES=alloy=DeepSeek|zh-CN-XiaoxiaoNeural,nova=Kimi|zh-CN-XiaohanNeural
+
+With VOICE_ROUTING=static an alias takes the first voice whose backend's
+circuit breaker is not open. With VOICE_ROUTING=latency it takes the backend
+that is currently fastest: every routed request reports its time to first
+byte and whether it failed, and a background probe synthesizes a short
+phrase on each backend every ROUTING_PROBE_INTERVAL seconds so a backend
+that is not getting traffic still has fresh numbers. Statistics are moving
+averages, so a backend that slows down or starts failing loses its traffic
+within a few requests. An earlier voice in the list is kept unless a later
+one is clearly faster, so traffic does not flap between backends that are
+about as fast.
+"""
+
+import os
+import threading
+import time
+
+import metrics
+from breaker import OPEN, get_breaker
+from config import DEFAULT_CONFIGS
+from logs import get_logger
+
+log = get_logger('routing')
+
+VOICE_ROUTING = os.getenv('VOICE_ROUTING', DEFAULT_CONFIGS["VOICE_ROUTING"])
+VOICE_ROUTES = os.getenv('VOICE_ROUTES', DEFAULT_CONFIGS["VOICE_ROUTES"])
+ROUTING_PROBE_INTERVAL = float(os.getenv('ROUTING_PROBE_INTERVAL', str(DEFAULT_CONFIGS["ROUTING_PROBE_INTERVAL"])))
+
+POLICIES = ('static', 'latency')
+
+# Weight of the newest sample in the moving averages
+ALPHA = 0.2
+# A backend failing every request scores as this many times slower than its latency
+ERROR_PENALTY = 4.0
+# How much faster a later voice must be to take traffic from an earlier one
+SWITCH_MARGIN = 0.2
+PROBE_TEXT = '你好。'
+
+def backend_for(voice):
+    """The backend a voice is served by (the rule /v1/audio/speech routes on)."""
+    return 'edge' if '-' in voice else 'nano'
+
+def parse_routes(value, defaults=None):
+    """
+    Parses "alias=voice|voice,..." into {alias: [voice, ...]}, on top of defaults
+    ({alias: voice}); an alias listed in value replaces its default.
+    """
+    routes = {alias: [voice] for alias, voice in (defaults or {}).items()}
+    for pair in value.split(','):
+        alias, _, voices = pair.partition('=')
+        voices = [voice.strip() for voice in voices.split('|') if voice.strip()]
+        if alias.strip() and voices:
+            routes[alias.strip()] = voices
+    return routes
+
+class BackendStats:
+    """Moving averages of one backend's time to first byte and failure rate."""
+
+    def __init__(self):
+        self.latency = None
+        self.error_rate = 0.0
+        self.samples = 0
+
+    def record(self, seconds, ok):
+        if ok:
+            # A failure's duration says little about speed (it may be a timeout or an instant refusal)
+            self.latency = seconds if self.latency is None else ALPHA * seconds + (1 - ALPHA) * self.latency
+        self.error_rate = (1 - ALPHA) * self.error_rate + (0.0 if ok else ALPHA)
+        self.samples += 1
+
+    def score(self):
+        """Expected seconds to first byte with failures penalized; None before the first success."""
+        if self.latency is None:
+            return None
+        return self.latency * (1 + ERROR_PENALTY * self.error_rate)
+
+class Router:
+    def __init__(self, routes, policy='static'):
+        if policy not in POLICIES:
+            raise ValueError(f"VOICE_ROUTING must be one of {', '.join(POLICIES)}, got {policy!r}")
+        self.routes = routes
+        self.policy = policy
+        self._stats = {backend_for(voice): BackendStats() for voices in routes.values() for voice in voices}
+        self._lock = threading.Lock()
+
+    def choose(self, alias, allowed=None):
+        """
+        The voice to serve an alias with, or None if the alias is not routed. allowed(backend),
+        if given, narrows the choice to backends the caller may use (e.g. its API key's).
+        """
+        voices = self.routes.get(alias)
+        if not voices:
+            return None
+        if allowed is not None:
+            voices = [voice for voice in voices if allowed(backend_for(voice))] or voices
+        # Skip backends failing fast behind an open breaker, unless that is all of them
+        available = [voice for voice in voices if get_breaker(backend_for(voice)).snapshot()['state'] != OPEN]
+        voices = available or voices
+        voice = voices[0] if self.policy == 'static' else self._fastest(voices)
+        metrics.ROUTE_CHOICES.inc(alias=alias, backend=backend_for(voice))
+        return voice
+
+    def _fastest(self, voices):
+        with self._lock:
+            scores = [self._stats[backend_for(voice)].score() for voice in voices]
+        for voice, score in zip(voices, scores):
+            if score is None:
+                return voice  # no numbers yet; this request provides the first
+        best = min(scores)
+        for voice, score in zip(voices, scores):
+            if score <= best * (1 + SWITCH_MARGIN):
+                return voice
+
+    def record(self, backend, seconds, ok):
+        """Reports one routed request or probe: its time to first byte and whether it succeeded."""
+        with self._lock:
+            stats = self._stats.get(backend)
+            if stats is None:
+                return
+            stats.record(seconds, ok)
+            score = stats.score()
+        if score is not None:
+            metrics.ROUTE_SCORE.set(score, backend=backend)
+
+    def start_probing(self, probes, interval=ROUTING_PROBE_INTERVAL):
+        """
+        Probes each routed backend every interval seconds in a daemon thread. probes maps a
+        backend to a function synthesizing (text, voice) and returning once audio starts.
+        """
+        if self.policy != 'latency' or not interval:
+            return
+        voices = {}
+        for alias_voices in self.routes.values():
+            for voice in alias_voices:
+                voices.setdefault(backend_for(voice), voice)
+        targets = [(backend, voice, probes[backend]) for backend, voice in voices.items() if backend in probes]
+        threading.Thread(target=self._probe_loop, args=(targets, interval), name='route-probe', daemon=True).start()
+
+    def _probe_loop(self, targets, interval):
+        while True:
+            for backend, voice, probe in targets:
+                if get_breaker(backend).snapshot()['state'] == OPEN:
+                    continue  # the breaker's own half-open probe decides when it is back
+                start = time.perf_counter()
+                try:
+                    probe(PROBE_TEXT, voice)
+                    ok = True
+                except Exception as e:
+                    log.warning("Routing probe of %s with %s failed: %s", backend, voice, e)
+                    ok = False
+                self.record(backend, time.perf_counter() - start, ok)
+            time.sleep(interval)
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                "policy": self.policy,
+                "backends": {
+                    backend: {
+                        "latency_ms": None if stats.latency is None else round(stats.latency * 1000, 1),
+                        "error_rate": round(stats.error_rate, 3),
+                        "samples": stats.samples,
+                    }
+                    for backend, stats in self._stats.items()
+                },
+            }
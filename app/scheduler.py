@@ -0,0 +1,234 @@
+# scheduler.py
+
+"""
+Scheduling of calls to the upstream synthesis services.
+
+Admission control bounds how many requests each backend works on; this
+bounds how many upstream calls run at once (NANO_UPSTREAM_CONCURRENCY,
+EDGE_UPSTREAM_CONCURRENCY) and decides which waiting call goes next. Each
+call is tagged with its request's Work: a priority class and a tenant (the
+API key). Waiting calls are served by class, in PRIORITIES order:
+
+- first: an interactive request's calls until one has completed, so a
+  stream's first sentence is not stuck behind anyone's bulk work
+- interactive: the rest of streamed requests and short buffered ones
+- bulk: batch items, background jobs and buffered texts of at least
+  SCHEDULER_BULK_CHARS characters
+
+Within a class, tenants take turns one call at a time, so one key sending a
+long document gets its share rather than the whole upstream. A call waits
+at most until its request's deadline.
+"""
+
+import hashlib
+import math
+import os
+import threading
+import time
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+
+from flask import g, has_request_context, request
+
+import metrics
+from config import DEFAULT_CONFIGS
+
+UPSTREAM_CONCURRENCY = {
+    'nano': int(os.getenv('NANO_UPSTREAM_CONCURRENCY', str(DEFAULT_CONFIGS["NANO_UPSTREAM_CONCURRENCY"]))),
+    'edge': int(os.getenv('EDGE_UPSTREAM_CONCURRENCY', str(DEFAULT_CONFIGS["EDGE_UPSTREAM_CONCURRENCY"]))),
+}
+SCHEDULER_BULK_CHARS = int(os.getenv('SCHEDULER_BULK_CHARS', str(DEFAULT_CONFIGS["SCHEDULER_BULK_CHARS"])))
+
+FIRST = 'first'
+INTERACTIVE = 'interactive'
+BULK = 'bulk'
+PRIORITIES = (FIRST, INTERACTIVE, BULK)
+
+# Tenant of work done outside any request (jobs, probes)
+BACKGROUND = 'background'
+
+class Work:
+    """Who upstream calls are made for: an interactive or bulk request of one tenant."""
+
+    def __init__(self, interactive, tenant):
+        self.interactive = interactive
+        self.tenant = tenant
+        self.first_done = False
+
+    @property
+    def priority(self):
+        if not self.interactive:
+            return BULK
+        return INTERACTIVE if self.first_done else FIRST
+
+def _tenant():
+    auth_header = request.headers.get('Authorization', '')
+    if not auth_header:
+        return 'anonymous'
+    # Only used to tell keys apart; the key itself is not kept
+    return hashlib.sha256(auth_header.encode('utf-8')).hexdigest()[:16]
+
+def _interactive():
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict):
+        return True
+    if data.get('stream') is True or data.get('stream_format') == 'sse':
+        return True
+    text = data.get('input') or data.get('text') or ''
+    return not (isinstance(text, str) and len(text) >= SCHEDULER_BULK_CHARS)
+
+def current_work(bulk=False):
+    """
+    The Work of the current request, created on first use; bulk=True (or being outside a
+    request) makes it bulk. Streaming generators that outlive the request take it up front.
+    """
+    if not has_request_context():
+        return Work(False, BACKGROUND)
+    work = g.get('upstream_work')
+    if work is None:
+        work = g.upstream_work = Work(not bulk and _interactive(), _tenant())
+    return work
+
+class UpstreamScheduler:
+    """At most concurrency calls at once; waiting calls go by priority class, then round-robin by tenant."""
+
+    def __init__(self, name, concurrency):
+        self.name = name
+        self.concurrency = concurrency
+        self._active = 0
+        self._waiting = {priority: OrderedDict() for priority in PRIORITIES}  # tenant -> deque of waiters
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self):
+        return self.concurrency > 0
+
+    @contextmanager
+    def slot(self, work, deadline):
+        """Holds one upstream call slot for the with-block."""
+        self.acquire(work, deadline)
+        ok = False
+        try:
+            yield
+            ok = True
+        finally:
+            self.release(work, ok)
+
+    def hold(self, chunks, work):
+        """Wraps an acquired call's chunk iterator so the slot is released when it ends or is closed."""
+        if not self.enabled:
+            return chunks
+        return HeldStream(chunks, lambda ok: self.release(work, ok))
+
+    def acquire(self, work, deadline):
+        """Waits for a call slot; raises DeadlineExceeded if the deadline passes first."""
+        if not self.enabled:
+            return
+        priority = work.priority
+        with self._lock:
+            if self._active < self.concurrency and not self._queued():
+                self._active += 1
+                metrics.SCHEDULER_WAIT.observe(0.0, backend=self.name, priority=priority)
+                return
+            waiter = threading.Event()  # set when a finishing call hands over its slot
+            self._waiting[priority].setdefault(work.tenant, deque()).append(waiter)
+            self._update_depth(priority)
+        start = time.perf_counter()
+        try:
+            granted = waiter.wait(None if math.isinf(deadline.expires_at) else deadline.remaining())
+        finally:
+            metrics.SCHEDULER_WAIT.observe(time.perf_counter() - start, backend=self.name, priority=priority)
+        if granted:
+            return
+        with self._lock:
+            if waiter.is_set():
+                return  # granted just as the wait timed out
+            queue = self._waiting[priority][work.tenant]
+            queue.remove(waiter)
+            if not queue:
+                del self._waiting[priority][work.tenant]
+            self._update_depth(priority)
+        raise deadline.exceeded()
+
+    def release(self, work, ok=True):
+        """Frees a call slot; a successful call ends its request's first-call priority."""
+        if ok:
+            work.first_done = True
+        if not self.enabled:
+            return
+        with self._lock:
+            for priority in PRIORITIES:
+                tenants = self._waiting[priority]
+                if not tenants:
+                    continue
+                tenant, queue = next(iter(tenants.items()))
+                waiter = queue.popleft()
+                if queue:
+                    tenants.move_to_end(tenant)  # the next call of this class goes to another tenant
+                else:
+                    del tenants[tenant]
+                self._update_depth(priority)
+                waiter.set()  # the slot passes straight to the waiter
+                return
+            self._active -= 1
+
+    def idle(self):
+        """Whether there is spare capacity for background work: nothing waiting and at most half the slots busy."""
+        with self._lock:
+            return not self._queued() and self._active <= self.concurrency // 2
+
+    def _queued(self):
+        return any(self._waiting.values())
+
+    def _update_depth(self, priority):
+        depth = sum(len(queue) for queue in self._waiting[priority].values())
+        metrics.SCHEDULER_QUEUE_DEPTH.set(depth, backend=self.name, priority=priority)
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                "concurrency": self.concurrency,
+                "active": self._active,
+                "waiting": {priority: sum(len(queue) for queue in tenants.values())
+                            for priority, tenants in self._waiting.items()},
+            }
+
+class HeldStream:
+    """A chunk iterator that keeps its call slot until it is exhausted or closed."""
+
+    def __init__(self, chunks, release):
+        self._chunks = chunks
+        self._release = release
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        try:
+            return next(self._chunks)
+        except StopIteration:
+            self._finish(True)
+            raise
+        except BaseException:
+            self._finish(False)
+            raise
+
+    def close(self):
+        try:
+            if hasattr(self._chunks, 'close'):
+                self._chunks.close()
+        finally:
+            self._finish(False)
+
+    def _finish(self, ok):
+        release, self._release = self._release, None
+        if release is not None:
+            release(ok)
+
+SCHEDULERS = {name: UpstreamScheduler(name, concurrency) for name, concurrency in UPSTREAM_CONCURRENCY.items()}
+
+def get_scheduler(upstream):
+    return SCHEDULERS[upstream]
+
+def snapshot():
+    return {name: scheduler.snapshot() for name, scheduler in SCHEDULERS.items()}
@@ -0,0 +1,190 @@
+# scratch.py
+
+"""
+Managed scratch storage for synthesized audio files.
+
+edge-tts writes its mp3 to a file and FFmpeg converts file to file, so
+buffered edge responses pass through disk. Those files live in one directory
+(SCRATCH_DIR) instead of the system temp directory, bounded in total size by
+SCRATCH_MAX_BYTES: a request that would go over the quota gets ScratchFull
+rather than filling the disk. A janitor thread removes files older than
+SCRATCH_MAX_AGE, left behind by a crash or a caller that never released them.
+
+Usage is kept as a running total rather than measured per request: a file
+counts from when its writer reports it (written) until it is released or
+swept. The janitor rescans the directory every RESCAN_INTERVAL seconds,
+which corrects any drift and picks up files of other processes sharing it.
+
+Responses serve the file itself (send_scratch_file) so the server can pass it
+to the socket with wsgi.file_wrapper / sendfile instead of reading it into
+memory. The file is unlinked as soon as the response has it open; the open
+descriptor keeps the data readable and the space is freed when the response
+body is closed.
+"""
+
+import os
+import tempfile
+import threading
+import time
+
+from flask import current_app, send_file
+
+import metrics
+from config import DEFAULT_CONFIGS
+from logs import get_logger
+
+log = get_logger('scratch')
+
+SCRATCH_DIR = os.getenv('SCRATCH_DIR', DEFAULT_CONFIGS["SCRATCH_DIR"])
+SCRATCH_MAX_BYTES = int(os.getenv('SCRATCH_MAX_BYTES', str(DEFAULT_CONFIGS["SCRATCH_MAX_BYTES"])))
+SCRATCH_MAX_AGE = float(os.getenv('SCRATCH_MAX_AGE', str(DEFAULT_CONFIGS["SCRATCH_MAX_AGE"])))
+
+# Seconds a request that finds the scratch area full is told to wait
+RETRY_AFTER = 5
+# Seconds between full rescans of the directory by the janitor
+RESCAN_INTERVAL = 10.0
+
+class ScratchFull(Exception):
+    """Raised when a new scratch file would put the scratch area over its quota."""
+
+    retry_after = RETRY_AFTER
+
+class ScratchArea:
+    """A directory of short-lived audio files with a size quota and an age limit."""
+
+    def __init__(self, directory, max_bytes, max_age):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self._janitor_pid = None
+        self._lock = threading.Lock()
+        self._sizes = {}  # bytes counted for each of this process's live files
+        self._used = 0
+        os.makedirs(directory, exist_ok=True)
+        self.rescan()
+
+    def new_file(self, suffix):
+        """Creates an empty scratch file and returns its path; raises ScratchFull over the quota."""
+        self._start_janitor()
+        if self.max_bytes and self.usage() >= self.max_bytes:
+            self.sweep()
+            if self.rescan() >= self.max_bytes:
+                raise ScratchFull(f"audio scratch area {self.directory} is full "
+                                  f"({self.max_bytes} bytes); retry later")
+        fd, path = tempfile.mkstemp(suffix=suffix, dir=self.directory)
+        os.close(fd)
+        with self._lock:
+            self._sizes[path] = 0
+        return path
+
+    def written(self, path):
+        """Counts a scratch file's size once its writer has finished with it."""
+        try:
+            size = os.path.getsize(path)
+        except OSError:
+            return
+        with self._lock:
+            self._used += size - self._sizes.get(path, 0)
+            self._sizes[path] = size
+            metrics.SCRATCH_BYTES.set(self._used)
+
+    def release(self, path):
+        """Removes a scratch file; a response still reading it keeps its data until closed."""
+        try:
+            os.unlink(path)
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            # e.g. still open on Windows; the janitor removes it once it is old enough
+            log.warning("Could not remove scratch file %s: %s", path, e)
+            return
+        with self._lock:
+            self._used -= self._sizes.pop(path, 0)
+            metrics.SCRATCH_BYTES.set(self._used)
+
+    def usage(self):
+        """Bytes held in the scratch directory, as of the last rescan plus what changed since."""
+        with self._lock:
+            return self._used
+
+    def rescan(self):
+        """Measures the scratch directory and resets the running total to it; returns the total."""
+        total = 0
+        sizes = {}
+        with os.scandir(self.directory) as entries:
+            for entry in entries:
+                try:
+                    sizes[entry.path] = entry.stat().st_size
+                except FileNotFoundError:
+                    continue  # released while scanning
+                total += sizes[entry.path]
+        with self._lock:
+            # Files created during the scan are not in it; they count again once written
+            self._sizes = {path: sizes[path] for path in self._sizes if path in sizes}
+            self._used = total
+            metrics.SCRATCH_BYTES.set(total)
+        return total
+
+    def sweep(self):
+        """Removes files older than max_age; returns how many were removed."""
+        cutoff = time.time() - self.max_age
+        removed = 0
+        with os.scandir(self.directory) as entries:
+            for entry in entries:
+                try:
+                    stat = entry.stat()
+                    if stat.st_mtime < cutoff:
+                        os.unlink(entry.path)
+                        removed += 1
+                        with self._lock:
+                            self._used -= self._sizes.pop(entry.path, stat.st_size)
+                except FileNotFoundError:
+                    pass
+                except OSError as e:
+                    log.warning("Could not remove stale scratch file %s: %s", entry.path, e)
+        if removed:
+            metrics.SCRATCH_SWEPT.inc(removed)
+            log.info("Scratch janitor removed %d stale files from %s", removed, self.directory)
+        return removed
+
+    def _start_janitor(self):
+        # Threads do not survive a fork, so each process starts its own on first use
+        with self._lock:
+            if self._janitor_pid == os.getpid():
+                return
+            self._janitor_pid = os.getpid()
+        threading.Thread(target=self._janitor, name='scratch-janitor', daemon=True).start()
+
+    def _janitor(self):
+        sweep_interval = max(1.0, self.max_age / 4)
+        last_sweep = time.monotonic()
+        while True:
+            time.sleep(min(RESCAN_INTERVAL, sweep_interval))
+            try:
+                if time.monotonic() - last_sweep >= sweep_interval:
+                    last_sweep = time.monotonic()
+                    self.sweep()
+                self.rescan()
+            except OSError as e:
+                log.error("Scratch janitor failed: %s", e)
+
+_scratch = None
+_scratch_lock = threading.Lock()
+
+def get_scratch():
+    """The process-wide ScratchArea configured by SCRATCH_DIR / SCRATCH_MAX_BYTES / SCRATCH_MAX_AGE."""
+    global _scratch
+    with _scratch_lock:
+        if _scratch is None:
+            _scratch = ScratchArea(SCRATCH_DIR, SCRATCH_MAX_BYTES, SCRATCH_MAX_AGE)
+        return _scratch
+
+def send_scratch_file(path, mimetype, **kwargs):
+    """
+    A response serving a scratch file through the server's file wrapper. The file is
+    released here; the response holds it open, so its space is freed when the body closes.
+    """
+    response = send_file(path, mimetype=mimetype, **kwargs)
+    if not current_app.config.get('USE_X_SENDFILE'):  # the front server would open the path itself
+        get_scratch().release(path)
+    return response
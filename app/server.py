@@ -1,20 +1,30 @@
 # server.py
 
-from flask import Flask, request, send_file, jsonify, Response
-from gevent.pywsgi import WSGIServer
-from dotenv import load_dotenv
+from flask import Flask, request, jsonify, Response
 import os
-import traceback
 import json
 import base64
+import time
+from contextlib import closing
 
 from config import DEFAULT_CONFIGS
-from handle_text import prepare_tts_input_with_context, clean_text
-from tts_handler import generate_speech, generate_speech_stream, get_models_formatted, get_voices, get_voices_formatted
-from utils import getenv_bool, require_api_key, AUDIO_FORMAT_MIME_TYPES, DETAILED_ERROR_LOGGING
+from handle_text import prepare_tts_input_with_context, clean_text, split_first_chunk
+from tts_handler import (generate_speech, generate_speech_stream, get_models_formatted, get_voices, get_voices_formatted,
+                         is_ffmpeg_installed, transcode_stream, voice_mapping)
+from utils import getenv_bool, require_api_key, format_sse_event, AUDIO_FORMAT_MIME_TYPES, DETAILED_ERROR_LOGGING
+from timing import current_timer
+from deadline import DeadlineExceeded, current_deadline, route_timeout
+from disconnect import ClientDisconnected, watch_client
+from scheduler import current_work
+from routing import backend_for
+from scratch import ScratchFull, send_scratch_file
+from ssml import Segment, SSMLError, parse_ssml, render
+from logs import get_logger, request_id
+import metrics
 
 app = Flask(__name__)
-load_dotenv()
+log = get_logger('edge')
+# .env has already been loaded by utils (imported above)
 
 API_KEY = os.getenv('API_KEY', DEFAULT_CONFIGS["API_KEY"])
 PORT = int(os.getenv('PORT', str(DEFAULT_CONFIGS["PORT"])))
@@ -29,23 +39,40 @@ EXPAND_API = getenv_bool('EXPAND_API', DEFAULT_CONFIGS["EXPAND_API"])
 # DEFAULT_MODEL = os.getenv('DEFAULT_MODEL', 'tts-1')
 
 # Currently in "beta" — needs more extensive testing where drop-in replacement warranted
-def generate_sse_audio_stream(text, voice, speed, pitch):
-    """Generator function for SSE streaming with JSON events."""
+def generate_sse_audio_stream(text, voice, speed, pitch, timer=None, deadline=None, watch=None, work=None, rid=None):
+    """
+    Generator function for SSE streaming with JSON events. With a watch, stops (closing
+    the upstream stream) as soon as the client is found to have disconnected. rid is the
+    request ID its log records carry, as they are logged after the request context is gone.
+    """
+    log_context = {"request_id": rid} if rid else None
+    timer = timer or current_timer()
+    start = time.perf_counter()
+    first_chunk = True
     try:
         # Generate streaming audio chunks and convert to SSE format
-        for chunk in generate_speech_stream(text, voice, speed, pitch):
-            # Base64 encode the audio chunk
-            encoded_audio = base64.b64encode(chunk).decode('utf-8')
-            
-            # Create SSE event for audio delta
-            event_data = {
-                "type": "speech.audio.delta",
-                "audio": encoded_audio
-            }
-            
-            # Format as SSE event
-            yield f"data: {json.dumps(event_data)}\n\n"
+        # closing(): stopping early (disconnect, deadline) cancels the upstream stream right away
+        with closing(generate_speech_stream(text, voice, speed, pitch, deadline, work)) as chunks:
+            for chunk in chunks:
+                if first_chunk:
+                    first_chunk = False
+                    timer.record('upstream-first-chunk', time.perf_counter() - start)
+                if watch is not None:
+                    watch.check()
+                # Base64 encode the audio chunk
+                encoded_audio = base64.b64encode(chunk).decode('utf-8')
+
+                # Create SSE event for audio delta
+                event_data = {
+                    "type": "speech.audio.delta",
+                    "audio": encoded_audio
+                }
+
+                # Format as SSE event
+                yield format_sse_event(event_data)
         
+        timer.record('upstream', time.perf_counter() - start)
+
         # Send completion event
         completion_event = {
             "type": "speech.audio.done",
@@ -53,18 +80,35 @@ def generate_sse_audio_stream(text, voice, speed, pitch):
                 "input_tokens": len(text.split()),  # Rough estimate
                 "output_tokens": 0,  # Edge TTS doesn't provide this
                 "total_tokens": len(text.split())
-            }
+            },
+            "timing": timer.summary()
         }
-        yield f"data: {json.dumps(completion_event)}\n\n"
+        yield format_sse_event(completion_event)
         
+    except (GeneratorExit, ClientDisconnected) as e:
+        log.info("SSE client disconnected; stopping synthesis", extra=log_context)
+        metrics.CLIENT_DISCONNECTS.inc(backend='edge')
+        if isinstance(e, GeneratorExit):
+            raise
+    except DeadlineExceeded as e:
+        log.warning("SSE stream abandoned: %s", e, extra=log_context)
+        metrics.DEADLINES_EXCEEDED.inc(backend='edge')
+        yield format_sse_event({"type": "error", "error": str(e), "code": "deadline_exceeded"})
     except Exception as e:
-        print(f"Error during SSE streaming: {e}")
+        log.error("Error during SSE streaming: %s", e, extra=log_context)
         # Send error event
         error_event = {
             "type": "error",
             "error": str(e)
         }
-        yield f"data: {json.dumps(error_event)}\n\n"
+        yield format_sse_event(error_event)
+
+def scratch_full(error):
+    log.warning("Rejecting speech request: %s", error)
+    response = jsonify({"error": str(error), "code": "scratch_full"})
+    response.status_code = 503
+    response.headers['Retry-After'] = str(error.retry_after)
+    return response
 
 # OpenAI endpoint format
 @app.route('/v1/audio/speech', methods=['POST'])
@@ -72,6 +116,7 @@ def generate_sse_audio_stream(text, voice, speed, pitch):
 @require_api_key
 def text_to_speech():
     try:
+        timer = current_timer()
         data = request.json
         if not data or 'input' not in data:
             return jsonify({"error": "Missing 'input' in request body"}), 400
@@ -79,12 +124,13 @@ def text_to_speech():
         text = data.get('input')
 
         # 1. Handle cleaning options (new feature)
-        cleaning_options = data.get('cleaning_options')
-        if cleaning_options:
-            text = clean_text(text, cleaning_options)
-        elif not REMOVE_FILTER:
-            # Fallback to original cleaning if no specific options provided
-            text = prepare_tts_input_with_context(text)
+        with timer.phase('clean'):
+            cleaning_options = data.get('cleaning_options')
+            if cleaning_options:
+                text = clean_text(text, cleaning_options)
+            elif not REMOVE_FILTER:
+                # Fallback to original cleaning if no specific options provided
+                text = prepare_tts_input_with_context(text)
 
         # 2. Handle pitch parameter (Hz format, integer value)
         pitch = int(data.get('pitch', 0))
@@ -99,20 +145,26 @@ def text_to_speech():
         stream_param = data.get('stream', False)
         stream_format = data.get('stream_format', 'audio')  # 'audio' (default) or 'sse'
         
-        print(f"DEBUG: stream_param={stream_param} (type={type(stream_param)}), stream_format={stream_format}")
-
         if stream_param is True:
             stream_format = 'sse'
-        
-        print(f"DEBUG: Final stream_format={stream_format}")
+        log.debug("Edge speech request", extra={"voice": voice, "chars": len(text), "stream_format": stream_format})
         
         mime_type = AUDIO_FORMAT_MIME_TYPES.get(response_format, "audio/mpeg")
+
+        # Started here unless the unified entry point already did; the SSE generator
+        # runs after the request context is gone, so it gets the deadline passed in
+        deadline = current_deadline(route_timeout(stream_format == 'sse'))
         
         if stream_format == 'sse':
+            # Like the deadline, the client connection and the scheduling tag are taken
+            # while the request context exists
+            watch = watch_client()
+            work = current_work()
+            rid = request_id()
+
             # Return SSE streaming response with JSON events
             def generate_sse():
-                for event in generate_sse_audio_stream(text, voice, speed, pitch):
-                    yield event
+                yield from generate_sse_audio_stream(text, voice, speed, pitch, timer, deadline, watch, work, rid)
             
             return Response(
                 generate_sse(),
@@ -126,32 +178,23 @@ def text_to_speech():
             )
         else:
             # Return raw audio data (like OpenAI) - can be piped to ffplay
-            output_file_path = generate_speech(text, voice, response_format, speed, pitch)
+            with timer.phase('synthesis'):
+                output_file_path = generate_speech(text, voice, response_format, speed, pitch, deadline)
             
-            # Read the file and return raw audio data
-            with open(output_file_path, 'rb') as audio_file:
-                audio_data = audio_file.read()
-            
-            # Clean up the temporary file
-            try:
-                os.unlink(output_file_path)
-            except OSError:
-                pass  # File might already be cleaned up
-            
-            return Response(
-                audio_data,
-                mimetype=mime_type,
-                headers={
-                    'Content-Type': mime_type,
-                    'Content-Length': str(len(audio_data))
-                }
-            )
+            with timer.phase('assemble'):
+                # Serve the file itself, so the server can hand it to the socket without reading it in
+                response = send_scratch_file(output_file_path, mime_type)
+            response.headers['Server-Timing'] = timer.header()
+            return response
             
+    except ScratchFull as e:
+        return scratch_full(e)
+    except DeadlineExceeded as e:
+        log.warning("text_to_speech abandoned: %s", e)
+        metrics.DEADLINES_EXCEEDED.inc(backend='edge')
+        return jsonify({"error": str(e), "code": "deadline_exceeded"}), 504
     except Exception as e:
-        if DETAILED_ERROR_LOGGING:
-            app.logger.error(f"Error in text_to_speech: {str(e)}\n{traceback.format_exc()}")
-        else:
-            app.logger.error(f"Error in text_to_speech: {str(e)}")
+        log.error("Error in text_to_speech: %s", e, exc_info=DETAILED_ERROR_LOGGING)
         # Return a 500 error for unhandled exceptions, which is more standard than 400
         return jsonify({"error": "An internal server error occurred", "details": str(e)}), 500
 
@@ -222,49 +265,217 @@ def elevenlabs_tts(voice_id):
     # Generate speech using edge-tts
     try:
         output_file_path = generate_speech(text, voice, response_format, speed)
+    except ScratchFull as e:
+        return scratch_full(e)
     except Exception as e:
         return jsonify({"error": f"TTS generation failed: {str(e)}"}), 500
 
-    # Return the generated audio file
-    return send_file(output_file_path, mimetype="audio/mpeg", as_attachment=True, download_name="speech.mp3")
-# tts.speech.microsoft.com/cognitiveservices/v1
-# https://{region}.tts.speech.microsoft.com/cognitiveservices/v1
-# http://localhost:5050/azure/cognitiveservices/v1
-@app.route('/azure/cognitiveservices/v1', methods=['POST'])
+    # Return the generated audio file; its scratch space is freed once it has been sent
+    return send_scratch_file(output_file_path, "audio/mpeg", as_attachment=True, download_name="speech.mp3")
+
+# optimize_streaming_latency (0-4) -> longest first text chunk; its audio starts before the rest is
+# synthesized. Level 4 also skips text normalization, as ElevenLabs does.
+FIRST_CHUNK_CHARS = {0: None, 1: 200, 2: 120, 3: 60, 4: 60}
+ELEVENLABS_OUTPUT_FORMAT = 'mp3_44100_128'
+
+def elevenlabs_output(output_format):
+    """
+    (mimetype, FFmpeg output arguments) for an ElevenLabs output_format such as mp3_44100_128,
+    pcm_16000 or ulaw_8000; None arguments stream edge's mp3 as is. Raises ValueError if unknown.
+    """
+    codec, _, rest = output_format.partition('_')
+    sample_rate, _, bitrate = rest.partition('_')
+    if not sample_rate.isdigit() or not 8000 <= int(sample_rate) <= 48000 or (bitrate and not bitrate.isdigit()):
+        raise ValueError(f"Unsupported output_format: {output_format}")
+    if codec == 'mp3':
+        # The edge stream is already mp3 (24 kHz); re-encoding it would only add latency
+        return "audio/mpeg", None
+    if codec == 'pcm':
+        return "audio/pcm", ["-f", "s16le", "-ac", "1", "-ar", sample_rate]
+    if codec == 'ulaw':
+        return "audio/basic", ["-f", "mulaw", "-ac", "1", "-ar", sample_rate]
+    if codec == 'alaw':
+        return "audio/x-alaw-basic", ["-f", "alaw", "-ac", "1", "-ar", sample_rate]
+    if codec == 'opus':
+        return "audio/ogg", ["-c:a", "libopus", "-b:a", f"{bitrate or 64}k", "-ar", sample_rate, "-f", "ogg"]
+    raise ValueError(f"Unsupported output_format: {output_format}")
+
+def elevenlabs_audio_stream(parts, voice, speed, deadline, watch, work):
+    """Edge mp3 chunks for each text part in turn; stops once the client has disconnected."""
+    for part in parts:
+        with closing(generate_speech_stream(part, voice, speed, 0, deadline, work)) as chunks:
+            for chunk in chunks:
+                watch.check()
+                yield chunk
+
+class StartedStream:
+    """A chunk stream whose first chunk has already been read; closing it closes the stream."""
+
+    def __init__(self, first, chunks):
+        self._first = first
+        self._chunks = chunks
+        # Iterated after the request context is gone
+        self._log_context = {"request_id": request_id()}
+
+    def __iter__(self):
+        yield self._first
+        try:
+            yield from self._chunks
+        except ClientDisconnected:
+            log.info("ElevenLabs stream client disconnected; stopping synthesis", extra=self._log_context)
+            metrics.CLIENT_DISCONNECTS.inc(backend='edge')
+        except DeadlineExceeded as e:
+            log.warning("ElevenLabs stream abandoned: %s", e, extra=self._log_context)
+            metrics.DEADLINES_EXCEEDED.inc(backend='edge')
+        except Exception as e:
+            # The status line is gone; all that can be done is to end the audio early
+            log.error("Error during ElevenLabs streaming: %s", e, extra=self._log_context)
+
+    def close(self):
+        self._chunks.close()
+
+# http://localhost:5050/v1/text-to-speech/en-US-AndrewNeural/stream (ElevenLabs SDK base URL)
+@app.route('/v1/text-to-speech/<voice_id>/stream', methods=['POST'])
+@app.route('/elevenlabs/v1/text-to-speech/<voice_id>/stream', methods=['POST'])
 @require_api_key
-def azure_tts():
+def elevenlabs_tts_stream(voice_id):
+    """
+    ElevenLabs streaming endpoint: audio bytes are sent as edge-tts produces them. With
+    optimize_streaming_latency the text's first sentence or clause is synthesized on its own,
+    so the first audio comes back sooner; output_format other than mp3 is converted by FFmpeg.
+    """
     if not EXPAND_API:
         return jsonify({"error": f"Endpoint not allowed"}), 500
-    
-    # Parse the SSML payload
+
+    payload = request.get_json(silent=True)
+    if not payload or not isinstance(payload.get('text'), str) or not payload['text'].strip():
+        return jsonify({"error": "Missing 'text' in request body"}), 400
+    try:
+        latency = int(request.args.get('optimize_streaming_latency', 0))
+        if latency not in FIRST_CHUNK_CHARS:
+            raise ValueError
+    except ValueError:
+        return jsonify({"error": "optimize_streaming_latency must be an integer from 0 to 4"}), 400
     try:
-        ssml_data = request.data.decode('utf-8')
-        if not ssml_data:
-            return jsonify({"error": "Missing SSML payload"}), 400
-
-        # Extract the text and voice from SSML
-        from xml.etree import ElementTree as ET
-        root = ET.fromstring(ssml_data)
-        text = root.find('.//{http://www.w3.org/2001/10/synthesis}voice').text
-        voice = root.find('.//{http://www.w3.org/2001/10/synthesis}voice').get('name')
+        mimetype, output_args = elevenlabs_output(request.args.get('output_format', ELEVENLABS_OUTPUT_FORMAT))
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    if output_args is not None and not is_ffmpeg_installed():
+        return jsonify({"error": "This output_format needs FFmpeg, which is not installed; use an mp3 format"}), 400
+
+    voice_settings = payload.get('voice_settings') or {}
+    try:
+        speed = float(voice_settings.get('speed', DEFAULT_SPEED))
+    except (TypeError, ValueError):
+        return jsonify({"error": "voice_settings.speed must be a number"}), 400
+
+    text = payload['text']
+    if not REMOVE_FILTER and latency < 4:
+        text = prepare_tts_input_with_context(text)
+    parts = [text]
+    if FIRST_CHUNK_CHARS[latency]:
+        parts = [part for part in split_first_chunk(text, FIRST_CHUNK_CHARS[latency]) if part]
+
+    # The stream outlives the request context, so it takes these now
+    deadline = current_deadline(route_timeout(True))
+    chunks = elevenlabs_audio_stream(parts, voice_id, speed, deadline, watch_client(), current_work())
+    if output_args is not None:
+        chunks = transcode_stream(chunks, output_args)
+
+    # Read the first chunk here, so a request that fails outright gets an error status. Every
+    # early return closes the stream, which stops FFmpeg and its feeder thread when transcoding.
+    try:
+        first = next(chunks)
+    except StopIteration:
+        chunks.close()
+        return jsonify({"error": "TTS generation produced no audio"}), 500
+    except DeadlineExceeded as e:
+        chunks.close()
+        metrics.DEADLINES_EXCEEDED.inc(backend='edge')
+        return jsonify({"error": str(e), "code": "deadline_exceeded"}), 504
     except Exception as e:
-        return jsonify({"error": f"Invalid SSML payload: {str(e)}"}), 400
+        chunks.close()
+        return jsonify({"error": f"TTS generation failed: {str(e)}"}), 500
+    except BaseException:
+        chunks.close()
+        raise
+
+    return Response(StartedStream(first, chunks), mimetype=mimetype, headers={
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no',
+    })
+
+
+def synthesize_edge_segment(segment, deadline, work):
+    """mp3 audio of one SSML segment on edge-tts, with the segment's prosody."""
+    with closing(generate_speech_stream(segment.text, segment.voice, deadline=deadline, work=work,
+                                        prosody=segment.prosody)) as chunks:
+        return b''.join(chunks)
+
+def ssml_backend(voice):
+    # OpenAI names are mapped to edge voices; otherwise the voice decides, as for /v1/audio/speech
+    return 'edge' if voice in voice_mapping else backend_for(voice)
+
+def ssml_speech(synthesizers):
+    """
+    Synthesizes the request's SSML document as one mp3. Each segment goes to
+    synthesizers[backend](segment, deadline, work); segments run concurrently.
+    """
+    if not EXPAND_API:
+        return jsonify({"error": f"Endpoint not allowed"}), 500
 
-    # Use default settings for edge-tts
-    response_format = 'mp3'
-    speed = DEFAULT_SPEED
+    timer = current_timer()
+    ssml_data = request.get_data(as_text=True)
+    if not ssml_data:
+        return jsonify({"error": "Missing SSML payload"}), 400
+    try:
+        with timer.phase('parse'):
+            pieces = parse_ssml(ssml_data, DEFAULT_VOICE)
+    except SSMLError as e:
+        return jsonify({"error": f"Invalid SSML payload: {str(e)}"}), 400
 
     if not REMOVE_FILTER:
-        text = prepare_tts_input_with_context(text)
+        with timer.phase('clean'):
+            for piece in pieces:
+                if isinstance(piece, Segment):
+                    piece.text = prepare_tts_input_with_context(piece.text)
+    pieces = [piece for piece in pieces if not isinstance(piece, Segment) or piece.text]
+    for piece in pieces:
+        if isinstance(piece, Segment) and ssml_backend(piece.voice) not in synthesizers:
+            return jsonify({"error": f"Voice '{piece.voice}' is not available on this endpoint"}), 400
+    if not any(isinstance(piece, Segment) for piece in pieces):
+        return jsonify({"error": "Invalid SSML payload: no text left to synthesize"}), 400
+
+    # Segments are synthesized on pool threads, outside the request context
+    deadline = current_deadline(route_timeout(False))
+    work = current_work()
+
+    def synthesize(segment):
+        return synthesizers[ssml_backend(segment.voice)](segment, deadline, work)
 
-    # Generate speech using edge-tts
     try:
-        output_file_path = generate_speech(text, voice, response_format, speed)
+        with timer.phase('synthesis'):
+            audio = render(pieces, synthesize)
+    except DeadlineExceeded as e:
+        log.warning("SSML synthesis abandoned: %s", e)
+        metrics.DEADLINES_EXCEEDED.inc(backend='edge')
+        return jsonify({"error": str(e), "code": "deadline_exceeded"}), 504
     except Exception as e:
         return jsonify({"error": f"TTS generation failed: {str(e)}"}), 500
 
-    # Return the generated audio file
-    return send_file(output_file_path, mimetype="audio/mpeg", as_attachment=True, download_name="speech.mp3")
+    return Response(audio, mimetype="audio/mpeg", headers={
+        'Content-Disposition': 'attachment; filename=speech.mp3',
+        'Server-Timing': timer.header(),
+    })
+
+# tts.speech.microsoft.com/cognitiveservices/v1
+# https://{region}.tts.speech.microsoft.com/cognitiveservices/v1
+# http://localhost:5050/azure/cognitiveservices/v1
+@app.route('/azure/cognitiveservices/v1', methods=['POST'])
+@require_api_key
+def azure_tts():
+    # Every <voice>, <prosody> and <break> of the document is honoured; this server has edge voices only
+    return ssml_speech({'edge': synthesize_edge_segment})
 
 print(f" Edge TTS (Free Azure TTS) Replacement for OpenAI's TTS API")
 print(f" ")
@@ -274,5 +485,6 @@ print(f" * TTS Endpoint: http://localhost:{PORT}/v1/audio/speech")
 print(f" ")
 
 if __name__ == '__main__':
+    from gevent.pywsgi import WSGIServer
     http_server = WSGIServer(('0.0.0.0', PORT), app)
     http_server.serve_forever()
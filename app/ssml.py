@@ -0,0 +1,203 @@
+# ssml.py
+
+"""
+SSML documents for the Azure-compatible endpoint.
+
+parse_ssml() turns a whole <speak> document into an ordered list of Segment
+(text in one voice with its prosody) and Pause (silence from <break>):
+
+- every <voice> block keeps its own voice; text outside any voice uses the
+  default voice
+- <prosody> rate, pitch and volume are converted to edge-tts's relative
+  strings ("+20%", "-10Hz", "+0%"); nested prosody overrides what it sets
+- <break> takes its time ("500ms", "1.5s") or strength; <sub> reads its alias
+- other elements (p, s, emphasis, say-as, lang, mstts:express-as, ...) are
+  read for their text; bookmarks, audio and metadata are skipped
+
+render() synthesizes the segments concurrently, at most max_parallel at a
+time, and joins the audio in document order, so a dialogue takes about as
+long as its longest line rather than the sum of all lines. Pauses are made
+of silent mp3 frames in edge's output format.
+"""
+
+import os
+import re
+from concurrent.futures import ThreadPoolExecutor
+from xml.etree import ElementTree as ET
+
+from config import DEFAULT_CONFIGS
+from logs import get_logger
+
+log = get_logger('ssml')
+
+SSML_MAX_PARALLEL = int(os.getenv('SSML_MAX_PARALLEL', str(DEFAULT_CONFIGS["SSML_MAX_PARALLEL"])))
+
+# One silent MPEG-2 Layer III frame (24 kHz, 48 kbps, mono, as edge sends): 576 samples, 24 ms
+SILENT_MP3_FRAME = b'\xff\xf3\x64\xc0' + bytes(140)
+SILENT_FRAME_MS = 24
+
+# As Azure: a <break> without time or strength is medium, and no break is longer than this
+BREAK_STRENGTHS = {'none': 0, 'x-weak': 250, 'weak': 500, 'medium': 750, 'strong': 1000, 'x-strong': 1250}
+MAX_BREAK_MS = 5000
+
+RATE_KEYWORDS = {'x-slow': '-50%', 'slow': '-25%', 'medium': '+0%', 'fast': '+25%', 'x-fast': '+50%', 'default': '+0%'}
+PITCH_KEYWORDS = {'x-low': '-50Hz', 'low': '-25Hz', 'medium': '+0Hz', 'high': '+25Hz', 'x-high': '+50Hz', 'default': '+0Hz'}
+VOLUME_KEYWORDS = {'silent': '-100%', 'x-soft': '-50%', 'soft': '-25%', 'medium': '+0%', 'loud': '+25%',
+                   'x-loud': '+50%', 'default': '+0%'}
+
+# Elements whose content is not spoken
+SKIPPED = {'audio', 'bookmark', 'mark', 'metadata', 'lexicon', 'backgroundaudio', 'desc'}
+
+class SSMLError(ValueError):
+    """The payload is not an SSML document this endpoint can synthesize."""
+
+class Segment:
+    """Text spoken in one voice with edge-tts prosody strings (rate, pitch, volume)."""
+
+    def __init__(self, voice, text, prosody):
+        self.voice = voice
+        self.text = text
+        self.prosody = prosody
+
+    def __repr__(self):
+        return f"Segment({self.voice!r}, {self.text!r}, {self.prosody!r})"
+
+class Pause:
+    """Silence of the given length from a <break>."""
+
+    def __init__(self, milliseconds):
+        self.milliseconds = milliseconds
+
+    def __repr__(self):
+        return f"Pause({self.milliseconds})"
+
+def _local(tag):
+    """The element name without its namespace ({http://www.w3.org/2001/10/synthesis}voice -> voice)."""
+    return tag.rsplit('}', 1)[-1] if isinstance(tag, str) else ''
+
+def _relative(value, keywords, unit):
+    """A prosody attribute as an edge-tts relative string, or None if it cannot be expressed."""
+    value = value.strip().lower()
+    if value in keywords:
+        return keywords[value]
+    match = re.fullmatch(r'([+-]?)(\d+(?:\.\d+)?)(%|hz)?', value)
+    if not match:
+        return None
+    sign, number, suffix = match.groups()
+    number = float(number)
+    if (suffix or '') != unit.lower():
+        if unit == '%' and not suffix and not sign:
+            # A bare number: a multiplier for rate ("1.5"), an absolute 0-100 level for volume ("80")
+            number = (number - 1) * 100 if keywords is RATE_KEYWORDS else number - 100
+            return f"{number:+.0f}%"
+        return None
+    return f"{-number if sign == '-' else number:+.0f}{'%' if unit == '%' else 'Hz'}"
+
+def _prosody(element):
+    prosody = {}
+    for name, keywords, unit in (('rate', RATE_KEYWORDS, '%'), ('pitch', PITCH_KEYWORDS, 'Hz'),
+                                 ('volume', VOLUME_KEYWORDS, '%')):
+        value = element.get(name)
+        if value is None:
+            continue
+        converted = _relative(value, keywords, unit)
+        if converted is None:
+            log.warning("Ignoring unsupported SSML prosody %s=%r", name, value)
+            continue
+        prosody[name] = converted
+    return prosody
+
+def _break_ms(element):
+    time_value = element.get('time')
+    if time_value is not None:
+        match = re.fullmatch(r'\s*(\d+(?:\.\d+)?)\s*(ms|s)\s*', time_value.lower())
+        if not match:
+            raise SSMLError(f"Invalid break time: {time_value!r}")
+        milliseconds = float(match.group(1)) * (1000 if match.group(2) == 's' else 1)
+    else:
+        strength = (element.get('strength') or 'medium').lower()
+        if strength not in BREAK_STRENGTHS:
+            raise SSMLError(f"Invalid break strength: {strength!r}")
+        milliseconds = BREAK_STRENGTHS[strength]
+    return int(min(milliseconds, MAX_BREAK_MS))
+
+def _walk(element, voice, prosody, pieces):
+    tag = _local(element.tag)
+    if tag in SKIPPED:
+        return
+    if tag == 'voice':
+        voice = element.get('name') or voice
+    elif tag == 'prosody':
+        prosody = {**prosody, **_prosody(element)}
+    elif tag == 'break':
+        pieces.append(Pause(_break_ms(element)))
+        return
+    elif tag == 'sub':
+        pieces.append(Segment(voice, element.get('alias') or ''.join(element.itertext()), prosody))
+        return
+    if element.text:
+        pieces.append(Segment(voice, element.text, prosody))
+    for child in element:
+        _walk(child, voice, prosody, pieces)
+        if child.tail:
+            pieces.append(Segment(voice, child.tail, prosody))
+
+def parse_ssml(document, default_voice):
+    """
+    The ordered segments and pauses of an SSML document; adjacent text in the same voice and
+    prosody is one segment. Raises SSMLError if the document is malformed or says nothing.
+    """
+    try:
+        root = ET.fromstring(document)
+    except ET.ParseError as e:
+        raise SSMLError(f"Invalid SSML: {e}") from e
+    if _local(root.tag) != 'speak':
+        raise SSMLError("SSML root element must be <speak>")
+
+    pieces = []
+    _walk(root, default_voice, {}, pieces)
+
+    result = []
+    for piece in pieces:
+        last = result[-1] if result else None
+        if isinstance(piece, Pause):
+            if isinstance(last, Pause):
+                last.milliseconds = min(last.milliseconds + piece.milliseconds, MAX_BREAK_MS)
+            elif piece.milliseconds:
+                result.append(piece)
+            continue
+        if not piece.text.strip():
+            if isinstance(last, Segment):
+                last.text += piece.text  # a space between words; indentation is collapsed below
+            continue
+        if isinstance(last, Segment) and last.voice == piece.voice and last.prosody == piece.prosody:
+            last.text += piece.text
+        else:
+            result.append(Segment(piece.voice, piece.text, piece.prosody))
+    for piece in result:
+        if isinstance(piece, Segment):
+            piece.text = ' '.join(piece.text.split())
+    if not any(isinstance(piece, Segment) for piece in result):
+        raise SSMLError("SSML contains no text to synthesize")
+    return result
+
+def silence(milliseconds):
+    """mp3 silence of about the given length."""
+    return SILENT_MP3_FRAME * round(milliseconds / SILENT_FRAME_MS)
+
+def render(pieces, synthesize, max_parallel=SSML_MAX_PARALLEL):
+    """
+    mp3 audio of parsed SSML: synthesize(segment) -> bytes runs for every segment concurrently,
+    and the results are joined in document order. The first failure is raised; segments not
+    yet started are then cancelled.
+    """
+    segments = [piece for piece in pieces if isinstance(piece, Segment)]
+    executor = ThreadPoolExecutor(max_workers=max(1, min(max_parallel, len(segments))), thread_name_prefix='ssml')
+    try:
+        futures = {id(segment): executor.submit(synthesize, segment) for segment in segments}
+        return b''.join(
+            silence(piece.milliseconds) if isinstance(piece, Pause) else futures[id(piece)].result()
+            for piece in pieces
+        )
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
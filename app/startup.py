@@ -0,0 +1,159 @@
+# startup.py
+
+"""
+Startup profiling and backend readiness.
+
+The profile records how long each import and init step takes so cold start
+can be kept under a budget. Backends that need slow work (network calls,
+heavy imports) warm up on a background thread instead of blocking startup;
+their readiness is tracked here and reported separately from liveness.
+
+Under the pre-fork launcher (prefork.py) the app is imported once in the
+parent and its workers are forked from it. Threads, event loops and database
+connections do not survive a fork, so setup that creates them is registered
+with per_process() and runs in each worker after it forks.
+"""
+
+import threading
+import time
+from contextlib import contextmanager
+
+# Readiness states
+PENDING = 'pending'
+READY = 'ready'
+FAILED = 'failed'
+
+class StartupProfile:
+    def __init__(self):
+        self._start = time.perf_counter()
+        self._ready_at = None
+        self._steps = []
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def step(self, name, background=False):
+        """Times the with-block as one startup step, including when it raises."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            with self._lock:
+                self._steps.append((name, (time.perf_counter() - start) * 1000.0, background))
+
+    def mark_serving(self):
+        """Marks the point where the server can accept requests; this is the cold start time."""
+        with self._lock:
+            if self._ready_at is None:
+                self._ready_at = time.perf_counter()
+
+    def summary(self):
+        with self._lock:
+            steps = list(self._steps)
+            end = self._ready_at or time.perf_counter()
+        return {
+            "steps": [
+                {"name": name, "duration_ms": round(duration, 1), **({"background": True} if background else {})}
+                for name, duration, background in steps
+            ],
+            "cold_start_ms": round((end - self._start) * 1000.0, 1),
+        }
+
+    def report(self, budget_ms=None):
+        """Formats the steps as a table, flagging the cold start when it is over budget."""
+        summary = self.summary()
+        lines = ["Startup timing:"]
+        for step in summary["steps"]:
+            suffix = "  (background)" if step.get("background") else ""
+            lines.append(f"  {step['name']:<36} {step['duration_ms']:>8.1f} ms{suffix}")
+        total = f"  {'cold start':<36} {summary['cold_start_ms']:>8.1f} ms"
+        if budget_ms and summary["cold_start_ms"] > budget_ms:
+            total += f"  (over the {budget_ms:.0f} ms budget)"
+        lines.append(total)
+        return '\n'.join(lines)
+
+class Readiness:
+    """Per-component readiness, updated by the warm-up thread and read by probes."""
+
+    def __init__(self):
+        self._states = {}
+        self._lock = threading.Lock()
+
+    def set(self, component, state, detail=None):
+        with self._lock:
+            self._states[component] = {"state": state, **({"detail": detail} if detail else {})}
+
+    def snapshot(self):
+        with self._lock:
+            return {component: dict(state) for component, state in self._states.items()}
+
+    def is_ready(self):
+        with self._lock:
+            return all(state["state"] == READY for state in self._states.values())
+
+profile = StartupProfile()
+readiness = Readiness()
+
+# Set by the pre-fork launcher before it imports the app
+prefork = False
+# This process's worker slot (0..N-1) under the pre-fork launcher; None in the parent or a single process
+worker_slot = None
+
+_per_process = []
+_warm_up_tasks = []
+
+def per_process(func):
+    """Runs func now, or in every worker once it has forked when the pre-fork launcher is preloading the app."""
+    if prefork and worker_slot is None:
+        _per_process.append(func)
+    else:
+        func()
+
+def start_worker(slot):
+    """Per-process setup for a freshly forked worker; called by the pre-fork launcher in the child."""
+    global worker_slot
+    worker_slot = slot
+    # Warm-ups still retrying in the parent lost their threads in the fork
+    unfinished = [(component, func) for component, func in _warm_up_tasks
+                  if readiness.snapshot().get(component, {}).get("state") != READY]
+    if unfinished:
+        warm_up(unfinished)
+    for func in _per_process:
+        func()
+
+def warm_up(tasks, retry_delay=5.0, max_retry_delay=60.0):
+    """
+    Runs each (component, func) warm-up task on its own daemon thread.
+
+    A component is pending until its func returns truthy, which marks it ready.
+    A falsy return or an exception marks it failed and the task is retried with
+    exponential backoff, so a backend that was down at boot becomes ready later.
+    """
+    def run(component, func):
+        delay = retry_delay
+        attempt = 1
+        while True:
+            try:
+                name = f"warm up {component}" + (f" (attempt {attempt})" if attempt > 1 else "")
+                with profile.step(name, background=True):
+                    ok = func()
+                error = None if ok else "warm-up returned no data"
+            except Exception as e:
+                error = str(e)
+            if error is None:
+                readiness.set(component, READY)
+                return
+            print(f"Warm-up of {component} failed: {error}; retrying in {delay:.0f}s")
+            readiness.set(component, FAILED, error)
+            time.sleep(delay)
+            delay = min(delay * 2, max_retry_delay)
+            attempt += 1
+
+    threads = []
+    for component, func in tasks:
+        if worker_slot is None:
+            _warm_up_tasks.append((component, func))
+        readiness.set(component, PENDING)
+        thread = threading.Thread(target=run, args=(component, func), name=f'warm-up-{component}', daemon=True)
+        thread.start()
+        threads.append(thread)
+    return threads
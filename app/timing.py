@@ -0,0 +1,81 @@
+# timing.py
+
+"""
+Per-request phase timing, reported as a Server-Timing header on buffered
+responses and as a summary in the final SSE event of streamed ones.
+"""
+
+import threading
+import time
+from contextlib import contextmanager
+
+from flask import g, has_request_context
+
+class PhaseTimer:
+    def __init__(self):
+        self._start = time.perf_counter()
+        self._phases = []
+        self._lock = threading.Lock()
+
+    def record(self, name, seconds, desc=None):
+        with self._lock:
+            self._phases.append((name, seconds * 1000.0, desc))
+
+    @contextmanager
+    def phase(self, name, desc=None):
+        """Times the with-block as one phase, including when it raises."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, time.perf_counter() - start, desc)
+
+    def summary(self):
+        """Returns the recorded phases as a list of dicts, plus the elapsed total."""
+        with self._lock:
+            phases = list(self._phases)
+        entries = [
+            {"name": name, "duration_ms": round(duration, 2), **({"description": desc} if desc else {})}
+            for name, duration, desc in phases
+        ]
+        entries.append({"name": "total", "duration_ms": round((time.perf_counter() - self._start) * 1000.0, 2)})
+        return entries
+
+    def header(self):
+        """
+        Formats the phases as a Server-Timing header value. A phase recorded more than once
+        (e.g. upstream, once per sentence) is one entry with the summed duration, described by
+        its count and longest duration, so the header stays small however long the text is;
+        summary() keeps every entry.
+        """
+        groups = {}
+        for entry in self.summary():
+            groups.setdefault(entry['name'], []).append(entry)
+        parts = []
+        for name, entries in groups.items():
+            if len(entries) == 1:
+                part = f"{name};dur={entries[0]['duration_ms']}"
+                desc = entries[0].get('description')
+            else:
+                durations = [entry['duration_ms'] for entry in entries]
+                part = f"{name};dur={round(sum(durations), 2)}"
+                desc = f"{len(entries)}x, max {max(durations)}ms"
+            if desc:
+                part += ';desc="' + desc.replace('\\', '').replace('"', '') + '"'
+            parts.append(part)
+        return ', '.join(parts)
+
+class _NullTimer(PhaseTimer):
+    """Discards everything; used when code runs outside a request (CLI, background workers)."""
+
+    def record(self, name, seconds, desc=None):
+        pass
+
+def current_timer():
+    """Returns the timer bound to the current request, creating it on first use."""
+    if not has_request_context():
+        return _NullTimer()
+    timer = g.get('phase_timer')
+    if timer is None:
+        timer = g.phase_timer = PhaseTimer()
+    return timer
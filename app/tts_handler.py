@@ -1,18 +1,86 @@
 # tts_handler.py
 
-import edge_tts
 import asyncio
-import tempfile
+import contextlib
+import json
+import math
 import subprocess
 import os
-from pathlib import Path
+import threading
+import time
 
 from utils import DETAILED_ERROR_LOGGING
 from config import DEFAULT_CONFIGS
+from breaker import get_breaker
+from deadline import DeadlineExceeded, UPSTREAM_TIMEOUT, current_deadline
+from disk_cache import get_disk_cache
+from scheduler import current_work, get_scheduler
+from scratch import get_scratch
+from metrics import UPSTREAM_LATENCY, UPSTREAM_ERRORS, FFMPEG_DURATION
+from timing import current_timer
+from logs import get_logger
+
+log = get_logger('edge.tts')
 
 # Language default (environment variable)
 DEFAULT_LANGUAGE = os.getenv('DEFAULT_LANGUAGE', DEFAULT_CONFIGS["DEFAULT_LANGUAGE"])
 
+# Optional upstream overrides, e.g. to point at local stand-ins during load tests.
+EDGE_TTS_WSS_URL = os.getenv('EDGE_TTS_WSS_URL')
+EDGE_TTS_VOICE_LIST_URL = os.getenv('EDGE_TTS_VOICE_LIST_URL')
+
+_edge_tts = None
+_edge_tts_lock = threading.Lock()
+
+def load_edge_tts():
+    """Imports edge-tts on first use, since it (with aiohttp) is the slowest import at startup."""
+    global _edge_tts
+    if _edge_tts is None:
+        with _edge_tts_lock:
+            if _edge_tts is None:
+                import edge_tts
+                # edge-tts has no setting for these, so the module-level URLs it reads are replaced
+                if EDGE_TTS_WSS_URL:
+                    edge_tts.communicate.WSS_URL = EDGE_TTS_WSS_URL
+                if EDGE_TTS_VOICE_LIST_URL:
+                    edge_tts.voices.VOICE_LIST = EDGE_TTS_VOICE_LIST_URL
+                _edge_tts = edge_tts
+    return _edge_tts
+
+EDGE_WS_POOL_SIZE = int(os.getenv('EDGE_WS_POOL_SIZE', str(DEFAULT_CONFIGS["EDGE_WS_POOL_SIZE"])))
+EDGE_WS_MAX_IDLE = float(os.getenv('EDGE_WS_MAX_IDLE', str(DEFAULT_CONFIGS["EDGE_WS_MAX_IDLE"])))
+EDGE_WS_MAX_AGE = float(os.getenv('EDGE_WS_MAX_AGE', str(DEFAULT_CONFIGS["EDGE_WS_MAX_AGE"])))
+EDGE_WS_HEARTBEAT = float(os.getenv('EDGE_WS_HEARTBEAT', str(DEFAULT_CONFIGS["EDGE_WS_HEARTBEAT"])))
+
+# The edge voice list is kept in the shared disk cache, so workers and restarts fetch it once per TTL
+VOICE_LIST_TTL = float(os.getenv('VOICE_LIST_TTL', str(DEFAULT_CONFIGS["VOICE_LIST_TTL"])))
+VOICE_LIST_KEY = 'edge-voice-list'
+
+_edge_pool = None
+_edge_pool_unavailable = False
+
+def get_edge_pool():
+    """
+    The pooled websocket client for edge-tts, or None when pooling is disabled or the
+    installed edge-tts lacks the internals the pool relies on (then Communicate is used).
+    """
+    global _edge_pool, _edge_pool_unavailable
+    if EDGE_WS_POOL_SIZE <= 0 or _edge_pool_unavailable:
+        return None
+    if _edge_pool is None:
+        load_edge_tts()
+        with _edge_tts_lock:
+            if _edge_pool is None and not _edge_pool_unavailable:
+                try:
+                    from edge_pool import EdgeSessionPool
+                except (ImportError, AttributeError) as e:
+                    log.warning("edge-tts %s is not supported by the websocket pool (%s); using unpooled connections",
+                                getattr(load_edge_tts(), '__version__', '?'), e)
+                    _edge_pool_unavailable = True
+                    return None
+                _edge_pool = EdgeSessionPool(EDGE_WS_POOL_SIZE, EDGE_WS_MAX_IDLE, EDGE_WS_MAX_AGE, EDGE_WS_HEARTBEAT)
+    return _edge_pool
+
 # OpenAI voice names mapped to edge-tts equivalents
 voice_mapping = {
     'alloy': 'zh-CN-XiaoxiaoNeural',    # 中文女声 (晓晓)
@@ -42,98 +110,173 @@ def is_ffmpeg_installed():
     except (subprocess.CalledProcessError, FileNotFoundError):
         return False
 
-async def _generate_audio_stream(text, voice, speed, pitch=0):
-    """Generate streaming TTS audio using edge-tts."""
+def _communicate_kwargs(text, voice, speed, pitch):
+    """Keyword arguments for edge_tts.Communicate (and the session pool) for an API request."""
     # Determine if the voice is an OpenAI-compatible voice or a direct edge-tts voice
     edge_tts_voice = voice_mapping.get(voice, voice)  # Use mapping if in OpenAI names, otherwise use as-is
-    
-    # Prepare kwargs for edge_tts.Communicate
+
     communicate_kwargs = {"text": text, "voice": edge_tts_voice}
-    
+
     # Only add rate if speed is not default (1.0)
     if speed != 1.0:
         try:
             speed_rate = speed_to_rate(speed)  # Convert speed value to "+X%" or "-X%"
             communicate_kwargs["rate"] = speed_rate
         except Exception as e:
-            print(f"Error converting speed: {e}. Speed will not be adjusted.")
-    
+            log.warning("Error converting speed: %s. Speed will not be adjusted.", e)
+
     # Always add pitch (converted to Hz format)
     try:
         pitch_value = pitch_to_pitch(pitch)  # Convert pitch value to Hz format
         communicate_kwargs["pitch"] = pitch_value
     except Exception as e:
-        print(f"Error converting pitch: {e}. Pitch will not be adjusted.")
-    
+        log.warning("Error converting pitch: %s. Pitch will not be adjusted.", e)
+
+    return communicate_kwargs
+
+def _socket_timeouts(deadline):
+    """connect/receive timeouts (whole seconds, as edge-tts requires) for a Communicate within the deadline."""
+    seconds = max(1, math.ceil(deadline.timeout(UPSTREAM_TIMEOUT)))
+    return {"connect_timeout": min(seconds, 10), "receive_timeout": seconds}
+
+async def _generate_audio_stream(communicate_kwargs, deadline):
+    """Generate streaming TTS audio using edge-tts."""
     # Create the communicator for streaming
-    communicator = edge_tts.Communicate(**communicate_kwargs)
+    communicator = load_edge_tts().Communicate(**communicate_kwargs, **_socket_timeouts(deadline))
     
     # Stream the audio data
-    async for chunk in communicator.stream():
-        if chunk["type"] == "audio":
-            yield chunk["data"]
+    start = time.perf_counter()
+    try:
+        # aclosing: an abandoned stream closes the websocket now rather than at garbage collection
+        async with contextlib.aclosing(communicator.stream()) as chunks:
+            async for chunk in chunks:
+                if chunk["type"] == "audio":
+                    yield chunk["data"]
+    except Exception:
+        UPSTREAM_ERRORS.inc(upstream="edge")
+        get_breaker('edge').record_failure()
+        raise
+    else:
+        get_breaker('edge').record_success()
+    finally:
+        UPSTREAM_LATENCY.observe(time.perf_counter() - start, upstream="edge")
+
+def _pooled_audio_stream(pool, communicate_kwargs, deadline):
+    """Streaming TTS audio over a pooled edge-tts websocket session."""
+    start = time.perf_counter()
+    try:
+        yield from pool.stream(**communicate_kwargs, deadline=deadline)
+    except DeadlineExceeded:
+        raise
+    except Exception:
+        UPSTREAM_ERRORS.inc(upstream="edge")
+        get_breaker('edge').record_failure()
+        raise
+    else:
+        get_breaker('edge').record_success()
+    finally:
+        UPSTREAM_LATENCY.observe(time.perf_counter() - start, upstream="edge")
+
+def generate_speech_stream(text, voice, speed=1.0, pitch=0, deadline=None, work=None, prosody=None):
+    """
+    Generate streaming speech audio (synchronous wrapper). Stops with DeadlineExceeded once the
+    deadline (by default the current request's) has passed. The stream holds an upstream
+    scheduler slot for work (by default the current request's) until it ends. prosody, if
+    given, holds edge-tts rate/pitch/volume strings (e.g. from SSML) that replace speed and pitch.
+    """
+    deadline = deadline or current_deadline()
+    communicate_kwargs = {**_communicate_kwargs(text, voice, speed, pitch), **(prosody or {})}
+    with get_scheduler('edge').slot(work or current_work(), deadline):
+        yield from _speech_stream(communicate_kwargs, deadline)
+
+def _speech_stream(communicate_kwargs, deadline):
+    pool = get_edge_pool()
+    if pool is not None:
+        yield from _pooled_audio_stream(pool, communicate_kwargs, deadline)
+        return
 
-def generate_speech_stream(text, voice, speed=1.0, pitch=0):
-    """Generate streaming speech audio (synchronous wrapper)."""
     loop = asyncio.new_event_loop()
     asyncio.set_event_loop(loop)
-    gen = _generate_audio_stream(text, voice, speed, pitch)
+    gen = _generate_audio_stream(communicate_kwargs, deadline)
 
     try:
         while True:
             try:
-                chunk = loop.run_until_complete(gen.__anext__())
+                chunk = loop.run_until_complete(asyncio.wait_for(gen.__anext__(), deadline.timeout()))
                 yield chunk
             except StopAsyncIteration:
                 break
+            except asyncio.TimeoutError:
+                if not deadline.reached():
+                    raise  # edge-tts's own socket timeout
+                raise deadline.exceeded()
     finally:
-        loop.close()
-
-async def _generate_audio(text, voice, response_format, speed, pitch=0):
+        # Closed early (e.g. the client disconnected): finish the generator on its own loop
+        # so edge-tts releases its websocket before the loop goes away
+        try:
+            loop.run_until_complete(gen.aclose())
+            loop.run_until_complete(loop.shutdown_asyncgens())
+            # edge-tts's inner generators are finalized on tasks of their own
+            pending = asyncio.all_tasks(loop)
+            if pending:
+                loop.run_until_complete(asyncio.gather(*pending, return_exceptions=True))
+        finally:
+            loop.close()
+
+async def _generate_audio(text, voice, response_format, speed, pitch, deadline):
     """Generate TTS audio and optionally convert to a different format."""
-    # Determine if the voice is an OpenAI-compatible voice or a direct edge-tts voice
-    edge_tts_voice = voice_mapping.get(voice, voice)  # Use mapping if in OpenAI names, otherwise use as-is
-
     # Generate the TTS output in mp3 format first
-    temp_mp3_file_obj = tempfile.NamedTemporaryFile(delete=False, suffix=".mp3")
-    temp_mp3_path = temp_mp3_file_obj.name
+    temp_mp3_path = get_scratch().new_file(".mp3")
 
-    # Prepare kwargs for edge_tts.Communicate
-    communicate_kwargs = {"text": text, "voice": edge_tts_voice}
-    
-    # Only add rate if speed is not default (1.0)
-    if speed != 1.0:
-        try:
-            speed_rate = speed_to_rate(speed)  # Convert speed value to "+X%" or "-X%"
-            communicate_kwargs["rate"] = speed_rate
-        except Exception as e:
-            print(f"Error converting speed: {e}. Speed will not be adjusted.")
+    communicate_kwargs = _communicate_kwargs(text, voice, speed, pitch)
 
-    # Always add pitch (converted to Hz format)
+    # Generate the MP3 file, over a warm pooled session when pooling is enabled
+    pool = get_edge_pool()
     try:
-        pitch_value = pitch_to_pitch(pitch)  # Convert pitch value to Hz format
-        communicate_kwargs["pitch"] = pitch_value
-    except Exception as e:
-        print(f"Error converting pitch: {e}. Pitch will not be adjusted.")
-
-    # Generate the MP3 file
-    communicator = edge_tts.Communicate(**communicate_kwargs)
-    await communicator.save(temp_mp3_path)
-    temp_mp3_file_obj.close() # Explicitly close our file object for the initial mp3
+        with UPSTREAM_LATENCY.time(upstream="edge"), current_timer().phase('upstream'):
+            if pool is not None:
+                synthesis = asyncio.wrap_future(pool.submit(**communicate_kwargs))
+            else:
+                synthesis = load_edge_tts().Communicate(**communicate_kwargs, **_socket_timeouts(deadline)).save(temp_mp3_path)
+            try:
+                audio = await asyncio.wait_for(synthesis, deadline.timeout())
+            except asyncio.TimeoutError:
+                if not deadline.reached():
+                    raise  # edge-tts's own socket timeout
+                raise deadline.exceeded()
+            if pool is not None:
+                with open(temp_mp3_path, 'wb') as f:
+                    f.write(audio)
+    except DeadlineExceeded:
+        get_scratch().release(temp_mp3_path)
+        raise
+    except Exception:
+        get_scratch().release(temp_mp3_path)
+        UPSTREAM_ERRORS.inc(upstream="edge")
+        get_breaker('edge').record_failure()
+        raise
+    get_breaker('edge').record_success()
+    get_scratch().written(temp_mp3_path)
 
     # If the requested format is mp3, return the generated file directly
     if response_format == "mp3":
         return temp_mp3_path
 
+    return convert_audio_file(temp_mp3_path, response_format)
+
+def convert_audio_file(temp_mp3_path, response_format):
+    """Converts an mp3 file to response_format with FFmpeg, removing the mp3. Returns the output path."""
     # Check if FFmpeg is installed
     if not is_ffmpeg_installed():
-        print("FFmpeg is not available. Returning unmodified mp3 file.")
+        log.warning("FFmpeg is not available. Returning unmodified mp3 file.")
         return temp_mp3_path # Return the original mp3 path, it won't be cleaned by this function
 
-    # Create a new temporary file for the converted output
-    converted_file_obj = tempfile.NamedTemporaryFile(delete=False, suffix=f".{response_format}")
-    converted_path = converted_file_obj.name
-    converted_file_obj.close() # Close file object, ffmpeg will write to the path
+    # Create a new scratch file for the converted output; ffmpeg will write to the path
+    try:
+        converted_path = get_scratch().new_file(f".{response_format}")
+    except Exception:
+        get_scratch().release(temp_mp3_path)
+        raise
 
     # Build the FFmpeg command
     ffmpeg_command = [
@@ -165,28 +308,84 @@ async def _generate_audio(text, voice, response_format, speed, pitch=0):
 
     try:
         # Run FFmpeg command and ensure no errors occur
-        subprocess.run(ffmpeg_command, check=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        with FFMPEG_DURATION.time(format=response_format), current_timer().phase('ffmpeg'):
+            subprocess.run(ffmpeg_command, check=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
     except subprocess.CalledProcessError as e:
         # Clean up potentially created (but incomplete) converted file
-        Path(converted_path).unlink(missing_ok=True)
+        get_scratch().release(converted_path)
         # Clean up the original mp3 file as well, since conversion failed
-        Path(temp_mp3_path).unlink(missing_ok=True)
+        get_scratch().release(temp_mp3_path)
         
         if DETAILED_ERROR_LOGGING:
             error_message = f"FFmpeg error during audio conversion. Command: '{' '.join(e.cmd)}'. Stderr: {e.stderr.decode('utf-8', 'ignore')}"
-            print(error_message) # Log for server-side diagnosis
+            log.error(error_message) # Log for server-side diagnosis
         else:
             error_message = f"FFmpeg error during audio conversion: {e}"
-            print(error_message) # Log a simpler message
+            log.error(error_message) # Log a simpler message
         raise RuntimeError(f"FFmpeg error during audio conversion: {e}") # The raised error will still have details via e
 
     # Clean up the original temporary file (original mp3) as it's now converted
-    Path(temp_mp3_path).unlink(missing_ok=True)
+    get_scratch().release(temp_mp3_path)
+    get_scratch().written(converted_path)
 
     return converted_path
 
-def generate_speech(text, voice, response_format, speed=1.0, pitch=0):
-    return asyncio.run(_generate_audio(text, voice, response_format, speed, pitch))
+# Bytes read from FFmpeg's output per streamed chunk (at most; whatever is available is sent)
+TRANSCODE_CHUNK_SIZE = 4096
+
+def transcode_stream(chunks, output_args):
+    """
+    Converts an mp3 chunk stream with FFmpeg as it arrives; output_args select the output
+    format (e.g. ["-f", "s16le", "-ar", "16000"]). Output is yielded as FFmpeg produces it.
+    An error in chunks is raised here; closing the stream stops FFmpeg and closes chunks.
+    """
+    process = subprocess.Popen(
+        ["ffmpeg", "-loglevel", "error", "-f", "mp3", "-i", "pipe:0", *output_args, "pipe:1"],
+        stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+    )
+    errors = []
+
+    def feed():
+        # chunks is iterated and closed on this thread only
+        try:
+            with contextlib.closing(chunks):
+                for chunk in chunks:
+                    try:
+                        process.stdin.write(chunk)
+                        process.stdin.flush()
+                    except (BrokenPipeError, ValueError):
+                        return  # FFmpeg was stopped because the stream was closed
+        except Exception as e:
+            errors.append(e)
+        finally:
+            try:
+                process.stdin.close()
+            except OSError:
+                pass
+
+    feeder = threading.Thread(target=feed, name='ffmpeg-feed', daemon=True)
+    feeder.start()
+    try:
+        while True:
+            data = process.stdout.read1(TRANSCODE_CHUNK_SIZE)
+            if not data:
+                break
+            yield data
+        feeder.join()
+        if errors:
+            raise errors[0]
+        if process.wait() != 0:
+            raise RuntimeError(f"FFmpeg exited with {process.returncode} during streaming conversion")
+    finally:
+        if process.poll() is None:
+            process.kill()  # the feeder's next write fails, and it closes chunks
+        process.wait()
+        process.stdout.close()
+
+def generate_speech(text, voice, response_format, speed=1.0, pitch=0, deadline=None):
+    deadline = deadline or current_deadline()
+    with get_scheduler('edge').slot(current_work(), deadline):
+        return asyncio.run(_generate_audio(text, voice, response_format, speed, pitch, deadline))
 
 def get_models():
     return model_data
@@ -197,9 +396,19 @@ def get_models_formatted():
 def get_voices_formatted():
     return [{ "id": k, "name": v } for k, v in voice_mapping.items()]
 
+async def _list_voices():
+    """edge-tts's full voice list, from the shared disk cache while it is fresh."""
+    cache = get_disk_cache()
+    stored = cache.get(VOICE_LIST_KEY)
+    if stored is not None:
+        return json.loads(stored[0])
+    voices = await load_edge_tts().list_voices()
+    cache.put(VOICE_LIST_KEY, json.dumps(voices).encode('utf-8'), 'application/json', ttl=VOICE_LIST_TTL)
+    return voices
+
 async def _get_voices(language=None):
     # List all voices, filter by language if specified
-    all_voices = await edge_tts.list_voices()
+    all_voices = await _list_voices()
     language = language or DEFAULT_LANGUAGE  # Use default if no language specified
     filtered_voices = [
         {"name": v['ShortName'], "gender": v['Gender'], "language": v['Locale']}
@@ -3,6 +3,7 @@
 from flask import request, jsonify
 from functools import wraps
 import os
+import json
 from dotenv import load_dotenv
 
 from config import DEFAULT_CONFIGS
@@ -25,14 +26,21 @@ def require_api_key(f):
         if not REQUIRE_API_KEY:
             return f(*args, **kwargs)
         auth_header = request.headers.get('Authorization')
-        if not auth_header or not auth_header.startswith('Bearer '):
+        if auth_header and auth_header.startswith('Bearer '):
+            token = auth_header.split('Bearer ')[1]
+        elif request.headers.get('xi-api-key'):
+            token = request.headers['xi-api-key']  # how ElevenLabs clients send the key
+        else:
             return jsonify({"error": "Missing or invalid API key"}), 401
-        token = auth_header.split('Bearer ')[1]
         if token != API_KEY:
             return jsonify({"error": "Invalid API key"}), 401
         return f(*args, **kwargs)
     return decorated_function
 
+def format_sse_event(event):
+    """Serializes an event dict as a single Server-Sent Events data frame."""
+    return f"data: {json.dumps(event)}\n\n"
+
 # Mapping of audio format to MIME type
 AUDIO_FORMAT_MIME_TYPES = {
     "mp3": "audio/mpeg",
@@ -0,0 +1,226 @@
+# bench_text.py
+
+"""
+Microbenchmarks for the per-request text-processing hot path.
+
+Covers sentence splitting, markdown/emoji cleaning, custom keyword removal,
+the nano auth header generation and SSE event encoding over a handful of
+realistic corpora. Each case reports ops/sec and the memory allocated per
+operation, and is compared against the stored baseline.
+
+Usage:
+    python benchmarks/bench_text.py                    # run and compare with baseline.json
+    python benchmarks/bench_text.py --update-baseline  # run and store the results as the new baseline
+    python benchmarks/bench_text.py --filter split     # only cases whose name contains "split"
+
+Exits with status 1 when any case is slower than the baseline by more than
+--threshold (default 20%). Baselines are machine specific: regenerate them on
+the machine that runs the comparison.
+"""
+
+import argparse
+import base64
+import json
+import os
+import sys
+import time
+import tracemalloc
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(os.path.join(ROOT, 'app'))
+sys.path.append(os.path.join(ROOT, 'nano-tts'))
+
+BASELINE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'baseline.json')
+
+# --- Corpora ---
+
+CHINESE_PARAGRAPH = (
+    "春天的早晨，城市还没有完全醒来，街道两旁的梧桐树已经抽出了嫩绿的新芽。"
+    "老王推着早点车慢慢走过巷口，豆浆的香气混着油条的热气在空气里散开；"
+    "赶早班的年轻人排起了队，有人低头看手机，有人小声地讨论着昨天的新闻！"
+    "你知道吗？据说今年的樱花比往年早开了整整一周，公园里已经挤满了拍照的游客。"
+    "时间过得真快，转眼间又是一年，很多计划还没来得及开始，就已经到了该总结的时候。\n"
+)
+
+MARKDOWN_LLM_OUTPUT = """# 部署指南
+
+## 1. 准备环境
+
+首先确认你已经安装了 **Python 3.12** 以及 `uv` 工具。更多信息请参考 [官方文档](https://docs.python.org/3/)。
+
+- 克隆仓库：`git clone https://github.com/example/repo.git`
+- 安装依赖：*推荐* 使用 `uv sync`
+- 配置 `.env` 文件，设置 __API_KEY__ 与 `PORT`
+
+```bash
+uv venv --python 3.12
+uv sync
+python main.py
+```
+
+> 注意：如果需要 mp3 以外的格式，请安装 ffmpeg。[1][2]
+
+### 常见问题
+
+1. **端口被占用？** 修改 `PORT` 环境变量即可。
+2. ![架构图](https://example.com/arch.png) 展示了整体结构。
+3. 查看 <b>日志</b> 获取详细错误信息，见 www.example.com/logs 。
+
+"""
+
+EMOJI_CHAT = (
+    "哈哈哈😂😂 今天太开心了🎉🎉🎉！你看到那只猫了吗🐱？超可爱的😍😍 "
+    "晚上一起去吃火锅吧🍲🔥 我请客💰💰👍 不见不散哦😘✨ "
+    "OK 👌👌 记得带伞☔️ 外面好像要下雨了🌧️🌧️ 路上小心🚗💨\n"
+)
+
+def build_corpora():
+    """Returns the benchmark corpora keyed by name."""
+    return {
+        'chinese_prose': CHINESE_PARAGRAPH * 60,
+        'markdown_llm': MARKDOWN_LLM_OUTPUT * 10,
+        'emoji_chat': EMOJI_CHAT * 40,
+        # A large input with no sentence punctuation at all forces the comma/length fallback paths
+        'no_punctuation': ('这是一段没有任何标点符号的超长文本用于测试最坏情况下的分句性能' * 400),
+    }
+
+CLEANING_OPTIONS = {
+    'remove_urls': True,
+    'remove_markdown': True,
+    'remove_emoji': True,
+    'remove_citation_numbers': True,
+    'remove_line_breaks': True,
+}
+
+# A tenant-sized keyword list: a few hundred distinct, non-overlapping entries
+CUSTOM_KEYWORDS = [f"广告词{i:03d}号" for i in range(300)]
+
+# --- Cases ---
+
+def build_cases():
+    # robots.json (the nano voice list) is resolved relative to the working directory
+    os.chdir(ROOT)
+
+    from handle_text import prepare_tts_input_with_context, clean_text, remove_keywords
+    from utils import format_sse_event
+    from app import split_text_into_sentences
+    from nano_tts import NanoAITTS
+
+    corpora = build_corpora()
+    cases = []
+
+    for name, text in corpora.items():
+        cases.append((f'split_text_into_sentences[{name}]', split_text_into_sentences, (text,)))
+    for name, text in corpora.items():
+        cases.append((f'prepare_tts_input_with_context[{name}]', prepare_tts_input_with_context, (text,)))
+    for name, text in corpora.items():
+        cases.append((f'clean_text[{name}]', clean_text, (text, CLEANING_OPTIONS)))
+
+    keyword_text = corpora['chinese_prose'] + ''.join(CUSTOM_KEYWORDS[::7])
+    cases.append(('clean_text[custom_keywords_300]', clean_text, (keyword_text, {'custom_keywords': CUSTOM_KEYWORDS})))
+    cases.append(('remove_keywords[300]', remove_keywords, (keyword_text, CUSTOM_KEYWORDS)))
+
+    engine = NanoAITTS()
+    cases.append(('NanoAITTS.get_headers', engine.get_headers, ()))
+    cases.append(('NanoAITTS._e[ua]', engine._e, (engine.ua * 4,)))
+
+    chunk = base64.b64encode(os.urandom(4096)).decode('utf-8')
+    event = {"type": "speech.audio.delta", "audio": chunk, "sentence_index": 3, "total_sentences": 40}
+    cases.append(('format_sse_event[4KiB]', format_sse_event, (event,)))
+    cases.append(('sse_delta_encode[4KiB]', _encode_delta, (os.urandom(4096),)))
+
+    return cases
+
+def _encode_delta(chunk):
+    """The full per-chunk cost on the SSE path: base64 plus JSON framing."""
+    from utils import format_sse_event
+    return format_sse_event({
+        "type": "speech.audio.delta",
+        "audio": base64.b64encode(chunk).decode('utf-8'),
+        "sentence_index": 0,
+        "total_sentences": 1,
+    })
+
+# --- Runner ---
+
+def measure(func, args, min_time=0.2, repeat=5):
+    """Returns (ops_per_sec, bytes_allocated_per_op) for func(*args)."""
+    number = 1
+    while True:
+        start = time.perf_counter()
+        for _ in range(number):
+            func(*args)
+        elapsed = time.perf_counter() - start
+        if elapsed >= min_time:
+            break
+        number *= 2 if elapsed <= 0 else max(2, int(min_time / elapsed) + 1)
+
+    best = elapsed
+    for _ in range(repeat - 1):
+        start = time.perf_counter()
+        for _ in range(number):
+            func(*args)
+        best = min(best, time.perf_counter() - start)
+
+    # Allocation pass, kept separate because tracing slows execution down
+    tracemalloc.start()
+    tracemalloc.reset_peak()
+    before, _ = tracemalloc.get_traced_memory()
+    func(*args)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return number / best, max(0, peak - before)
+
+def load_baseline():
+    if not os.path.exists(BASELINE_PATH):
+        return {}
+    with open(BASELINE_PATH, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Text-processing hot path microbenchmarks")
+    parser.add_argument('--update-baseline', action='store_true', help="store the results as the new baseline")
+    parser.add_argument('--threshold', type=float, default=0.20, help="allowed slowdown vs baseline (fraction)")
+    parser.add_argument('--filter', default='', help="only run cases whose name contains this string")
+    parser.add_argument('--min-time', type=float, default=0.2, help="minimum seconds per timing round")
+    args = parser.parse_args(argv)
+
+    baseline = load_baseline()
+    results = {}
+    regressions = []
+
+    print(f"{'case':<48} {'ops/sec':>12} {'alloc/op':>12} {'vs baseline':>12}")
+    for name, func, call_args in build_cases():
+        if args.filter and args.filter not in name:
+            continue
+        ops, allocated = measure(func, call_args, min_time=args.min_time)
+        results[name] = {"ops_per_sec": round(ops, 2), "alloc_bytes_per_op": allocated}
+
+        comparison = ''
+        reference = baseline.get(name)
+        if reference:
+            change = ops / reference['ops_per_sec'] - 1.0
+            comparison = f"{change:+.1%}"
+            if change < -args.threshold:
+                regressions.append((name, change))
+                comparison += ' !'
+        print(f"{name:<48} {ops:>12,.1f} {allocated / 1024:>10.1f}Ki {comparison:>12}")
+
+    if args.update_baseline:
+        baseline.update(results)
+        with open(BASELINE_PATH, 'w', encoding='utf-8') as f:
+            json.dump(baseline, f, ensure_ascii=False, indent=2, sort_keys=True)
+            f.write('\n')
+        print(f"Baseline written to {BASELINE_PATH}")
+        return 0
+
+    if regressions:
+        print(f"\n{len(regressions)} case(s) regressed by more than {args.threshold:.0%}:")
+        for name, change in regressions:
+            print(f"  {name}: {change:+.1%}")
+        return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
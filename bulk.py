@@ -0,0 +1,281 @@
+# bulk.py
+
+"""
+Offline bulk synthesis, without the HTTP server.
+
+    python bulk.py prompts.csv --out audio/
+    python bulk.py library.jsonl --out audio/ --workers 16 --format opus
+
+Reads a manifest of items and writes one audio file per item to the output
+directory, calling the engines directly: edge-tts through tts_handler and
+Nano-TTS through its engine (fetch_audio, sentence by sentence). There is no
+HTTP, JSON encoding or API key check per item.
+
+The manifest is CSV with a header row, or JSON Lines (.jsonl / .ndjson), with
+these fields per item:
+
+    text     required (also accepted as "input")
+    voice    edge voice, OpenAI voice name or nano model; default --voice
+    format   mp3, opus, aac, flac, wav or pcm; default --format
+    speed    edge only; default 1.0
+    pitch    edge only; default 0
+    id       output file name without extension; default a hash of the
+             fields above, so the same item always maps to the same file
+
+Items whose output file already exists are skipped, so an interrupted run
+can simply be started again; files are written under a temporary name and
+renamed when complete. Text is cleaned as /v1/audio/speech cleans it.
+
+Items run on --workers threads, and the upstream schedulers still cap
+concurrent calls per backend (NANO_UPSTREAM_CONCURRENCY,
+EDGE_UPSTREAM_CONCURRENCY). A failed item is retried with backoff within
+the usual retry budget, then reported; the exit status is 1 if any item
+failed. Progress and throughput are printed every --progress seconds.
+"""
+
+import argparse
+import csv
+import hashlib
+import json
+import os
+import re
+import shutil
+import sys
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'app'))
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'nano-tts'))
+
+import app as nano_server
+from config import DEFAULT_CONFIGS
+from deadline import Deadline, route_timeout
+from handle_text import clean_text, parse_keywords, prepare_tts_input_with_context, remove_keywords
+from retry import RetryBudget
+from routing import backend_for
+from scratch import get_scratch
+from tts_handler import convert_audio_file, generate_speech, is_ffmpeg_installed, voice_mapping
+from utils import AUDIO_FORMAT_MIME_TYPES, getenv_bool
+
+# Read as server.py reads it, without importing the edge server's Flask app
+REMOVE_FILTER = getenv_bool('REMOVE_FILTER', DEFAULT_CONFIGS["REMOVE_FILTER"])
+DEFAULT_VOICE = 'zh-CN-XiaoxiaoNeural'
+# Characters of an id kept in a file name; anything else becomes '_'
+UNSAFE_NAME = re.compile(r'[^\w.-]')
+
+class Item:
+    __slots__ = ('line', 'text', 'voice', 'format', 'speed', 'pitch', 'cleaning_options', 'name')
+
+    def __init__(self, line, text, voice, response_format, speed, pitch, cleaning_options, name):
+        self.line = line
+        self.text = text
+        self.voice = voice
+        self.format = response_format
+        self.speed = speed
+        self.pitch = pitch
+        self.cleaning_options = cleaning_options
+        self.name = name
+
+def read_manifest(path):
+    """
+    (line number, item) for each item of a CSV or JSON Lines manifest: a dict of fields for
+    CSV, the raw line for JSONL, which parse_item decodes so a bad line only fails that item.
+    """
+    with open(path, 'r', encoding='utf-8-sig', newline='') as f:
+        if path.lower().endswith(('.jsonl', '.ndjson')):
+            for line, raw in enumerate(f, 1):
+                if raw.strip():
+                    yield line, raw
+        else:
+            # Line 1 is the header
+            for line, row in enumerate(csv.DictReader(f), 2):
+                yield line, {key.strip(): value for key, value in row.items() if key and value not in (None, '')}
+
+def parse_item(line, fields, default_voice, default_format):
+    if isinstance(fields, str):
+        fields = json.loads(fields)
+    if not isinstance(fields, dict):
+        raise ValueError("not a JSON object")
+    text = fields.get('text') or fields.get('input')
+    if not isinstance(text, str) or not text.strip():
+        raise ValueError("missing text")
+    voice = str(fields.get('voice') or default_voice).strip()
+    response_format = str(fields.get('format') or fields.get('response_format') or default_format).strip().lower()
+    if response_format not in AUDIO_FORMAT_MIME_TYPES:
+        raise ValueError(f"unsupported format {response_format!r}")
+    speed = float(fields.get('speed', 1.0))
+    pitch = int(fields.get('pitch', 0))
+    cleaning_options = fields.get('cleaning_options')
+    if isinstance(cleaning_options, str):
+        cleaning_options = json.loads(cleaning_options)
+    name = fields.get('id')
+    if name:
+        name = UNSAFE_NAME.sub('_', str(name))
+    else:
+        canonical = json.dumps([voice, text, response_format, speed, pitch, cleaning_options],
+                               ensure_ascii=False, sort_keys=True)
+        name = hashlib.sha256(canonical.encode('utf-8')).hexdigest()[:24]
+    return Item(line, text, voice, response_format, speed, pitch, cleaning_options, name)
+
+def output_path(out_dir, item):
+    return os.path.join(out_dir, f"{item.name}.{item.format}")
+
+def synthesize_edge(item, deadline):
+    """A scratch file holding the item's audio, in its format."""
+    text = item.text
+    if item.cleaning_options:
+        text = clean_text(text, item.cleaning_options)
+    elif not REMOVE_FILTER:
+        text = prepare_tts_input_with_context(text)
+    return generate_speech(text, item.voice, item.format, item.speed, item.pitch, deadline=deadline)
+
+def synthesize_nano(item, deadline):
+    """A scratch file holding the item's audio, in its format (Nano-TTS makes mp3, converted here)."""
+    text = item.text
+    keywords = (item.cleaning_options or {}).get('custom_keywords')
+    if keywords:
+        text = remove_keywords(text, parse_keywords(keywords))
+    audio = b''.join(nano_server.fetch_audio(sentence, item.voice, deadline=deadline)
+                     for sentence in nano_server.split_text_into_sentences(text) if sentence.strip())
+    if not audio:
+        raise RuntimeError("upstream returned no audio")
+    path = get_scratch().new_file('.mp3')
+    with open(path, 'wb') as f:
+        f.write(audio)
+    get_scratch().written(path)
+    return path if item.format == 'mp3' else convert_audio_file(path, item.format)
+
+def item_backend(voice):
+    """Like the server: OpenAI voice names (alloy, nova, ...) are edge voices, otherwise the voice decides."""
+    return 'edge' if voice in voice_mapping else backend_for(voice)
+
+def synthesize(item, out_dir):
+    """Writes the item's output file, retrying within a retry budget; returns its size in bytes."""
+    synthesizer = synthesize_edge if item_backend(item.voice) == 'edge' else synthesize_nano
+    budget = RetryBudget()
+    attempt = 0
+    while True:
+        attempt += 1
+        try:
+            path = synthesizer(item, Deadline(route_timeout(False)))
+            break
+        except Exception as e:
+            delay = budget.next_delay(attempt)
+            if delay is None:
+                raise
+            print(f"line {item.line}: attempt {attempt} failed: {e}; retrying in {delay:.2f}s")
+            time.sleep(delay)
+    target = output_path(out_dir, item)
+    part = f"{target}.part"
+    try:
+        shutil.move(path, part)
+        os.replace(part, target)
+    finally:
+        get_scratch().release(path)
+    return os.path.getsize(target)
+
+class Progress:
+    """Counts finished items and prints progress and throughput at most every interval seconds."""
+
+    def __init__(self, total, interval):
+        self.total = total
+        self.interval = interval
+        self.done = self.skipped = self.failed = 0
+        self.chars = self.bytes = 0
+        self.start = time.perf_counter()
+        self._last_report = self.start
+        self._lock = threading.Lock()
+
+    def finished(self, item, size=None, error=None):
+        with self._lock:
+            if error is not None:
+                self.failed += 1
+            else:
+                self.done += 1
+                self.chars += len(item.text)
+                self.bytes += size
+            now = time.perf_counter()
+            if now - self._last_report >= self.interval:
+                self._last_report = now
+                print(self.line(now))
+
+    def line(self, now=None):
+        elapsed = (now or time.perf_counter()) - self.start
+        finished = self.done + self.failed
+        rate = self.done / elapsed if elapsed else 0.0
+        remaining = self.total - self.skipped - finished
+        eta = f", ETA {remaining / rate:.0f}s" if rate and remaining else ""
+        return (f"[{self.skipped + finished}/{self.total}] {self.done} written, {self.skipped} skipped, "
+                f"{self.failed} failed; {rate:.2f} items/s, {self.chars / elapsed if elapsed else 0:.0f} chars/s{eta}")
+
+def main():
+    parser = argparse.ArgumentParser(description="Synthesize every item of a CSV or JSONL manifest to files, without HTTP.")
+    parser.add_argument('manifest', help="CSV (with a header row) or .jsonl / .ndjson manifest")
+    parser.add_argument('--out', required=True, help="Output directory")
+    parser.add_argument('--workers', type=int, default=8, help="Items synthesized at once (default 8)")
+    parser.add_argument('--voice', default=DEFAULT_VOICE, help=f"Voice for items without one (default {DEFAULT_VOICE})")
+    parser.add_argument('--format', default='mp3', choices=sorted(AUDIO_FORMAT_MIME_TYPES),
+                        help="Format for items without one (default mp3)")
+    parser.add_argument('--progress', type=float, default=5.0, help="Seconds between progress lines (default 5)")
+    args = parser.parse_args()
+
+    items, invalid = [], 0
+    try:
+        for line, fields in read_manifest(args.manifest):
+            try:
+                items.append(parse_item(line, fields, args.voice, args.format))
+            except (TypeError, ValueError) as e:
+                invalid += 1
+                print(f"line {line}: skipped invalid item: {e}")
+    except (OSError, ValueError) as e:
+        raise SystemExit(f"Cannot read manifest {args.manifest}: {e}")
+    if any(item.format != 'mp3' for item in items) and not is_ffmpeg_installed():
+        raise SystemExit("FFmpeg is required for formats other than mp3")
+
+    os.makedirs(args.out, exist_ok=True)
+    progress = Progress(len(items), args.progress)
+    pending = []
+    for item in items:
+        if os.path.exists(output_path(args.out, item)):
+            progress.skipped += 1
+        else:
+            pending.append(item)
+    print(f"{len(items)} items in {args.manifest}: {progress.skipped} already done, {len(pending)} to synthesize "
+          f"with {args.workers} workers")
+
+    # Items are submitted as workers free up, so a large manifest is not all queued at once
+    failures = []
+    with ThreadPoolExecutor(max_workers=max(1, args.workers), thread_name_prefix='bulk') as executor:
+        queue = iter(pending)
+        running = {}
+        while True:
+            while len(running) < 2 * max(1, args.workers):
+                item = next(queue, None)
+                if item is None:
+                    break
+                running[executor.submit(synthesize, item, args.out)] = item
+            if not running:
+                break
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                item = running.pop(future)
+                try:
+                    progress.finished(item, size=future.result())
+                except Exception as e:
+                    progress.finished(item, error=e)
+                    failures.append(item)
+                    print(f"line {item.line}: failed ({item.voice}, {item.name}): {e}")
+
+    elapsed = time.perf_counter() - progress.start
+    print(progress.line())
+    print(f"Done in {elapsed:.1f}s: {progress.bytes / 1e6:.2f} MB of audio written to {args.out}")
+    if invalid:
+        print(f"{invalid} invalid items were skipped")
+    if failures:
+        print(f"{len(failures)} items failed; run again to retry them")
+    if failures or invalid:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
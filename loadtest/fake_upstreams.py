@@ -0,0 +1,223 @@
+# fake_upstreams.py
+
+"""
+Local stand-ins for the upstream speech services, for load testing.
+
+One aiohttp server provides:
+  * POST /api/tts/v1           - the nano (bot.n.cn) synthesis API, returning canned MP3
+  * GET  /api/robot/platform   - the nano voice list
+  * GET  /edge/v1              - the edge-tts websocket (speech.config + ssml turns)
+  * GET  /voices/list          - the edge-tts voice list
+
+Latency, jitter and error rate are configurable so degraded upstreams can be
+simulated. Point the service at it with:
+
+    NANO_TTS_BASE_URL=http://127.0.0.1:PORT
+    EDGE_TTS_WSS_URL=ws://127.0.0.1:PORT/edge/v1?TrustedClientToken=local
+    EDGE_TTS_VOICE_LIST_URL=http://127.0.0.1:PORT/voices/list?trustedclienttoken=local
+
+Run standalone with: python loadtest/fake_upstreams.py --port 5900 --latency-ms 150
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import threading
+
+from aiohttp import web, WSMsgType
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# One silent MPEG-2 Layer III frame (24 kHz, 48 kbps, mono): a 4-byte header
+# followed by zeroed side info and payload. Every frame is 144 bytes / 24 ms,
+# the same format the edge service streams.
+SILENT_MP3_FRAME = b'\xff\xf3\x64\xc0' + bytes(140)
+
+EDGE_VOICES = [
+    {"Name": f"Microsoft Server Speech Text to Speech Voice ({locale}, {name})",
+     "ShortName": f"{locale}-{name}", "Gender": gender, "Locale": locale,
+     "SuggestedCodec": "audio-24khz-48kbitrate-mono-mp3", "FriendlyName": name,
+     "Status": "GA", "VoiceTag": {"ContentCategories": ["General"], "VoicePersonalities": ["Friendly"]}}
+    for locale, name, gender in [
+        ("zh-CN", "XiaoxiaoNeural", "Female"),
+        ("zh-CN", "YunxiNeural", "Male"),
+        ("en-US", "AvaNeural", "Female"),
+        ("en-US", "AndrewNeural", "Male"),
+    ]
+]
+
+class UpstreamBehaviour:
+    """Tunable latency / failure model shared by all fake endpoints."""
+
+    def __init__(self, latency_ms=100.0, jitter_ms=50.0, error_rate=0.0, ms_per_char=2.0, seed=None,
+                 connect_latency_ms=0.0):
+        self.latency_ms = latency_ms
+        self.connect_latency_ms = connect_latency_ms
+        self.jitter_ms = jitter_ms
+        self.error_rate = error_rate
+        self.ms_per_char = ms_per_char
+        self._random = random.Random(seed)
+        # Counted so a test can tell how many edge turns shared a websocket
+        self.edge_connections = 0
+        self.edge_turns = 0
+
+    def delay(self):
+        return max(0.0, self.latency_ms + self._random.uniform(-self.jitter_ms, self.jitter_ms)) / 1000.0
+
+    def should_fail(self):
+        return self._random.random() < self.error_rate
+
+    def failure_kind(self):
+        """Picks how a simulated nano failure looks: a JSON 'Fail' body or an HTTP error."""
+        return 'json' if self._random.random() < 0.5 else 'http'
+
+    def audio_for(self, text):
+        """Canned audio roughly as long as the text would take to speak."""
+        frames = max(1, int(len(text) * self.ms_per_char * 10 / 24))
+        return SILENT_MP3_FRAME * frames
+
+def _edge_text_message(path, request_id, body=''):
+    return f"X-RequestId:{request_id}\r\nContent-Type:application/json; charset=utf-8\r\nPath:{path}\r\n\r\n{body}"
+
+def _edge_audio_message(request_id, data):
+    header = f"X-RequestId:{request_id}\r\nContent-Type:audio/mpeg\r\nPath:audio\r\n".encode('utf-8')
+    return len(header).to_bytes(2, 'big') + header + data
+
+def _parse_edge_message(text):
+    head, _, body = text.partition('\r\n\r\n')
+    headers = dict(line.split(':', 1) for line in head.split('\r\n') if ':' in line)
+    return headers, body
+
+def create_app(behaviour):
+    routes = web.RouteTableDef()
+
+    with open(os.path.join(ROOT, 'robots.json'), 'r', encoding='utf-8') as f:
+        nano_voices = json.load(f)
+
+    @routes.post('/api/tts/v1')
+    async def nano_tts(request):
+        form = await request.post()
+        text = form.get('text', '')
+        await asyncio.sleep(behaviour.delay())
+        if behaviour.should_fail():
+            if behaviour.failure_kind() == 'json':
+                return web.json_response({"msg": "Fail", "data": {"reason": "simulated upstream failure"}})
+            return web.Response(status=502, text="simulated upstream failure")
+        return web.Response(body=behaviour.audio_for(text), content_type='audio/mpeg')
+
+    @routes.get('/api/robot/platform')
+    async def nano_voice_list(request):
+        await asyncio.sleep(behaviour.delay())
+        return web.json_response(nano_voices)
+
+    @routes.get('/voices/list')
+    async def edge_voice_list(request):
+        await asyncio.sleep(behaviour.delay())
+        return web.json_response(EDGE_VOICES)
+
+    @routes.get('/edge/v1')
+    async def edge_websocket(request):
+        # Stands in for the TLS and websocket handshake cost of a new connection
+        await asyncio.sleep(behaviour.connect_latency_ms / 1000.0)
+        ws = web.WebSocketResponse(compress=True)
+        await ws.prepare(request)
+        behaviour.edge_connections += 1
+        # A single connection may carry any number of turns, as the real service allows
+        async for message in ws:
+            if message.type != WSMsgType.TEXT:
+                continue
+            headers, body = _parse_edge_message(message.data)
+            if headers.get('Path') != 'ssml':
+                continue
+            request_id = headers.get('X-RequestId', 'local')
+            behaviour.edge_turns += 1
+            await asyncio.sleep(behaviour.delay())
+            if behaviour.should_fail():
+                await ws.close(code=1011, message=b'simulated upstream failure')
+                break
+            try:
+                await ws.send_str(_edge_text_message('turn.start', request_id, '{}'))
+                audio = behaviour.audio_for(body)
+                for offset in range(0, len(audio), 4096):
+                    await ws.send_bytes(_edge_audio_message(request_id, audio[offset:offset + 4096]))
+                await ws.send_str(_edge_text_message('turn.end', request_id, '{}'))
+            except ConnectionResetError:
+                break  # the client gave up on the turn (deadline, disconnect) and closed the socket
+        return ws
+
+    app = web.Application()
+    app.add_routes(routes)
+    return app
+
+class FakeUpstreams:
+    """Runs the fake upstream server on a background thread."""
+
+    def __init__(self, behaviour, host='127.0.0.1', port=0):
+        self.behaviour = behaviour
+        self.host = host
+        self.port = port
+        self._loop = None
+        self._runner = None
+        self._thread = None
+        self._ready = threading.Event()
+
+    @property
+    def base_url(self):
+        return f"http://{self.host}:{self.port}"
+
+    def environment(self):
+        """Environment variables that point the service at this server."""
+        return {
+            'NANO_TTS_BASE_URL': self.base_url,
+            'EDGE_TTS_WSS_URL': f"ws://{self.host}:{self.port}/edge/v1?TrustedClientToken=local",
+            'EDGE_TTS_VOICE_LIST_URL': f"{self.base_url}/voices/list?trustedclienttoken=local",
+        }
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name='fake-upstreams', daemon=True)
+        self._thread.start()
+        self._ready.wait()
+        return self
+
+    def stop(self):
+        if self._loop is not None:
+            asyncio.run_coroutine_threadsafe(self._runner.cleanup(), self._loop).result(timeout=10)
+            self._loop.call_soon_threadsafe(self._loop.stop)
+            self._thread.join(timeout=10)
+
+    def _run(self):
+        self._loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self._loop)
+        self._runner = web.AppRunner(create_app(self.behaviour))
+        self._loop.run_until_complete(self._runner.setup())
+        site = web.TCPSite(self._runner, self.host, self.port)
+        self._loop.run_until_complete(site.start())
+        self.port = site._server.sockets[0].getsockname()[1]
+        self._ready.set()
+        self._loop.run_forever()
+        self._loop.close()
+
+def main():
+    parser = argparse.ArgumentParser(description="Local stand-ins for the nano and edge speech upstreams")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=5900)
+    parser.add_argument('--latency-ms', type=float, default=100.0)
+    parser.add_argument('--jitter-ms', type=float, default=50.0)
+    parser.add_argument('--error-rate', type=float, default=0.0)
+    parser.add_argument('--connect-latency-ms', type=float, default=0.0)
+    args = parser.parse_args()
+
+    behaviour = UpstreamBehaviour(args.latency_ms, args.jitter_ms, args.error_rate,
+                                  connect_latency_ms=args.connect_latency_ms)
+    upstreams = FakeUpstreams(behaviour, args.host, args.port).start()
+    for name, value in upstreams.environment().items():
+        print(f"{name}={value}")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        upstreams.stop()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,318 @@
+# run.py
+
+"""
+End-to-end load test for the unified service against local stand-in upstreams.
+
+Starts the fake nano/edge upstreams (fake_upstreams.py), launches main.py in a
+subprocess pointed at them, drives it with a weighted mix of requests from
+scenarios.json and reports throughput, latency percentiles, time-to-first-byte
+and the server's memory use.
+
+Usage:
+    python loadtest/run.py --scenario mixed --requests 500 --concurrency 32
+    python loadtest/run.py --scenario nano-stream --latency-ms 300 --error-rate 0.05
+    python loadtest/run.py --scenario mixed --target http://127.0.0.1:5050   # drive an already running server
+    python loadtest/run.py --scenario mixed --json-out before.json           # keep results to compare runs
+    python loadtest/run.py --scenario mixed --workers 4                      # run prefork.py instead of main.py
+    python loadtest/run.py --scenario mixed --cache                          # keep the audio cache on
+
+Run the same command before and after a change and compare the reports (or the
+--json-out files) to see its effect. The scenarios repeat the same inputs, so
+the started server runs with the audio cache off (unless --cache) to measure
+the synthesis path, and keeps its disk cache, popularity counts, jobs and
+scratch files in a temporary directory removed afterwards, so no run sees
+another's state.
+"""
+
+import argparse
+import json
+import os
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+from fake_upstreams import FakeUpstreams, UpstreamBehaviour
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SCENARIOS_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'scenarios.json')
+API_KEY = 'sk-123456'  # the nano route only accepts its static key
+
+def load_scenario(name):
+    with open(SCENARIOS_PATH, 'r', encoding='utf-8') as f:
+        scenarios = json.load(f)
+    if name not in scenarios:
+        raise SystemExit(f"Unknown scenario '{name}'. Available: {', '.join(sorted(scenarios))}")
+    return scenarios[name]
+
+def build_payload(entry):
+    payload = {key: value for key, value in entry.items() if key not in ('weight', 'input_repeat')}
+    payload['input'] = entry['input'] * entry.get('input_repeat', 1)
+    payload.setdefault('model', 'tts-1')
+    return payload
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+def rss_bytes(pid):
+    """Resident set size of a process, from /proc (Linux only)."""
+    try:
+        with open(f'/proc/{pid}/status', 'r') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+def tree_memory_bytes(pid):
+    """
+    Proportional set size of a process and its children (Linux only): pages shared
+    copy-on-write between pre-forked workers are split between them, not counted per worker.
+    """
+    total = 0
+    pids = [pid]
+    while pids:
+        current = pids.pop()
+        try:
+            with open(f'/proc/{current}/smaps_rollup', 'r') as f:
+                for line in f:
+                    if line.startswith('Pss:'):
+                        total += int(line.split()[1]) * 1024
+                        break
+            with open(f'/proc/{current}/task/{current}/children', 'r') as f:
+                pids.extend(int(child) for child in f.read().split())
+        except OSError:
+            pass
+    return total or None
+
+class MemorySampler(threading.Thread):
+    def __init__(self, pid, interval=0.25, measure=rss_bytes):
+        super().__init__(daemon=True)
+        self.pid = pid
+        self.interval = interval
+        self.measure = measure
+        self.samples = []
+        self._stop_event = threading.Event()
+
+    def run(self):
+        while not self._stop_event.is_set():
+            value = self.measure(self.pid)
+            if value is not None:
+                self.samples.append(value)
+            self._stop_event.wait(self.interval)
+
+    def stop(self):
+        self._stop_event.set()
+        self.join()
+
+def start_server(upstream_env, port, state_dir, log_path=None, workers=0, cache=False):
+    env = dict(os.environ)
+    env.update(upstream_env)
+    env.update({'PORT': str(port), 'API_KEY': API_KEY, 'REQUIRE_API_KEY': 'False', 'PYTHONUNBUFFERED': '1'})
+    # Everything the server persists goes to this run's own directory, not the repo's data/
+    env.update({
+        'DISK_CACHE_DIR': os.path.join(state_dir, 'cache'),
+        'POPULARITY_FILE': os.path.join(state_dir, 'popularity.json'),
+        'JOBS_DIR': os.path.join(state_dir, 'jobs'),
+        'SCRATCH_DIR': os.path.join(state_dir, 'scratch'),
+    })
+    if not cache:
+        env['AUDIO_CACHE_MAX_BYTES'] = '0'
+    if workers:
+        env['PREFORK_WORKERS'] = str(workers)
+    log = open(log_path, 'w') if log_path else subprocess.DEVNULL
+    process = subprocess.Popen(
+        [sys.executable, 'prefork.py' if workers else 'main.py'], cwd=ROOT, env=env,
+        stdout=log, stderr=subprocess.STDOUT if log_path else subprocess.DEVNULL,
+    )
+    base_url = f'http://127.0.0.1:{port}'
+    deadline = time.monotonic() + 60
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise SystemExit(f"Server exited during startup with code {process.returncode}")
+        try:
+            # Backends warm up in the background after the port opens; wait until both are ready
+            if requests.get(f'{base_url}/readyz', timeout=1).status_code == 200:
+                return process, base_url
+        except requests.RequestException:
+            pass
+        time.sleep(0.2)
+    process.kill()
+    raise SystemExit("Server did not become ready within 60 s")
+
+def run_one(session, base_url, payload):
+    """Sends one speech request and returns (ok, latency, ttfb, bytes, kind)."""
+    kind = f"{payload['voice']}/{'sse' if payload.get('stream') else 'buffered'}/{payload.get('response_format', 'mp3')}"
+    start = time.perf_counter()
+    ttfb = None
+    received = 0
+    try:
+        with session.post(
+            f'{base_url}/v1/audio/speech', json=payload, stream=True, timeout=120,
+            headers={'Authorization': f'Bearer {API_KEY}'},
+        ) as response:
+            for chunk in response.iter_content(chunk_size=None):
+                if ttfb is None:
+                    ttfb = time.perf_counter() - start
+                received += len(chunk)
+            ok = response.status_code == 200
+            if ok and payload.get('stream'):
+                # SSE streams report upstream failures in-band rather than via the status code
+                ok = received > 0
+    except requests.RequestException:
+        ok = False
+    latency = time.perf_counter() - start
+    return ok, latency, ttfb if ttfb is not None else latency, received, kind
+
+def percentile(values, pct):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, int(round(pct / 100.0 * len(ordered))) - 1))
+    return ordered[index]
+
+def summarize(results, elapsed, memory_samples):
+    latencies = [r[1] for r in results]
+    ttfbs = [r[2] for r in results]
+    ok = sum(1 for r in results if r[0])
+    report = {
+        "requests": len(results),
+        "succeeded": ok,
+        "failed": len(results) - ok,
+        "elapsed_s": round(elapsed, 3),
+        "throughput_rps": round(len(results) / elapsed, 2) if elapsed else 0.0,
+        "bytes_received": sum(r[3] for r in results),
+        "latency_ms": {p: round(percentile(latencies, p) * 1000, 1) for p in (50, 95, 99)},
+        "ttfb_ms": {p: round(percentile(ttfbs, p) * 1000, 1) for p in (50, 95, 99)},
+        "by_kind": {},
+    }
+    for kind in sorted({r[4] for r in results}):
+        subset = [r for r in results if r[4] == kind]
+        report["by_kind"][kind] = {
+            "requests": len(subset),
+            "failed": sum(1 for r in subset if not r[0]),
+            "latency_p50_ms": round(percentile([r[1] for r in subset], 50) * 1000, 1),
+            "latency_p95_ms": round(percentile([r[1] for r in subset], 95) * 1000, 1),
+            "ttfb_p50_ms": round(percentile([r[2] for r in subset], 50) * 1000, 1),
+        }
+    if memory_samples:
+        report["server_rss_mb"] = {
+            "start": round(memory_samples[0] / 2**20, 1),
+            "peak": round(max(memory_samples) / 2**20, 1),
+            "end": round(memory_samples[-1] / 2**20, 1),
+        }
+    return report
+
+def print_report(name, report):
+    print(f"\nScenario: {name}")
+    print(f"  requests     {report['requests']} ({report['failed']} failed) in {report['elapsed_s']} s")
+    print(f"  throughput   {report['throughput_rps']} req/s")
+    latency, ttfb = report['latency_ms'], report['ttfb_ms']
+    print(f"  latency ms   p50={latency[50]}  p95={latency[95]}  p99={latency[99]}")
+    print(f"  ttfb ms      p50={ttfb[50]}  p95={ttfb[95]}  p99={ttfb[99]}")
+    if 'server_rss_mb' in report:
+        rss = report['server_rss_mb']
+        label = 'PSS' if report.get("workers") else 'RSS'  # summed over the workers, shared pages split
+        print(f"  server {label}   start={rss['start']} MB  peak={rss['peak']} MB  end={rss['end']} MB")
+    upstream = report.get('upstream', {})
+    if upstream.get('edge_turns'):
+        print(f"  edge ws      {upstream['edge_turns']} turns over {upstream['edge_connections']} connections")
+    print("  by request kind:")
+    for kind, stats in report['by_kind'].items():
+        print(f"    {kind:<40} n={stats['requests']:<5} failed={stats['failed']:<4} "
+              f"p50={stats['latency_p50_ms']} ms  p95={stats['latency_p95_ms']} ms  ttfb50={stats['ttfb_p50_ms']} ms")
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Load test the unified TTS service against local stand-in upstreams")
+    parser.add_argument('--scenario', default='mixed', help="scenario name from scenarios.json")
+    parser.add_argument('--requests', type=int, default=200, help="total requests to send")
+    parser.add_argument('--concurrency', type=int, default=16, help="concurrent clients")
+    parser.add_argument('--latency-ms', type=float, default=100.0, help="fake upstream base latency")
+    parser.add_argument('--jitter-ms', type=float, default=50.0, help="fake upstream latency jitter (+/-)")
+    parser.add_argument('--error-rate', type=float, default=0.0, help="fraction of upstream calls that fail")
+    parser.add_argument('--connect-latency-ms', type=float, default=0.0,
+                        help="extra delay before the fake edge upstream accepts a websocket (handshake cost)")
+    parser.add_argument('--target', help="base URL of an already running server (skips starting one)")
+    parser.add_argument('--seed', type=int, default=1, help="random seed for the request mix")
+    parser.add_argument('--json-out', help="write the report as JSON to this path")
+    parser.add_argument('--server-log', help="write the started server's output to this file")
+    parser.add_argument('--workers', type=int, default=0,
+                        help="start the server with prefork.py and this many workers instead of main.py")
+    parser.add_argument('--cache', action='store_true',
+                        help="keep the server's audio cache on; repeated inputs are then served from it")
+    parser.add_argument('--keep-alive', action='store_true',
+                        help="reuse client connections; the Flask development server that main.py runs does not "
+                             "support keep-alive and can stall a reused connection after a chunked (SSE) response")
+    args = parser.parse_args(argv)
+
+    scenario = load_scenario(args.scenario)
+    rng = random.Random(args.seed)
+    entries = scenario['mix']
+    weights = [entry.get('weight', 1) for entry in entries]
+    payloads = [build_payload(entry) for entry in rng.choices(entries, weights=weights, k=args.requests)]
+
+    upstreams = process = sampler = state_dir = None
+    try:
+        if args.target:
+            base_url = args.target.rstrip('/')
+        else:
+            behaviour = UpstreamBehaviour(args.latency_ms, args.jitter_ms, args.error_rate, seed=args.seed,
+                                          connect_latency_ms=args.connect_latency_ms)
+            upstreams = FakeUpstreams(behaviour).start()
+            state_dir = tempfile.mkdtemp(prefix='tts-loadtest-')
+            process, base_url = start_server(upstreams.environment(), free_port(), state_dir, args.server_log,
+                                             args.workers, args.cache)
+            sampler = MemorySampler(process.pid, measure=tree_memory_bytes if args.workers else rss_bytes)
+            sampler.start()
+
+        if args.keep_alive:
+            session = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(pool_connections=args.concurrency, pool_maxsize=args.concurrency)
+            session.mount('http://', adapter)
+        else:
+            session = requests  # a fresh connection per request
+
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+            results = list(pool.map(lambda payload: run_one(session, base_url, payload), payloads))
+        elapsed = time.perf_counter() - start
+    finally:
+        if sampler is not None:
+            sampler.stop()
+        if process is not None:
+            process.terminate()
+            process.wait(timeout=10)
+        if upstreams is not None:
+            upstreams.stop()
+        if state_dir is not None:
+            shutil.rmtree(state_dir, ignore_errors=True)
+
+    report = summarize(results, elapsed, sampler.samples if sampler else [])
+    report["scenario"] = args.scenario
+    if args.workers:
+        report["workers"] = args.workers
+    if not args.target:
+        report["audio_cache"] = args.cache
+    report["upstream"] = {"latency_ms": args.latency_ms, "jitter_ms": args.jitter_ms, "error_rate": args.error_rate,
+                          "connect_latency_ms": args.connect_latency_ms}
+    if upstreams is not None:
+        report["upstream"]["edge_connections"] = upstreams.behaviour.edge_connections
+        report["upstream"]["edge_turns"] = upstreams.behaviour.edge_turns
+    print_report(args.scenario, report)
+
+    if args.json_out:
+        with open(args.json_out, 'w', encoding='utf-8') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+
+if __name__ == '__main__':
+    main()
@@ -1,8 +1,14 @@
 import sys
 import os
+import gzip
+import hashlib
 import json
-from flask import Flask, request, jsonify, Response, render_template_string
-from flask_cors import CORS
+import math
+import re
+import threading
+import time
+from contextlib import closing
+from functools import wraps
 
 # Add directories to sys.path to allow imports
 # We add 'app' directory to path so we can import 'server' and its dependencies (config, handle_text, etc.)
@@ -10,34 +16,424 @@ sys.path.append(os.path.join(os.path.dirname(__file__), 'app'))
 # We add 'nano-tts' directory to path so we can import 'app' (as nano_app) and 'nano_tts'
 sys.path.append(os.path.join(os.path.dirname(__file__), 'nano-tts'))
 
+# Imported first so the rest of startup can be timed
+import startup
+from startup import profile
+
+with profile.step('import flask'):
+    from flask import Flask, request, jsonify, Response, render_template_string, g, make_response, send_file
+    from flask_cors import CORS
+
 # Import the existing modules
 # Note: These imports will execute the module-level code in those files, 
-# including creating their own Flask app instances (which we will ignore)
-# and initializing their TTS engines.
+# including creating their own Flask app instances (which we will ignore).
+# Nothing slow or networked runs at import time: edge-tts is imported on first
+# use and the nano voice list is loaded by the background warm-up below.
 try:
-    import server as existing_server
+    with profile.step('import server (edge)'):
+        import server as existing_server
     print("Successfully imported existing openai-edge-tts server module.")
 except ImportError as e:
     print(f"Error importing existing server: {e}")
     sys.exit(1)
 
 try:
-    import app as nano_server
+    with profile.step('import app (nano)'):
+        import app as nano_server
     print("Successfully imported nano-tts app module.")
 except ImportError as e:
     print(f"Error importing nano-tts app: {e}")
     sys.exit(1)
 
+import metrics
+from admission import AdmissionController, Overloaded, ReleasingStream
+from audio_cache import AudioCache, cache_key
+from batch import BatchResult, run_batch, ndjson_stream, zip_stream
+import breaker
+from breaker import get_breaker
+from config import DEFAULT_CONFIGS
+from deadline import TIMEOUT_HEADER, DeadlineExceeded, current_deadline, route_timeout
+from disk_cache import get_disk_cache
+from handle_text import prepare_tts_input_with_context, clean_text, parse_keywords, remove_keywords
+from jobs import JobStore, JobManager, SUCCEEDED
+from logs import REQUEST_ID_HEADER, get_logger, request_id
+from peer_cache import PEER_HEADER, SIGNATURE_HEADER, get_peer_cache
+from popularity import PopularityTracker, POPULARITY_FILE, PREWARM_INTERVAL, PREWARM_TOP_N
+from routing import Router, VOICE_ROUTES, VOICE_ROUTING, backend_for, parse_routes
+from scratch import get_scratch
+import scheduler
+from scheduler import current_work
+from ssml import Segment
+from timing import current_timer
+from tts_handler import generate_speech, generate_speech_stream, convert_audio_file, load_edge_tts, get_edge_pool, voice_mapping
+import utils
+from utils import require_api_key, AUDIO_FORMAT_MIME_TYPES
+
+STARTUP_BUDGET_MS = float(os.getenv('STARTUP_BUDGET_MS', str(DEFAULT_CONFIGS["STARTUP_BUDGET_MS"])))
+
 # Initialize the unified Flask app
 app = Flask(__name__)
 CORS(app)
+log = get_logger('main')
+
+@app.after_request
+def add_request_id(response):
+    # The ID every log record of this request carries, so a client report can be matched to them
+    response.headers[REQUEST_ID_HEADER] = request_id()
+    return response
+
+# Per-backend concurrency limits with a bounded wait queue; excess load is shed with 429
+ADMISSION_QUEUE_SIZE = int(os.getenv('ADMISSION_QUEUE_SIZE', str(DEFAULT_CONFIGS["ADMISSION_QUEUE_SIZE"])))
+ADMISSION_MAX_WAIT = float(os.getenv('ADMISSION_MAX_WAIT', str(DEFAULT_CONFIGS["ADMISSION_MAX_WAIT"])))
+admission = AdmissionController({
+    'nano': (int(os.getenv('NANO_MAX_CONCURRENCY', str(DEFAULT_CONFIGS["NANO_MAX_CONCURRENCY"]))),
+             ADMISSION_QUEUE_SIZE, ADMISSION_MAX_WAIT),
+    'edge': (int(os.getenv('EDGE_MAX_CONCURRENCY', str(DEFAULT_CONFIGS["EDGE_MAX_CONCURRENCY"]))),
+             ADMISSION_QUEUE_SIZE, ADMISSION_MAX_WAIT),
+})
+
+# OpenAI voice aliases -> equivalent voices across both backends, picked per request
+router = Router(parse_routes(VOICE_ROUTES, voice_mapping), VOICE_ROUTING)
+
+class ObservedStream:
+    """Wraps a streamed response body to record time-to-first-byte, total latency and in-flight streams."""
+
+    def __init__(self, iterable, labels, start, on_first_byte=None):
+        self._iterable = iterable
+        self._labels = labels
+        self._start = start
+        self._on_first_byte = on_first_byte
+        self._first_byte_seen = False
+        self._closed = False
+        metrics.INFLIGHT_STREAMS.inc(backend=labels['backend'])
+
+    def __iter__(self):
+        for chunk in self._iterable:
+            if not self._first_byte_seen:
+                self._first_byte_seen = True
+                elapsed = time.perf_counter() - self._start
+                metrics.TIME_TO_FIRST_BYTE.observe(elapsed, **self._labels)
+                if self._on_first_byte:
+                    self._on_first_byte(elapsed)
+            yield chunk
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        try:
+            if hasattr(self._iterable, 'close'):
+                self._iterable.close()
+        finally:
+            metrics.INFLIGHT_STREAMS.dec(backend=self._labels['backend'])
+            metrics.REQUEST_LATENCY.observe(time.perf_counter() - self._start, **self._labels)
+
+def is_stream(response):
+    """Whether a response is produced as it is sent, rather than being a finished file passed through."""
+    return response.is_streamed and not response.direct_passthrough
+
+def response_body(response):
+    """A buffered response's bytes, reading through a file passed through by send_file."""
+    if response.direct_passthrough:
+        return b''.join(response.response)
+    return response.get_data()
+
+def observe_speech(view):
+    """Records request count, latency and TTFB for a speech view, labelled by the backend it routed to."""
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        timer = current_timer()
+        response = make_response(view(*args, **kwargs))
+
+        # Failed requests are folded into one voice label so bad input cannot blow up cardinality
+        voice = g.get('speech_voice') if response.status_code < 400 else None
+        labels = {
+            "backend": g.get('speech_backend', 'none'),
+            "voice": voice or 'other',
+            "stream": 'true' if is_stream(response) else 'false',
+        }
+        metrics.REQUESTS.inc(status=response.status_code, **labels)
+
+        # A routed alias reports back how its backend did; sentences that fell back count as a failure
+        route = g.get('speech_route')
+        ok = response.status_code < 500 and not g.get('sentence_fallbacks')
+        report = (lambda seconds: router.record(route, seconds, ok)) if route else None
+
+        if is_stream(response):
+            response.response = ObservedStream(response.response, labels, start, report)
+        else:
+            elapsed = time.perf_counter() - start
+            metrics.TIME_TO_FIRST_BYTE.observe(elapsed, **labels)
+            metrics.REQUEST_LATENCY.observe(elapsed, **labels)
+            if report:
+                report(elapsed)
+            response.headers['Server-Timing'] = timer.header()
+        return response
+    return wrapper
+
+def admitted(backend, handler, *args):
+    """Runs a backend handler inside an admission slot, holding the slot until a streamed body is closed."""
+    timer = current_timer()
+    try:
+        with timer.phase('admission'):
+            slot = admission.admit(backend, max_wait=current_deadline().remaining())
+    except Overloaded as e:
+        log.warning("Shedding request for %s: %s, retry after %ss", backend, e.reason, e.retry_after)
+        response = jsonify({"error": {"message": str(e), "type": "rate_limit_error", "code": "overloaded"}})
+        response.status_code = 429
+        response.headers['Retry-After'] = str(e.retry_after)
+        return response
+
+    try:
+        response = make_response(handler(*args))
+    except BaseException:
+        slot.release()
+        raise
+    if is_stream(response):
+        response.response = ReleasingStream(response.response, slot)
+    else:
+        slot.release()
+    return response
+
+def upstream_unavailable(upstream):
+    """Fails fast while an upstream's circuit breaker is open."""
+    response = jsonify({"error": f"{upstream} upstream is unavailable (circuit open), please retry later"})
+    response.status_code = 503
+    response.headers['Retry-After'] = str(get_breaker(upstream).retry_after())
+    return response
+
+_ui_page = None
+
+def ui_page():
+    """The UI rendered once, as (html, gzipped html, etag); the template has no per-request content."""
+    global _ui_page
+    if _ui_page is None:
+        html = render_template_string(nano_server.HTML_TEMPLATE).encode('utf-8')
+        _ui_page = (html, gzip.compress(html, 9), hashlib.sha256(html).hexdigest()[:32])
+    return _ui_page
+
+# How often each cacheable request is made: decides what the cache keeps and what is pre-warmed
+popularity = PopularityTracker(PREWARM_TOP_N, POPULARITY_FILE)
+with profile.step('load popularity'):
+    popularity.load()
+
+# Keys double as stored-audio URLs, so they are keyed with a secret (defaults to the API key)
+AUDIO_URL_SECRET = os.getenv('AUDIO_URL_SECRET') or utils.API_KEY
+audio_cache = AudioCache(
+    int(os.getenv('AUDIO_CACHE_MAX_BYTES', str(DEFAULT_CONFIGS["AUDIO_CACHE_MAX_BYTES"]))),
+    int(os.getenv('AUDIO_CACHE_MAX_ENTRY_BYTES', str(DEFAULT_CONFIGS["AUDIO_CACHE_MAX_ENTRY_BYTES"]))),
+    disk=get_disk_cache(),
+    admission=popularity,
+    peers=get_peer_cache(AUDIO_URL_SECRET),
+)
+# Audio for a given key never changes, so clients may keep it; private because requests carry credentials
+AUDIO_CACHE_CONTROL = 'private, max-age=86400'
+# Stored-audio keys as cache_key() makes them; pushed audio is only accepted under such a key
+STORED_KEY = re.compile(r'[0-9a-f]{40}')
+
+def speech_cache_key(backend, data):
+    """The canonical cache key / ETag for a buffered speech request, or None if it is not cacheable."""
+    if data.get('stream') or data.get('stream_format', 'audio') == 'sse':
+        return None
+    text = data.get('input')
+    if not isinstance(text, str) or not text:
+        return None
+    try:
+        return cache_key(
+            AUDIO_URL_SECRET, backend, data.get('voice') or data.get('model'), text,
+            data.get('speed', existing_server.DEFAULT_SPEED), data.get('pitch', 0),
+            data.get('response_format', existing_server.DEFAULT_RESPONSE_FORMAT),
+            data.get('cleaning_options'),
+        )
+    except (TypeError, ValueError):
+        return None  # malformed speed/pitch; let the backend report it
+
+# Request fields that decide the audio, kept so a popular request can be synthesized again
+PREWARM_FIELDS = ('voice', 'input', 'speed', 'pitch', 'response_format', 'cleaning_options')
+
+def request_authorized(backend):
+    """Mirrors the backend's own API key check, for responses served without calling the backend."""
+    auth_header = request.headers.get('Authorization', '')
+    token = auth_header[len('Bearer '):] if auth_header.startswith('Bearer ') else None
+    if backend == 'nano':
+        return token == nano_server.STATIC_API_KEY
+    return not utils.REQUIRE_API_KEY or token == utils.API_KEY
+
+def audio_response(audio, mimetype, key):
+    """A stored-audio response that honours If-None-Match (304), Range (206) and If-Range."""
+    response = Response(audio, mimetype=mimetype)
+    response.set_etag(key)
+    response.headers['Cache-Control'] = AUDIO_CACHE_CONTROL
+    response.headers['Content-Location'] = f'/v1/audio/speech/{key}'
+    if request.method in ('GET', 'HEAD'):
+        return response.make_conditional(request, accept_ranges=True, complete_length=len(audio))
+
+    # Werkzeug only evaluates conditionals for GET/HEAD; POST clients get the same Range handling here
+    response.headers['Accept-Ranges'] = 'bytes'
+    byte_range = request.range
+    if byte_range is None or len(byte_range.ranges) != 1:
+        return response  # no range, or a multi-range request: send everything
+    if 'If-Range' in request.headers and request.if_range.etag != key:
+        return response  # the client's partial copy is of different audio
+    bounds = byte_range.range_for_length(len(audio))
+    if bounds is None:
+        response = Response(status=416)
+        response.headers['Content-Range'] = f'bytes */{len(audio)}'
+        return response
+    start, stop = bounds
+    response.set_data(audio[start:stop])
+    response.status_code = 206
+    response.headers['Content-Range'] = f'bytes {start}-{stop - 1}/{len(audio)}'
+    return response
+
+def cached_speech(backend, data, handler, *args, fail_fast=False):
+    """
+    Serves buffered speech from the audio cache when possible, otherwise synthesizes through
+    admission control and stores the result. Cache hits and revalidations skip admission; with
+    fail_fast they also skip the backend's circuit breaker, which then only refuses (or probes
+    with) requests that need the upstream.
+    """
+    def synthesize():
+        if fail_fast and not get_breaker(backend).allow():
+            return upstream_unavailable(backend)
+        return admitted(backend, handler, *args)
+
+    key = speech_cache_key(backend, data) if audio_cache.enabled else None
+    if key is None or not request_authorized(backend):
+        return synthesize()
+
+    prewarming = g.get('prewarm', False)
+    if not prewarming:
+        popularity.record(key)
+    voice = data.get('voice') or data.get('model')
+    hot_request = {'backend': backend, **{field: data[field] for field in PREWARM_FIELDS if field in data}}
+
+    timer = current_timer()
+    if key in request.if_none_match:
+        # The ETag is the request's canonical key, so a match means the client already has this audio
+        timer.record('cache', 0.0, 'revalidated')
+        g.pop('speech_route', None)  # nothing was synthesized, so there is no backend timing to report
+        response = Response(status=304)
+        response.set_etag(key)
+        response.headers['Cache-Control'] = AUDIO_CACHE_CONTROL
+        return response
+
+    with timer.phase('cache'):
+        entry = audio_cache.get(key)
+    if entry is not None:
+        g.pop('speech_route', None)
+        if not prewarming:
+            popularity.remember(key, voice, hot_request)
+        return audio_response(entry.data, entry.mimetype, key)
+
+    response = synthesize()
+    # Only cache what the requested backend produced; fallback audio is a different voice. Audio
+    # the cache would refuse as too large (or of unknown size) is passed through unread, so a
+    # scratch file is still streamed (or sent with sendfile) rather than loaded into memory.
+    size = response.content_length
+    if (response.status_code == 200 and not is_stream(response) and g.get('speech_backend') == backend
+            and not g.get('sentence_fallbacks') and size is not None and size <= audio_cache.max_entry_bytes):
+        with closing(response):  # frees a scratch file's space
+            audio = response_body(response)
+        audio_cache.put(key, audio, response.mimetype)
+        if not prewarming:
+            popularity.remember(key, voice, hot_request)
+        return audio_response(audio, response.mimetype, key)
+    return response
+
+def prewarm_once():
+    """
+    Synthesizes the hot phrases that are not in the in-memory cache, each only while its backend
+    has spare upstream capacity; they queue behind any interactive work. Returns how many were made.
+    """
+    made = 0
+    for key, hot_request in popularity.hot():
+        backend = hot_request['backend']
+        data = {field: value for field, value in hot_request.items() if field != 'backend'}
+        if audio_cache.contains(key) or 'voice' not in data:
+            continue
+        if not scheduler.get_scheduler(backend).idle() or get_breaker(backend).snapshot()['state'] == breaker.OPEN:
+            continue
+        token = nano_server.STATIC_API_KEY if backend == 'nano' else utils.API_KEY
+        with app.test_request_context('/v1/audio/speech', method='POST', json=data,
+                                      headers={'Authorization': f'Bearer {token}'}):
+            g.prewarm = True
+            g.speech_backend = backend
+            current_work(bulk=True)
+            if backend == 'edge':
+                response = cached_speech(backend, data, existing_server.text_to_speech)
+            else:
+                response = cached_speech(backend, data, nano_with_fallback, data, data['voice'])
+            response.close()
+        if response.status_code == 200:
+            made += 1
+            metrics.PREWARMED.inc(backend=backend)
+    return made
+
+def run_prewarmer():
+    while True:
+        time.sleep(PREWARM_INTERVAL)
+        try:
+            made = prewarm_once()
+            if made:
+                log.info("Pre-warmed %d popular phrases", made)
+            popularity.save()
+        except Exception as e:
+            log.error("Pre-warming failed: %s", e)
+
+def start_prewarmer():
+    # Like the job runner, one process pre-warms; the others find its audio in the shared disk cache
+    if audio_cache.enabled and PREWARM_TOP_N > 0 and PREWARM_INTERVAL > 0 and startup.worker_slot in (None, 0):
+        threading.Thread(target=run_prewarmer, name='prewarm', daemon=True).start()
+
+@app.route('/v1/audio/speech/<key>', methods=['GET'])
+def get_stored_speech(key):
+    """
+    Stored audio by key (the ETag / Content-Location of a buffered speech response), with Range
+    support so an <audio> element can seek. The key is unguessable, so no Authorization is needed.
+    """
+    from_peer = PEER_HEADER in request.headers
+    if not from_peer:  # the replica that asked has already counted the request
+        popularity.record(key)
+    # Another replica asking the owner of this key: answer from this replica's own tiers
+    entry = audio_cache.get(key, local=from_peer)
+    if entry is None:
+        return jsonify({"error": "Audio not found or no longer cached; request it again with POST /v1/audio/speech"}), 404
+    return audio_response(entry.data, entry.mimetype, key)
+
+@app.route('/v1/audio/speech/<key>', methods=['PUT'])
+def put_stored_speech(key):
+    """Audio another replica synthesized for a key this replica owns, signed with the shared key secret."""
+    peers = audio_cache.peers
+    if peers is None or not STORED_KEY.fullmatch(key):
+        return jsonify({"error": "Forbidden"}), 403
+    # Checked before the body is read, so an oversized or unsized upload is never buffered
+    if request.content_length is None or request.content_length > audio_cache.max_entry_bytes:
+        return jsonify({"error": "Audio too large to cache"}), 413
+    data = request.get_data()
+    if not peers.verify(key, data, request.headers.get(SIGNATURE_HEADER)):
+        return jsonify({"error": "Forbidden"}), 403
+    audio_cache.put(key, data, request.mimetype or 'application/octet-stream', share=False)
+    return Response(status=204)
 
 @app.route('/')
 def index():
-    # Serve the nano-tts UI as the main UI, as it's the only one with a web interface
-    return nano_server.index()
+    # Serve the nano-tts UI as the main UI, as it's the only one with a web interface.
+    # It is served precompressed with an ETag, so revalidation costs a 304 and no rendering.
+    html, compressed, etag = ui_page()
+    use_gzip = 'gzip' in request.accept_encodings
+    response = Response(compressed if use_gzip else html, mimetype='text/html')
+    # Each encoding is a different representation, so it gets its own strong ETag
+    response.set_etag(etag + ('-gz' if use_gzip else ''))
+    if use_gzip:
+        response.headers['Content-Encoding'] = 'gzip'
+    response.headers['Vary'] = 'Accept-Encoding'
+    response.headers['Cache-Control'] = 'no-cache'
+    return response.make_conditional(request)
 
 @app.route('/v1/audio/speech', methods=['POST'])
+@observe_speech
 def create_speech():
     try:
         data = request.get_json()
@@ -61,61 +457,385 @@ def create_speech():
         if not voice:
             return jsonify({"error": "Missing 'voice' or 'model' parameter"}), 400
 
+        g.speech_voice = voice
+
+        # The deadline covers admission, retries and every upstream call made for this request
+        current_deadline(route_timeout(data.get('stream') is True or data.get('stream_format') == 'sse'))
+
+        # OpenAI aliases are served by whichever equivalent voice the routing policy picks,
+        # among the backends this request's API key is good for
+        routed = router.choose(voice, request_authorized)
+        if routed is not None:
+            log.info("Routing alias %s to %s", voice, routed)
+            g.speech_route = backend_for(routed)
+            data['voice'] = data['model'] = voice = routed
+
         # Routing logic
         if '-' in voice:
             # Route to existing openai-edge-tts (no retry needed)
-            print(f"Routing to openai-edge-tts for voice: {voice}")
-            return existing_server.text_to_speech()
+            log.info("Routing to openai-edge-tts for voice: %s", voice)
+            g.speech_backend = 'edge'
+            return cached_speech('edge', data, existing_server.text_to_speech, fail_fast=True)
         else:
             # Route to nano-tts with retry and fallback logic
-            print(f"Routing to nano-tts for voice: {voice}")
-            
-            # First attempt
-            try:
-                response = nano_server.create_speech()
-                # Check if response is successful (status code 200-299)
-                if hasattr(response, 'status_code') and 200 <= response.status_code < 300:
-                    return response
-                elif isinstance(response, tuple) and len(response) > 1:
-                    # Handle (response, status_code) tuple
-                    if 200 <= response[1] < 300:
-                        return response
-                else:
-                    # Not a tuple, assume it's successful if no exception
-                    return response
-            except Exception as e:
-                print(f"First nano-tts attempt failed: {e}")
-            
-            # Second attempt (retry)
-            print(f"Retrying nano-tts for voice: {voice}")
-            try:
-                response = nano_server.create_speech()
-                # Check if response is successful
-                if hasattr(response, 'status_code') and 200 <= response.status_code < 300:
-                    return response
-                elif isinstance(response, tuple) and len(response) > 1:
-                    if 200 <= response[1] < 300:
-                        return response
-                else:
-                    return response
-            except Exception as e:
-                print(f"Second nano-tts attempt failed: {e}")
-            
-            # Fallback to edge-tts with default voice
-            print(f"Falling back to edge-tts with default voice: zh-CN-XiaoxiaoNeural")
-            # Modify request data to use edge-tts default voice
-            original_voice = voice
-            data['voice'] = 'zh-CN-XiaoxiaoNeural'
-            # Update the request context with modified data
-            from flask import g
-            g._original_voice = original_voice
-            
-            return existing_server.text_to_speech()
+            log.info("Routing to nano-tts for voice: %s", voice)
+            g.speech_backend = 'nano'
+            return cached_speech('nano', data, nano_with_fallback, data, voice)
             
     except Exception as e:
-        print(f"Error in unified dispatch: {e}")
+        log.exception("Error in unified dispatch: %s", e)
         return jsonify({"error": str(e)}), 500
 
+def nano_with_fallback(data, voice):
+    """
+    Calls nano-tts. Retries and edge fallback happen per sentence inside it, so only the
+    sentences that failed are redone. A 502 (a sentence failed on both backends) and a 504
+    (the request's deadline passed) are returned as is. Any other failure (e.g. the nano engine or voice list being unavailable)
+    falls back to edge for the whole request.
+    """
+    timer = current_timer()
+    try:
+        with timer.phase('nano-attempt'):
+            response = make_response(nano_server.create_speech())
+    except Exception as e:
+        log.warning("nano-tts request failed: %s", e)
+        return edge_fallback(data, voice, timer)
+    if 200 <= response.status_code < 300 or response.status_code in (502, 504):
+        return response
+    log.warning("nano-tts returned %d", response.status_code)
+    return edge_fallback(data, voice, timer)
+
+def edge_fallback(data, voice, timer):
+    """Serves a failed nano-tts request with the matching edge-tts fallback voice."""
+    if not get_breaker('edge').allow():
+        return upstream_unavailable('edge')
+
+    fallback_voice = nano_server.NANO_FALLBACK_VOICES.get(voice, nano_server.NANO_FALLBACK_VOICE)
+    log.warning("Falling back to edge-tts with voice: %s", fallback_voice)
+    metrics.FALLBACKS.inc(from_backend='nano', to_backend='edge')
+    g.speech_backend = 'edge'
+
+    # Modify request data to use the edge-tts fallback voice
+    original_voice = voice
+    data['voice'] = fallback_voice
+    # Update the request context with modified data
+    g._original_voice = original_voice
+    
+    with timer.phase('fallback', 'edge'):
+        return existing_server.text_to_speech()
+
+@app.route('/v1/text-to-speech/<voice_id>/stream', methods=['POST'])
+@app.route('/elevenlabs/v1/text-to-speech/<voice_id>/stream', methods=['POST'])
+@observe_speech
+def elevenlabs_speech_stream(voice_id):
+    """ElevenLabs streaming endpoint (edge voices), under the same deadline, breaker and admission control as /v1/audio/speech."""
+    g.speech_voice = voice_id
+    g.speech_backend = 'edge'
+    current_deadline(route_timeout(True))
+    if not get_breaker('edge').allow():
+        return upstream_unavailable('edge')
+    return admitted('edge', existing_server.elevenlabs_tts_stream, voice_id)
+
+def synthesize_nano_segment(segment, deadline, work):
+    """
+    mp3 audio of one SSML segment on nano-tts, sentence by sentence (nano has no prosody
+    controls). If nano fails, the segment is spoken by the matching edge fallback voice.
+    """
+    sentences = [sentence for sentence in nano_server.split_text_into_sentences(segment.text) if sentence.strip()]
+    try:
+        if not get_breaker('nano').allow():
+            raise RuntimeError("nano-tts circuit breaker is open")
+        return b''.join(nano_server.fetch_audio(sentence, segment.voice, deadline=deadline, work=work)
+                        for sentence in sentences)
+    except DeadlineExceeded:
+        raise
+    except Exception as e:
+        if not get_breaker('edge').allow():
+            raise
+        fallback_voice = nano_server.NANO_FALLBACK_VOICES.get(segment.voice, nano_server.NANO_FALLBACK_VOICE)
+        log.warning("SSML segment on %s failed (%s); falling back to edge-tts with voice: %s", segment.voice, e, fallback_voice)
+        metrics.FALLBACKS.inc(from_backend='nano', to_backend='edge')
+        return existing_server.synthesize_edge_segment(Segment(fallback_voice, segment.text, segment.prosody),
+                                                       deadline, work)
+
+@app.route('/azure/cognitiveservices/v1', methods=['POST'])
+@require_api_key
+def azure_speech():
+    """Azure-compatible SSML synthesis; <voice> blocks may name nano voices as well as edge ones."""
+    return existing_server.ssml_speech({'edge': existing_server.synthesize_edge_segment,
+                                        'nano': synthesize_nano_segment})
+
+BATCH_MAX_ITEMS = int(os.getenv('BATCH_MAX_ITEMS', str(DEFAULT_CONFIGS["BATCH_MAX_ITEMS"])))
+BATCH_MAX_PARALLEL = int(os.getenv('BATCH_MAX_PARALLEL', str(DEFAULT_CONFIGS["BATCH_MAX_PARALLEL"])))
+# Batch-level fields that act as defaults for every item
+BATCH_ITEM_DEFAULTS = ('voice', 'model', 'response_format', 'speed', 'pitch', 'cleaning_options')
+
+@app.route('/v1/audio/speech/batch', methods=['POST'])
+def create_speech_batch():
+    """
+    Synthesizes many items in one request. Each item goes through the same routing, cleaning,
+    retry and admission control as /v1/audio/speech; results are streamed back as they complete,
+    as NDJSON lines with base64 audio (default) or as a zip archive ("output": "zip").
+    """
+    data = request.get_json(silent=True)
+    if not data or not isinstance(data.get('items'), list) or not data['items']:
+        return jsonify({"error": "Request body must contain a non-empty 'items' list"}), 400
+    items = data['items']
+    if len(items) > BATCH_MAX_ITEMS:
+        return jsonify({"error": f"Too many items: {len(items)} (maximum is {BATCH_MAX_ITEMS})"}), 400
+    if not all(isinstance(item, dict) for item in items):
+        return jsonify({"error": "Every item must be a JSON object"}), 400
+
+    output = data.get('output')
+    if output is None:
+        output = 'zip' if request.accept_mimetypes.best == 'application/zip' else 'ndjson'
+    if output not in ('ndjson', 'zip'):
+        return jsonify({"error": "'output' must be 'ndjson' or 'zip'"}), 400
+
+    defaults = {key: data[key] for key in BATCH_ITEM_DEFAULTS if key in data}
+    # Items are dispatched outside this request, so carry its credentials along
+    headers = {'Authorization': request.headers.get('Authorization', '')}
+    if TIMEOUT_HEADER in request.headers:
+        headers[TIMEOUT_HEADER] = request.headers[TIMEOUT_HEADER]  # a deadline for each item
+
+    def synthesize(index, item):
+        item = {**defaults, **item}
+        payload = {key: value for key, value in item.items() if key != 'id'}
+        payload['stream'] = False
+        payload.pop('stream_format', None)
+        with app.test_request_context('/v1/audio/speech', method='POST', json=payload, headers=headers):
+            current_work(bulk=True)  # batch items queue for upstream calls behind interactive requests
+            response = make_response(create_speech())
+            try:
+                body = response_body(response)
+            finally:
+                response.close()
+        if response.status_code >= 400:
+            return BatchResult(index, item, response.status_code, error=_error_message(body))
+        return BatchResult(index, item, response.status_code, audio=body, mimetype=response.mimetype)
+
+    log.info("Batch of %d items, output=%s", len(items), output)
+    results = run_batch(items, synthesize, BATCH_MAX_PARALLEL)
+    if output == 'zip':
+        return Response(zip_stream(results), mimetype='application/zip',
+                        headers={'Content-Disposition': 'attachment; filename="speech-batch.zip"'})
+    return Response(ndjson_stream(results), mimetype='application/x-ndjson',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+def _error_message(body):
+    try:
+        error = json.loads(body).get('error')
+    except (ValueError, AttributeError):
+        return body.decode('utf-8', 'replace')[:200]
+    if isinstance(error, dict):
+        return error.get('message', str(error))
+    return str(error)
+
+JOBS_DIR = os.getenv('JOBS_DIR', DEFAULT_CONFIGS["JOBS_DIR"])
+JOB_WORKERS = int(os.getenv('JOB_WORKERS', str(DEFAULT_CONFIGS["JOB_WORKERS"])))
+JOB_MAX_ATTEMPTS = int(os.getenv('JOB_MAX_ATTEMPTS', str(DEFAULT_CONFIGS["JOB_MAX_ATTEMPTS"])))
+# Pre-forked workers share the job store but only the first runs jobs; it polls for the others' submissions
+JOB_POLL_INTERVAL = 2.0
+
+def synthesize_job_chunk(job, text):
+    """Synthesizes one chunk of a job as mp3 bytes on the job's backend."""
+    if job['backend'] == 'nano':
+        return nano_server.fetch_audio(text, job['voice'])
+    output_path = generate_speech(text, job['voice'], 'mp3', job['speed'], job['pitch'])
+    try:
+        with open(output_path, 'rb') as f:
+            return f.read()
+    finally:
+        get_scratch().release(output_path)
+
+def finalize_job_audio(mp3_path, response_format):
+    if response_format == 'mp3':
+        return mp3_path
+    return convert_audio_file(mp3_path, response_format)
+
+def start_job_workers():
+    if startup.worker_slot in (None, 0):
+        job_manager.start()
+
+with profile.step('init jobs'):
+    job_manager = JobManager(
+        JobStore(JOBS_DIR), synthesize_job_chunk, finalize_job_audio,
+        workers=JOB_WORKERS, max_attempts=JOB_MAX_ATTEMPTS,
+        poll_interval=JOB_POLL_INTERVAL if startup.prefork else None,
+    )
+    startup.per_process(start_job_workers)
+
+@app.route('/v1/audio/jobs', methods=['POST'])
+@require_api_key
+def create_job():
+    """
+    Submits a long text for background synthesis. The text is cleaned and split up front,
+    then synthesized chunk by chunk; poll the job for progress and fetch /content when done.
+    """
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict) or not isinstance(data.get('input'), str) or not data['input'].strip():
+        return jsonify({"error": "Missing 'input' in request body"}), 400
+    voice = data.get('voice') or data.get('model') or ''
+    voice = voice.strip() if isinstance(voice, str) else ''
+    if not voice:
+        return jsonify({"error": "Missing 'voice' or 'model' parameter"}), 400
+
+    voice = router.choose(voice) or voice  # a job stays on the voice its alias resolves to now
+    text = data['input']
+    cleaning_options = data.get('cleaning_options') or {}
+    if not isinstance(cleaning_options, dict):
+        return jsonify({"error": "cleaning_options must be an object"}), 400
+    response_format = data.get('response_format', 'mp3')
+    if not isinstance(response_format, str) or response_format not in AUDIO_FORMAT_MIME_TYPES:
+        return jsonify({"error": f"Unsupported response_format '{response_format}'"}), 400
+    # Checked before anything is queued; a bad value would otherwise fail every chunk later
+    try:
+        speed = float(data.get('speed', 1.0))
+        if not math.isfinite(speed) or speed <= 0:
+            raise ValueError
+    except (TypeError, ValueError):
+        return jsonify({"error": "speed must be a positive number"}), 400
+    try:
+        pitch = int(data.get('pitch', 0))
+    except (TypeError, ValueError, OverflowError):
+        return jsonify({"error": "pitch must be an integer"}), 400
+
+    # Same routing and cleaning rules as /v1/audio/speech
+    if '-' in voice:
+        backend = 'edge'
+        if cleaning_options:
+            text = clean_text(text, cleaning_options)
+        elif not existing_server.REMOVE_FILTER:
+            text = prepare_tts_input_with_context(text)
+        # Edge handles long passages well, so short sentences are merged into fewer, larger chunks
+        chunks = nano_server.split_text_into_sentences(text, min_length=200, max_length=1000)
+    else:
+        backend = 'nano'
+        if voice not in nano_server.model_cache.get_models():
+            return jsonify({"error": f"Model '{voice}' not found. Please use the /v1/models endpoint to see available models."}), 404
+        custom_keywords = cleaning_options.get('custom_keywords', '')
+        if custom_keywords:
+            text = remove_keywords(text, parse_keywords(custom_keywords))
+        chunks = nano_server.split_text_into_sentences(text)
+
+    chunks = [chunk for chunk in chunks if chunk.strip()]
+    if not chunks:
+        return jsonify({"error": "No speakable text left after cleaning"}), 400
+
+    job_id = job_manager.submit(voice, backend, response_format, speed, pitch, chunks)
+    log.info("Job %s submitted: %d chunks on %s for voice %s", job_id, len(chunks), backend, voice)
+    return jsonify(job_manager.describe(job_id)), 202
+
+@app.route('/v1/audio/jobs/<job_id>', methods=['GET'])
+@require_api_key
+def get_job(job_id):
+    description = job_manager.describe(job_id)
+    if description is None:
+        return jsonify({"error": "Job not found"}), 404
+    return jsonify(description)
+
+@app.route('/v1/audio/jobs/<job_id>/content', methods=['GET'])
+@require_api_key
+def get_job_content(job_id):
+    job = job_manager.store.get(job_id)
+    if job is None:
+        return jsonify({"error": "Job not found"}), 404
+    if job['status'] != SUCCEEDED:
+        return jsonify({"error": f"Job is {job['status']}, audio is not available yet"}), 409
+    # Without FFmpeg the result stays mp3 whatever format was requested
+    extension = os.path.splitext(job['result_path'])[1].lstrip('.')
+    mimetype = AUDIO_FORMAT_MIME_TYPES.get(extension, 'audio/mpeg')
+    return send_file(os.path.abspath(job['result_path']), mimetype=mimetype,
+                     download_name=f"{job_id}.{extension}")
+
+@app.route('/v1/audio/jobs/<job_id>/resume', methods=['POST'])
+@require_api_key
+def resume_job(job_id):
+    """Requeues a failed or cancelled job; chunks already synthesized are kept."""
+    if job_manager.store.get(job_id) is None:
+        return jsonify({"error": "Job not found"}), 404
+    if not job_manager.resume(job_id):
+        return jsonify({"error": "Only failed or cancelled jobs can be resumed"}), 409
+    return jsonify(job_manager.describe(job_id)), 202
+
+@app.route('/v1/audio/jobs/<job_id>', methods=['DELETE'])
+@require_api_key
+def delete_job(job_id):
+    """Cancels the job if it is still running and removes its audio."""
+    if job_manager.store.get(job_id) is None:
+        return jsonify({"error": "Job not found"}), 404
+    job_manager.cancel(job_id)
+    job_manager.store.delete(job_id)
+    return jsonify({"id": job_id, "object": "audio.job", "deleted": True})
+
+def warm_up_edge():
+    load_edge_tts()
+    startup.per_process(get_edge_pool)  # starts the websocket pool's event loop
+    existing_server.prepare_tts_input_with_context('')  # loads the emoji tables
+    return True
+
+def warm_up_nano():
+    return nano_server.model_cache is not None and bool(nano_server.model_cache.get_models())
+
+def probe_edge(text, voice):
+    with closing(generate_speech_stream(text, voice)) as chunks:
+        next(chunks)
+
+def start_route_probes():
+    router.start_probing({'nano': nano_server.fetch_audio, 'edge': probe_edge})
+
+# Slow backend setup happens off the startup path; /readyz reports when it is done
+startup.warm_up([('edge', warm_up_edge), ('nano', warm_up_nano)])
+startup.per_process(start_route_probes)
+startup.per_process(start_prewarmer)
+
+@app.route('/healthz', methods=['GET'])
+def healthz():
+    """Liveness: the process is up and serving requests. Breaker state is informational."""
+    return jsonify({"status": "ok", "breakers": breaker.snapshot(), "routing": router.snapshot(),
+                    "scheduler": scheduler.snapshot(),
+                    "peers": audio_cache.peers.snapshot() if audio_cache.peers is not None else None})
+
+@app.route('/readyz', methods=['GET'])
+def readyz():
+    """
+    Readiness: every backend has finished warming up. Circuit breaker state is reported
+    but does not fail readiness, since an open breaker is already handled by fallback.
+    Reads in-memory state only; no templates, no network.
+    """
+    ready = startup.readiness.is_ready()
+    body = {
+        "status": "ready" if ready else "not_ready",
+        "backends": startup.readiness.snapshot(),
+        "breakers": breaker.snapshot(),
+        "startup": profile.summary(),
+    }
+    return jsonify(body), 200 if ready else 503
+
+@app.route('/metrics', methods=['GET'])
+def prometheus_metrics():
+    """Exposes service metrics in the Prometheus text format."""
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+VOICE_JSON_PATH = os.path.join(os.path.dirname(__file__), 'voice.json')
+_voice_index = (None, [])
+
+def voice_index():
+    """The entries of voice.json, parsed again only after the file changes."""
+    global _voice_index
+    mtime = os.stat(VOICE_JSON_PATH).st_mtime_ns
+    if _voice_index[0] != mtime:
+        with open(VOICE_JSON_PATH, 'r', encoding='utf-8') as f:
+            _voice_index = (mtime, json.load(f))
+    return _voice_index[1]
+
+# Parsed at import, so pre-forked workers share one copy
+with profile.step('load voice index'):
+    try:
+        voice_index()
+    except (OSError, ValueError) as e:
+        print(f"Error loading voice.json: {e}")
+
 @app.route('/v1/models', methods=['GET'])
 def list_models():
     """
@@ -123,11 +843,8 @@ def list_models():
     This provides a simple, consistent model list from the centralized voice configuration.
     """
     try:
-        # Read voice.json from the project root
-        voice_json_path = os.path.join(os.path.dirname(__file__), 'voice.json')
-        with open(voice_json_path, 'r', encoding='utf-8') as f:
-            voices = json.load(f)
-        
+        voices = voice_index()
+
         # Convert voice entries to OpenAI-compatible model format
         models = []
         for voice in voices:
@@ -152,11 +869,15 @@ def list_models():
         return jsonify({"object": "list", "data": models})
         
     except Exception as e:
-        print(f"Error loading voice.json: {e}")
+        log.error("Error loading voice.json: %s", e)
         # Fallback to empty list on error
         return jsonify({"object": "list", "data": []})
 
+# Everything above runs at import time, whichever server hosts the app
+profile.mark_serving()
+
 if __name__ == "__main__":
     port = int(os.environ.get('PORT', 5050))
+    print(profile.report(STARTUP_BUDGET_MS))
     print(f"Unified TTS Server running on port {port}")
     app.run(host='0.0.0.0', port=port)
@@ -1,13 +1,34 @@
 # app.py
 
-from flask import Flask, request, Response, jsonify, render_template_string, stream_with_context
+from flask import Flask, request, Response, jsonify, render_template_string, stream_with_context, g
 from flask_cors import CORS
 from nano_tts import NanoAITTS
 import threading
 import time
+from contextlib import closing
 import base64
 import json
+import os
 import re
+import sys
+
+# 共享的文本处理等工具位于 ../app 目录（与 main.py 的导入方式一致）
+sys.path.append(os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'app'))
+from handle_text import parse_keywords, remove_keywords
+from breaker import get_breaker
+from config import DEFAULT_CONFIGS
+from deadline import DeadlineExceeded, UPSTREAM_TIMEOUT, current_deadline, route_timeout
+from disconnect import ClientDisconnected, watch_client
+from logs import get_logger
+from metrics import (UPSTREAM_LATENCY, UPSTREAM_ERRORS, MODEL_CACHE_REFRESHES, RETRIES, FALLBACKS,
+                     DEADLINES_EXCEEDED, CLIENT_DISCONNECTS)
+from retry import RetryBudget, REQUEST_BUDGET
+from scheduler import current_work, get_scheduler
+from timing import current_timer
+from tts_handler import generate_speech_stream
+from utils import format_sse_event
+
+log = get_logger('nano')
 
 # --- 文本分句工具 ---
 def split_text_into_sentences(text, min_length=10, max_length=500):
@@ -84,6 +105,20 @@ def split_text_into_sentences(text, min_length=10, max_length=500):
 # --- 配置 ---
 STATIC_API_KEY = "sk-123456"
 CACHE_DURATION_SECONDS = 2 * 60 * 60
+STREAM_CHUNK_SIZE = 4096  # 流式读取上游音频的块大小
+
+def parse_voice_map(value):
+    """解析 "DeepSeek=zh-CN-YunxiNeural,Kimi=zh-CN-XiaoyiNeural" 形式的声音映射"""
+    mapping = {}
+    for pair in value.split(','):
+        name, _, edge_voice = pair.partition('=')
+        if name.strip() and edge_voice.strip():
+            mapping[name.strip()] = edge_voice.strip()
+    return mapping
+
+# 单句降级时使用的 Edge-TTS 声音：优先按 nano 声音映射，否则使用默认声音
+NANO_FALLBACK_VOICE = os.getenv('NANO_FALLBACK_VOICE', DEFAULT_CONFIGS["NANO_FALLBACK_VOICE"])
+NANO_FALLBACK_VOICES = parse_voice_map(os.getenv('NANO_FALLBACK_VOICES', DEFAULT_CONFIGS["NANO_FALLBACK_VOICES"]))
 
 # --- 缓存管理器 ---
 class ModelCache:
@@ -97,23 +132,169 @@ class ModelCache:
         with self._lock:
             current_time = time.time()
             if not self._cache or (current_time - self._last_updated > CACHE_DURATION_SECONDS):
-                print("缓存过期或为空，正在刷新模型列表...")
+                log.info("缓存过期或为空，正在刷新模型列表...")
                 try:
                     self._tts_engine.load_voices()
                     self._cache = {tag: info['name'] for tag, info in self._tts_engine.voices.items()}
                     self._last_updated = current_time
-                    print(f"模型列表刷新成功，共找到 {len(self._cache)} 个模型。")
+                    MODEL_CACHE_REFRESHES.inc(outcome="success")
+                    log.info("模型列表刷新成功，共找到 %d 个模型。", len(self._cache))
                 except Exception as e:
-                    print(f"刷新模型列表失败: {e}")
+                    MODEL_CACHE_REFRESHES.inc(outcome="error")
+                    log.error("刷新模型列表失败: %s", e)
             return self._cache
 
+def _open_stream(upstream_response, deadline):
+    """
+    读取首个音频块以确认上游返回的是音频而不是 JSON 错误，返回从首块开始的音频块迭代器。
+    超过请求截止时间后停止读取。
+    """
+    first = upstream_response.read(STREAM_CHUNK_SIZE)
+    error = None
+    if not first:
+        error = "空响应"
+    elif first.startswith(b'{'):
+        try:
+            body = json.loads(first)
+        except ValueError:
+            body = None
+        if isinstance(body, dict) and body.get('msg') == 'Fail':
+            error = (body.get('data') or {}).get('reason') or body
+    if error is not None:
+        upstream_response.close()
+        raise Exception(f"上游 API 错误: {error}")
+
+    def chunks():
+        try:
+            yield first
+            while True:
+                deadline.check()
+                chunk = upstream_response.read(STREAM_CHUNK_SIZE)
+                if not chunk:
+                    break
+                yield chunk
+        finally:
+            try:
+                upstream_response.close()
+            except Exception:
+                pass
+    return chunks()
+
+def fetch_audio(sentence, voice, stream=False, deadline=None, work=None):
+    """
+    请求上游 TTS，记录上游耗时与错误次数并更新熔断器。
+    流式请求返回音频块迭代器，只计到首个音频块返回。
+    调用前在调度器中排队取得上游名额（首句优先，同一优先级内各 API Key 轮流），
+    流式请求的名额保持到音频块迭代器读完或关闭。
+    超时取请求剩余时间（不超过 UPSTREAM_TIMEOUT），截止时间已过则抛出 DeadlineExceeded。
+    在请求上下文之外调用（如 SSML 分段合成线程）时由调用方传入 deadline 与 work。
+    """
+    deadline = deadline or current_deadline()
+    work = work or current_work()
+    scheduler = get_scheduler('nano')
+    scheduler.acquire(work, deadline)
+    ok = held = False
+    start = time.perf_counter()
+    try:
+        timeout = deadline.timeout(UPSTREAM_TIMEOUT)
+        audio = tts_engine.get_audio(sentence, voice=voice, stream=stream, timeout=timeout)
+        if stream:
+            audio = scheduler.hold(_open_stream(audio, deadline), work)
+            held = True
+    except Exception:
+        if deadline.reached():
+            # 超时是因为请求的时间用完了，不算上游故障
+            raise deadline.exceeded()
+        UPSTREAM_ERRORS.inc(upstream="nano")
+        get_breaker('nano').record_failure()
+        raise
+    else:
+        get_breaker('nano').record_success()
+        ok = True
+        return audio
+    finally:
+        if not held:
+            scheduler.release(work, ok)
+        UPSTREAM_LATENCY.observe(time.perf_counter() - start, upstream="nano")
+
+# --- 单句重试与降级 ---
+# 只重试失败的句子（指数退避加随机抖动，整个请求共享重试时间预算），重试用尽后仅该句改用
+# 匹配的 Edge-TTS 声音合成；已成功的句子不会重新合成，输出顺序保持不变。
+
+def _retry_or_give_up(budget, attempt, label, error):
+    """记录一次失败；可以重试时等待退避时间并返回 True"""
+    delay = budget.next_delay(attempt)
+    if delay is None:
+        log.warning("%s 第 %d 次合成失败: %s，不再重试", label, attempt, error)
+        return False
+    log.warning("%s 第 %d 次合成失败: %s，%.2f 秒后重试", label, attempt, error, delay)
+    RETRIES.inc(backend='nano')
+    time.sleep(delay)
+    return True
+
+def fallback_stream(sentence, voice, label):
+    """用与 nano 声音匹配的 Edge-TTS 声音合成单句，返回音频块迭代器（受同一截止时间约束）"""
+    if not get_breaker('edge').allow():
+        raise Exception("Nano-TTS 与 Edge-TTS 均不可用")
+    edge_voice = NANO_FALLBACK_VOICES.get(voice, NANO_FALLBACK_VOICE)
+    log.warning("%s 降级到 Edge-TTS 声音: %s", label, edge_voice)
+    FALLBACKS.inc(from_backend='nano', to_backend='edge')
+    g.sentence_fallbacks = g.get('sentence_fallbacks', 0) + 1
+    return generate_speech_stream(sentence, edge_voice, deadline=current_deadline())
+
+def synthesize_sentence(sentence, voice, budget, label):
+    """非流式合成单句，返回 (音频, 后端)"""
+    timer = current_timer()
+    attempt = 0
+    while get_breaker('nano').allow():
+        attempt += 1
+        try:
+            with timer.phase('upstream', label if attempt == 1 else f"{label} attempt {attempt}"):
+                audio = fetch_audio(sentence, voice, stream=False)
+            if audio:
+                return audio, 'nano'
+            error = "上游返回了空音频"
+        except DeadlineExceeded:
+            raise
+        except Exception as e:
+            error = e
+        if not _retry_or_give_up(budget, attempt, label, error):
+            break
+    with timer.phase('fallback', label):
+        return b''.join(fallback_stream(sentence, voice, label)), 'edge'
+
+def stream_sentence(sentence, voice, budget, label):
+    """
+    流式合成单句，逐块产出 (后端, 音频块)。
+    收到首个音频块之前的失败会重试或降级；音频已开始输出后的失败直接抛出。
+    """
+    attempt = 0
+    while get_breaker('nano').allow():
+        attempt += 1
+        try:
+            chunks = fetch_audio(sentence, voice, stream=True)
+        except DeadlineExceeded:
+            raise
+        except Exception as e:
+            if not _retry_or_give_up(budget, attempt, label, e):
+                break
+            continue
+        with closing(chunks):
+            for chunk in chunks:
+                yield 'nano', chunk
+        return
+    with closing(fallback_stream(sentence, voice, label)) as chunks:
+        for chunk in chunks:
+            yield 'edge', chunk
+
 # --- 初始化 ---
 app = Flask(__name__)
 CORS(app)  # 启用 CORS 支持
 
 try:
     print("正在初始化 TTS 引擎...")
-    tts_engine = NanoAITTS()
+    # 不在导入时加载声音列表（可能需要联网），由 ModelCache 在首次使用或后台预热时加载
+    tts_engine = NanoAITTS(preload_voices=False)
     print("TTS 引擎初始化完毕。")
     model_cache = ModelCache(tts_engine)
 except Exception as e:
@@ -771,6 +952,7 @@ def index():
 # --- API 端点 ---
 @app.route('/v1/audio/speech', methods=['POST'])
 def create_speech():
+    timer = current_timer()
     if not tts_engine:
         return jsonify({"error": "TTS engine is not available due to initialization failure."}), 503
 
@@ -793,7 +975,8 @@ def create_speech():
     if not model_id or not text_input:
         return jsonify({"error": "Missing required fields: 'model' and 'input'"}), 400
 
-    available_models = model_cache.get_models()
+    with timer.phase('models'):
+        available_models = model_cache.get_models()
     if model_id not in available_models:
         return jsonify({"error": f"Model '{model_id}' not found. Please use the /v1/models endpoint to see available models."}), 404
 
@@ -806,108 +989,148 @@ def create_speech():
     cleaning_options = data.get('cleaning_options', {})
     custom_keywords = cleaning_options.get('custom_keywords', '')
     
-    # 文本清理逻辑
+    # 文本清理逻辑（关键词列表按字符串缓存，单次扫描移除全部关键词）
     if custom_keywords:
-        keywords = [k.strip() for k in custom_keywords.split(',') if k.strip()]
-        for keyword in keywords:
-            text_input = text_input.replace(keyword, '')
+        with timer.phase('clean'):
+            text_input = remove_keywords(text_input, parse_keywords(custom_keywords))
             
     # 处理 stream 参数
     stream = data.get('stream', False)
 
-    print(f"收到请求: model='{model_id}', input='{text_input[:30]}...', stream={stream}")
+    # 请求截止时间（统一入口已设置时沿用），重试预算不超过剩余时间
+    deadline = current_deadline(route_timeout(stream))
+
+    # 只记录文本长度，不记录用户文本
+    log.info("收到请求", extra={"voice": model_id, "chars": len(text_input), "stream": bool(stream)})
 
     try:
         if stream:
             # 流式响应 - 按句子分割处理
-            sentences = split_text_into_sentences(text_input)
-            print(f"文本已分割为 {len(sentences)} 个句子进行流式处理")
+            with timer.phase('split'):
+                sentences = split_text_into_sentences(text_input)
+            log.debug("文本已分割为 %d 个句子进行流式处理", len(sentences))
             
+            # 在请求上下文中取得客户端连接，流式过程中据此及时发现断开
+            watch = watch_client()
+
             def generate():
-                chunk_size = 4096  # 每次读取的块大小
-                
-                for idx, sentence in enumerate(sentences):
-                    if not sentence.strip():
-                        continue
-                    
-                    print(f"处理句子 {idx + 1}/{len(sentences)}: '{sentence[:30]}...'")
-                    
-                    try:
-                        # 为每个句子请求上游 TTS
-                        upstream_response = tts_engine.get_audio(sentence, voice=model_id, stream=True)
-                        
-                        # 流式读取并返回音频块
-                        while True:
-                            chunk = upstream_response.read(chunk_size)
-                            if not chunk:
-                                break
-                            
-                            # 将音频块编码为 base64
-                            audio_base64 = base64.b64encode(chunk).decode('utf-8')
-                            
-                            # 构造 SSE 事件数据
-                            event_data = {
-                                "type": "speech.audio.delta",
-                                "audio": audio_base64,
-                                "sentence_index": idx,
-                                "total_sentences": len(sentences)
-                            }
-                            
-                            yield f"data: {json.dumps(event_data)}\n\n"
-                        
-                        # 关闭这个句子的响应
+                budget = RetryBudget(min(REQUEST_BUDGET, deadline.remaining()))
+                try:
+                    for idx, sentence in enumerate(sentences):
+                        if not sentence.strip():
+                            continue
+
+                        # 客户端已断开时不再请求后面的句子
+                        watch.check()
+                        log.debug("处理句子 %d/%d (%d 字)", idx + 1, len(sentences), len(sentence))
+                        label = f"sentence {idx + 1}/{len(sentences)}"
+                        sentence_start = time.perf_counter()
+
                         try:
-                            upstream_response.close()
-                        except:
-                            pass
-                            
-                    except Exception as e:
-                        print(f"处理句子 {idx + 1} 时出错: {e}")
-                        # 发送错误事件但继续处理下一个句子
-                        error_event = {
-                            "type": "speech.error",
-                            "error": str(e),
-                            "sentence_index": idx
-                        }
-                        yield f"data: {json.dumps(error_event)}\n\n"
-                        continue
-                
+                            # 为每个句子请求上游 TTS（失败时只重试或降级这一句），流式返回音频块；
+                            # 生成器关闭时（客户端断开）上游连接随之关闭
+                            with closing(stream_sentence(sentence, model_id, budget, label)) as sentence_chunks:
+                                for backend, chunk in sentence_chunks:
+                                    watch.check()
+
+                                    # 将音频块编码为 base64
+                                    audio_base64 = base64.b64encode(chunk).decode('utf-8')
+
+                                    # 构造 SSE 事件数据
+                                    event_data = {
+                                        "type": "speech.audio.delta",
+                                        "audio": audio_base64,
+                                        "sentence_index": idx,
+                                        "total_sentences": len(sentences)
+                                    }
+                                    if backend != 'nano':
+                                        event_data["backend"] = backend
+
+                                    yield format_sse_event(event_data)
+
+                            timer.record('upstream', time.perf_counter() - sentence_start, label)
+
+                        except ClientDisconnected:
+                            raise
+                        except DeadlineExceeded as e:
+                            # 截止时间已过：放弃剩余句子
+                            log.warning("处理句子 %d 时超过截止时间，停止合成: %s", idx + 1, e)
+                            DEADLINES_EXCEEDED.inc(backend='nano')
+                            yield format_sse_event({
+                                "type": "speech.error",
+                                "error": str(e),
+                                "code": "deadline_exceeded",
+                                "sentence_index": idx
+                            })
+                            return
+                        except Exception as e:
+                            timer.record('upstream', time.perf_counter() - sentence_start, f"{label} failed")
+                            log.error("处理句子 %d 时出错: %s", idx + 1, e)
+                            # 重试与降级都失败：发送错误事件但继续处理下一个句子
+                            error_event = {
+                                "type": "speech.error",
+                                "error": str(e),
+                                "sentence_index": idx
+                            }
+                            yield format_sse_event(error_event)
+                            continue
+                except (GeneratorExit, ClientDisconnected) as e:
+                    # 客户端已断开：停止合成剩余句子，进行中的上游读取已随句子生成器关闭
+                    log.info("客户端已断开，停止合成剩余句子")
+                    CLIENT_DISCONNECTS.inc(backend='nano')
+                    if isinstance(e, GeneratorExit):
+                        raise
+                    return
+
                 # 发送完成标记
                 done_event = {
                     "type": "speech.done",
-                    "total_sentences": len(sentences)
+                    "total_sentences": len(sentences),
+                    "timing": timer.summary()
                 }
-                yield f"data: {json.dumps(done_event)}\n\n"
+                yield format_sse_event(done_event)
 
             return Response(stream_with_context(generate()), mimetype='text/event-stream')
         else:
             # 非流式响应 - 按句子分割处理并合并
-            sentences = split_text_into_sentences(text_input)
-            print(f"非流式模式: 文本已分割为 {len(sentences)} 个句子")
+            with timer.phase('split'):
+                sentences = split_text_into_sentences(text_input)
+            log.debug("非流式模式: 文本已分割为 %d 个句子", len(sentences))
             
-            all_audio_data = b''
+            budget = RetryBudget(min(REQUEST_BUDGET, deadline.remaining()))
+            audio_chunks = []
             for idx, sentence in enumerate(sentences):
                 if not sentence.strip():
                     continue
                 
-                print(f"处理句子 {idx + 1}/{len(sentences)}: '{sentence[:30]}...'")
+                log.debug("处理句子 %d/%d (%d 字)", idx + 1, len(sentences), len(sentence))
                 
                 try:
-                    audio_chunk = tts_engine.get_audio(sentence, voice=model_id, stream=False)
-                    if audio_chunk:
-                        all_audio_data += audio_chunk
+                    audio_chunk, _ = synthesize_sentence(sentence, model_id, budget, f"sentence {idx + 1}/{len(sentences)}")
+                except DeadlineExceeded as e:
+                    log.warning("处理句子 %d 时超过截止时间，停止合成: %s", idx + 1, e)
+                    DEADLINES_EXCEEDED.inc(backend='nano')
+                    return jsonify({"error": str(e), "code": "deadline_exceeded", "sentence_index": idx}), 504
                 except Exception as e:
-                    print(f"处理句子 {idx + 1} 时出错: {e}")
-                    # 继续处理下一个句子
-                    continue
+                    # 重试与降级都失败时整个请求失败，而不是返回缺了一句的音频
+                    log.error("处理句子 %d 时出错: %s", idx + 1, e)
+                    return jsonify({"error": f"Failed to generate audio for sentence {idx + 1}: {e}", "sentence_index": idx}), 502
+                if audio_chunk:
+                    audio_chunks.append(audio_chunk)
+            
+            with timer.phase('assemble'):
+                all_audio_data = b''.join(audio_chunks)
             
             if not all_audio_data:
                 return jsonify({"error": "Failed to generate audio for any sentence"}), 500
             
-            return Response(all_audio_data, mimetype='audio/mpeg')
+            headers = {'Server-Timing': timer.header()}
+            if g.get('sentence_fallbacks'):
+                headers['X-Sentence-Fallbacks'] = str(g.sentence_fallbacks)
+            return Response(all_audio_data, mimetype='audio/mpeg', headers=headers)
 
     except Exception as e:
-        print(f"TTS 引擎错误: {e}")
+        log.error("TTS 引擎错误: %s", e)
         return jsonify({"error": f"Failed to generate audio: {e}"}), 500
 
 @app.route('/v1/models', methods=['GET'])
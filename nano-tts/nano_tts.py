@@ -4,13 +4,20 @@ import urllib.request
 import urllib.parse
 import hashlib
 import json
+import logging
 import os
 from datetime import datetime
 import random
 import time
 
+# 由 app/logs.py 配置的非阻塞日志（单独使用本模块时为标准 logging 的默认行为）
+log = logging.getLogger('tts.nano.engine')
+
+# 上游服务地址，可通过环境变量指向本地替身服务（例如压测时）
+BASE_URL = os.getenv('NANO_TTS_BASE_URL', 'https://bot.n.cn').rstrip('/')
+
 class NanoAITTS:
-    def __init__(self):
+    def __init__(self, preload_voices=True):
         self.name = '纳米AI'
         self.id = 'bot.n.cn'
         self.author = 'TTS Server'
@@ -18,7 +25,9 @@ class NanoAITTS:
         self.version = 2
         self.ua = "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/117.0.0.0 Safari/537.36"
         self.voices = {}
-        self.load_voices()
+        # 声音列表可能需要联网获取，preload_voices=False 时推迟到首次使用（由 ModelCache 加载）
+        if preload_voices:
+            self.load_voices()
     
     def md5(self, msg):
         """MD5 哈希函数"""
@@ -101,12 +110,12 @@ class NanoAITTS:
         except Exception as e:
             raise Exception(f"HTTP GET 请求失败: {e}")
     
-    def http_post(self, url, data, headers, stream=False):
+    def http_post(self, url, data, headers, stream=False, timeout=30):
         """使用标准库发送 POST 请求"""
         data_bytes = data.encode('utf-8')
         req = urllib.request.Request(url, data=data_bytes, headers=headers, method='POST')
         try:
-            response = urllib.request.urlopen(req, timeout=30)
+            response = urllib.request.urlopen(req, timeout=timeout)
             if stream:
                 return response
             with response as res:
@@ -123,10 +132,13 @@ class NanoAITTS:
                 with open(filename, 'r', encoding='utf-8') as f:
                     data = json.load(f)
             else:
-                response_text = self.http_get('https://bot.n.cn/api/robot/platform', self.get_headers())
+                response_text = self.http_get(f'{BASE_URL}/api/robot/platform', self.get_headers())
                 data = json.loads(response_text)
-                with open(filename, 'w', encoding='utf-8') as f:
+                # 先写临时文件再改名：多个工作进程可能同时写入，读取方不会读到写了一半的文件
+                partial = f'{filename}.{os.getpid()}.part'
+                with open(partial, 'w', encoding='utf-8') as f:
                     json.dump(data, f, ensure_ascii=False, indent=2)
+                os.replace(partial, filename)
             
             # 清空旧的声音列表
             self.voices.clear()
@@ -136,14 +148,14 @@ class NanoAITTS:
                     'iconUrl': item['icon']
                 }
         except Exception as e:
-            print(f"加载声音列表失败: {e}")
+            log.error("加载声音列表失败: %s", e)
             self.voices.clear()
             # 如果网络请求失败，添加默认选项
             self.voices['DeepSeek'] = {'name': 'DeepSeek (默认)', 'iconUrl': ''}
     
-    def get_audio(self, text, voice='DeepSeek', stream=False):
-        """获取音频"""
-        url = f'https://bot.n.cn/api/tts/v1?roleid={voice}'
+    def get_audio(self, text, voice='DeepSeek', stream=False, timeout=30):
+        """获取音频（timeout 为单次请求的超时秒数）"""
+        url = f'{BASE_URL}/api/tts/v1?roleid={voice}'
         
         headers = self.get_headers()
         headers['Content-Type'] = 'application/x-www-form-urlencoded'
@@ -151,7 +163,7 @@ class NanoAITTS:
         form_data = f'&text={urllib.parse.quote(text)}&audio_type=mp3&format=stream'
         
         try:
-            response_data = self.http_post(url, form_data, headers, stream=stream)
+            response_data = self.http_post(url, form_data, headers, stream=stream, timeout=timeout)
             
             if stream:
                 return response_data
@@ -166,7 +178,7 @@ class NanoAITTS:
                         raise Exception(f"上游 API 错误: {reason or error_json}")
                     else:
                         # 可能是其他类型的 JSON 响应，打印警告但继续（或者也抛出异常）
-                        print(f"警告: 上游返回了 JSON 数据而不是音频: {response_data[:100]}")
+                        log.warning("上游返回了 JSON 数据而不是音频: %r", response_data[:100])
                         # 如果确定不是音频，可以抛出异常
                         # raise Exception(f"上游 API 返回错误: {response_data.decode('utf-8', errors='ignore')}")
                 except json.JSONDecodeError:
@@ -174,5 +186,5 @@ class NanoAITTS:
 
             return response_data
         except Exception as e:
-            print(f"获取音频失败: {e}")
+            log.warning("获取音频失败: %s", e)
             raise e
\ No newline at end of file
@@ -0,0 +1,275 @@
+# prefork.py
+
+"""
+Pre-fork launcher for the unified TTS service.
+
+    python prefork.py
+
+One process is bound to one core by the GIL, and base64, JSON and text
+cleaning keep it busy. This launcher imports main.py once in the parent (the
+Flask app, voice indexes, emoji tables, edge-tts), waits for the backends to
+warm up, moves everything loaded so far out of the garbage collector's reach
+with gc.freeze() so the pages stay shared copy-on-write, and forks
+PREFORK_WORKERS workers that all accept on the same listening socket.
+
+Workers share the on-disk cache tier (DISK_CACHE_DIR) and the job store.
+Each worker is recycled, finishing its in-flight requests first, after
+PREFORK_MAX_REQUESTS requests or once its resident memory passes
+PREFORK_MAX_RSS_MB; the parent replaces any worker that exits. SIGTERM or
+Ctrl-C stops the workers gracefully.
+
+Files served with send_file (buffered edge audio) are written to the client
+socket with sendfile(2), without passing through the worker's memory.
+
+Metrics and admission limits are per worker.
+"""
+
+import gc
+import os
+import random
+import signal
+import socket
+import sys
+import threading
+import time
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'app'))
+
+import startup
+
+startup.prefork = True
+
+import logs
+import main
+from config import DEFAULT_CONFIGS
+from werkzeug.serving import ThreadedWSGIServer
+from werkzeug.wsgi import FileWrapper
+
+PORT = int(os.environ.get('PORT', 5050))
+WORKERS = int(os.getenv('PREFORK_WORKERS', str(DEFAULT_CONFIGS["PREFORK_WORKERS"]))) or os.cpu_count() or 1
+MAX_REQUESTS = int(os.getenv('PREFORK_MAX_REQUESTS', str(DEFAULT_CONFIGS["PREFORK_MAX_REQUESTS"])))
+MAX_RSS_MB = float(os.getenv('PREFORK_MAX_RSS_MB', str(DEFAULT_CONFIGS["PREFORK_MAX_RSS_MB"])))
+GRACEFUL_TIMEOUT = float(os.getenv('PREFORK_GRACEFUL_TIMEOUT', str(DEFAULT_CONFIGS["PREFORK_GRACEFUL_TIMEOUT"])))
+
+# How long the parent waits for the backends to warm up before forking anyway
+WARM_UP_WAIT = 30.0
+# Workers that exit sooner than this after starting are respawned after a pause
+MIN_WORKER_LIFETIME = 1.0
+
+def rss_mb():
+    """This process's resident memory in MB, or None where /proc is not available."""
+    try:
+        with open('/proc/self/statm', 'r') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / (1024 * 1024)
+    except (OSError, ValueError):
+        return None
+
+class WorkerLifecycle:
+    """
+    WSGI middleware for a worker: counts requests and in-flight responses, and asks the
+    worker to stop once it has served max_requests or its memory is over max_rss_mb.
+    """
+
+    def __init__(self, app, max_requests, max_rss_mb, on_limit):
+        self.app = app
+        # Jittered so workers started together are not all recycled together
+        self.max_requests = max_requests + random.randint(0, max_requests // 10) if max_requests else 0
+        self.max_rss_mb = max_rss_mb
+        self.on_limit = on_limit
+        self.served = 0
+        self.in_flight = 0
+        self._lock = threading.Lock()
+
+    def __call__(self, environ, start_response):
+        with self._lock:
+            self.in_flight += 1
+        if 'HTTP_RANGE' not in environ:
+            # A range is cut from the wrapper's chunks, so only whole files can be sent directly
+            environ['wsgi.file_wrapper'] = lambda file, buffer_size=8192: SendfileWrapper(environ, file, buffer_size)
+
+        def start(status, headers, exc_info=None):
+            # Without a length werkzeug chunks the body, which bytes sent by sendfile would bypass
+            environ[SENDFILE_SIZED] = any(name.lower() == 'content-length' for name, _ in headers)
+            return start_response(status, headers, exc_info)
+
+        try:
+            body = self.app(environ, start)
+        except BaseException:
+            self._finished()
+            raise
+        return _ClosingBody(body, environ, self._finished)
+
+    def _finished(self):
+        with self._lock:
+            self.in_flight -= 1
+            self.served += 1
+            served = self.served
+        if self.max_requests and served >= self.max_requests:
+            self.on_limit(f"served {served} requests")
+            return
+        if self.max_rss_mb:
+            rss = rss_mb()
+            if rss is not None and rss > self.max_rss_mb:
+                self.on_limit(f"resident memory {rss:.0f} MB is over {self.max_rss_mb:.0f} MB")
+
+class _ClosingBody:
+    """A response body that reports when the server has finished with it (streams included)."""
+
+    def __init__(self, body, environ, on_close):
+        self._body = body
+        self._environ = environ
+        self._on_close = on_close
+
+    def __iter__(self):
+        # From here on the server is writing to the socket, so a file wrapper may write to it too
+        self._environ[SENDFILE_READY] = self._environ.get(SENDFILE_SIZED, False)
+        return iter(self._body)
+
+    def close(self):
+        try:
+            if hasattr(self._body, 'close'):
+                self._body.close()
+        finally:
+            self._on_close()
+
+SENDFILE_SIZED = 'prefork.sendfile_sized'
+SENDFILE_READY = 'prefork.sendfile_ready'
+
+class SendfileWrapper(FileWrapper):
+    """
+    wsgi.file_wrapper that hands the whole file to the kernel with socket.sendfile once the
+    server is sending the body. Read inside the app (e.g. to cache it) it yields chunks like
+    werkzeug's FileWrapper.
+    """
+
+    def __init__(self, environ, file, buffer_size=8192):
+        super().__init__(file, buffer_size)
+        self.environ = environ
+
+    def __iter__(self):
+        sock = self.environ.get('werkzeug.socket')
+        if sock is None or not self.environ.get(SENDFILE_READY) or not hasattr(self.file, 'fileno'):
+            return super().__iter__()
+        return self._sendfile(sock)
+
+    def _sendfile(self, sock):
+        yield b''  # werkzeug writes and flushes the status line and headers before the first chunk
+        sock.sendfile(self.file)
+
+class WorkerServer(ThreadedWSGIServer):
+    # run_worker waits for in-flight requests itself, with a timeout; joining the
+    # connection threads on close would wait on a stalled client with no limit
+    block_on_close = False
+
+STOP_SIGNALS = {signal.SIGTERM, signal.SIGINT}
+
+def run_worker(slot, listener):
+    """Serves on the inherited listening socket until asked to stop; returns the exit code."""
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.signal(signal.SIGINT, signal.SIG_IGN)  # Ctrl-C reaches the parent, which stops the workers
+    signal.pthread_sigmask(signal.SIG_UNBLOCK, STOP_SIGNALS)
+    startup.start_worker(slot)
+
+    stopping = threading.Event()
+    server = None
+
+    def stop(reason):
+        if stopping.is_set():
+            return
+        stopping.set()
+        print(f"Worker {slot} (pid {os.getpid()}) stopping: {reason}")
+        # shutdown() waits for serve_forever to return, so it cannot run on the serving thread
+        threading.Thread(target=server.shutdown, name='worker-shutdown', daemon=True).start()
+
+    lifecycle = WorkerLifecycle(main.app, MAX_REQUESTS, MAX_RSS_MB, stop)
+    server = WorkerServer('0.0.0.0', PORT, lifecycle, fd=listener.fileno())
+    signal.signal(signal.SIGTERM, lambda signum, frame: stop("SIGTERM"))
+    print(f"Worker {slot} (pid {os.getpid()}) serving")
+    server.serve_forever()
+
+    # No longer accepting; let in-flight requests and streams finish
+    deadline = time.monotonic() + GRACEFUL_TIMEOUT
+    while lifecycle.in_flight and time.monotonic() < deadline:
+        time.sleep(0.1)
+    if lifecycle.in_flight:
+        print(f"Worker {slot} exiting with {lifecycle.in_flight} requests still in flight")
+    return 0
+
+def spawn(slot, listener):
+    sys.stdout.flush()  # or the child would print the parent's buffered output again
+    # Blocked across the fork so the parent's handlers never run in the child
+    signal.pthread_sigmask(signal.SIG_BLOCK, STOP_SIGNALS)
+    pid = os.fork()
+    if pid:
+        signal.pthread_sigmask(signal.SIG_UNBLOCK, STOP_SIGNALS)
+        return pid
+    code = 1
+    try:
+        code = run_worker(slot, listener)
+    except BaseException as e:
+        print(f"Worker {slot} failed: {e!r}")
+    finally:
+        logs.flush()  # os._exit skips atexit, which would otherwise write the queued records
+        sys.stdout.flush()
+        os._exit(code)
+
+def main_loop():
+    # Preload: everything the workers would otherwise each load or fetch on their own
+    deadline = time.monotonic() + WARM_UP_WAIT
+    while not startup.readiness.is_ready() and time.monotonic() < deadline:
+        time.sleep(0.1)
+    if not startup.readiness.is_ready():
+        print(f"Backends not ready after {WARM_UP_WAIT:.0f}s; workers will keep warming them up")
+    print(startup.profile.report(main.STARTUP_BUDGET_MS))
+
+    listener = socket.create_server(('0.0.0.0', PORT), backlog=2048)
+    listener.set_inheritable(True)
+
+    # Objects that survive until now live for the whole process; freezing them keeps the
+    # collector from writing to their pages, which would un-share them in every worker
+    gc.collect()
+    gc.freeze()
+
+    stopping = False
+    workers = {}  # pid -> (slot, started)
+
+    def shut_down(signum, frame):
+        nonlocal stopping
+        stopping = True
+        for pid in list(workers):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    signal.signal(signal.SIGTERM, shut_down)
+    signal.signal(signal.SIGINT, shut_down)
+
+    def start(slot):
+        pid = spawn(slot, listener)
+        workers[pid] = (slot, time.monotonic())
+        if stopping:
+            os.kill(pid, signal.SIGTERM)  # the stop signal arrived while it was being forked
+
+    for slot in range(WORKERS):
+        start(slot)
+    print(f"Unified TTS Server running on port {PORT} with {WORKERS} workers")
+
+    while workers:
+        try:
+            pid, status = os.wait()
+        except ChildProcessError:
+            break
+        slot, started = workers.pop(pid, (None, None))
+        if slot is None or stopping:
+            continue
+        code = os.waitstatus_to_exitcode(status)
+        if code != 0:
+            print(f"Worker {slot} (pid {pid}) exited with {code}")
+        if time.monotonic() - started < MIN_WORKER_LIFETIME:
+            time.sleep(MIN_WORKER_LIFETIME)  # a worker failing at startup should not spin
+        start(slot)
+    listener.close()
+
+if __name__ == "__main__":
+    main_loop()